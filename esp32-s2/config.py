@@ -5,5 +5,16 @@ config = {
     "mqtt_username": "**USER**",
     "mqtt_password": "**PASSWORD**",
     "mqtt_clientid": "**CLIENT_ID**",
-    "time_server": "au.pool.ntp.org",
+    "mqtt_publish_rate": 2,
+    "mqtt_protocol": 4,
+    "mqtt_tls": False,
+    "mqtt_tls_cert": "",
+    "mqtt_heartbeat_s": 120,
+    "mqtt_state_fields": False,
+    "power_save": False,
+    "power_light_sleep_ms": 0,  # only while Wi-Fi is down, light sleep drops the AP
+    "battery_mah": 0,
+    "telemetry_s": 60,
+    "profile": False,
+    "time_servers": ["0.au.pool.ntp.org", "1.au.pool.ntp.org", "2.au.pool.ntp.org"],
 }
@@ -1,25 +1,46 @@
 # main.py
-# Non-blocking 1000 ms tick using uasyncio.
+# Event-driven MQTT letterbox controller using uasyncio.
 # - Connects Wi-Fi
-# - Syncs RTC from NTP (UTC)
+# - Syncs RTC from NTP (UTC) and keeps it in sync
 # - Connects MQTT and subscribes
-# - Publishes state every second without blocking
-# - Services MQTT in background and keeps connection alive
+# - Queues /set commands off the MQTT read path and applies them from a
+#   task of their own, a burst of them as one update
+# - Publishes state, retained, only when it changes; otherwise just a small
+#   retained heartbeat every HEARTBEAT_S, which expires when the board goes quiet
+# - Publishes without blocking, through a coalescing, rate limited queue
+#   drained by one writer task
+# - Services MQTT in background and keeps connection alive, reconnecting
+#   with backoff instead of resetting when the broker goes away or the
+#   link goes silent (missed pings)
+#   (reader task wakes only when the broker sends something)
+# - Runs the periodic jobs (Wi-Fi check, pings, heartbeat) from one
+#   scheduler, so they share their wakeups
+# - Publishes device health (heap, loop lag, RSSI, reset cause, error
+#   counters) on <id>/telemetry every TELEMETRY_S
+# - Reconnects Wi-Fi when it drops; feeds a hardware watchdog only while the
+#   loop keeps time and Wi-Fi hasn't stayed down for WIFI_LOST_S
+# - "profile" in config.py times every task's steps (see lib/profiler.py);
+#   {"profile": true} on /set prints the figures
+# - "power_save" in config.py: Wi-Fi modem sleep, an 80 MHz CPU, a 5 minute
+#   keepalive, and light sleep between wakes while Wi-Fi is down when
+#   "power_light_sleep_ms" is set
 
 import machine
 import time
-from time import gmtime
 from machine import Pin
 import network
-import select, struct
-from mqtt import MQTTClient
+from commands import CommandQueue
+from mqtt import AsyncMQTTClient, PublishQueue, tls_context
+from ntp import NTPClient
+from profiler import Profiler
+from resolver import Resolver
+from scheduler import Scheduler
+from statejson import StateJSON
+import telemetry
+from watchdog import Watchdog
+from wifi import WifiConnect
 import ujson as json
 
-try:
-    import usocket as socket
-except:
-    import socket
-
 try:
     import uasyncio as asyncio
 except ImportError:
@@ -33,25 +54,66 @@ SLEEP_LED_MS = 50  # brief indicator blinks
 
 from config import *
 
-ntp_host = config["time_server"]
+# "time_servers" wins; a single "time_server" from an older config.py is still accepted
+ntp_servers = config.get("time_servers") or [config["time_server"]]
 
 mqtt_host = config["mqtt_host"]
 mqtt_clientid = config["mqtt_clientid"]  # e.g. "letterbox1"
 mqtt_username = config["mqtt_username"] or None
 mqtt_password = config["mqtt_password"] or None
-KEEPALIVE_S = 60
+POWER_SAVE = config.get("power_save", False)
+# Light sleep stops the radio and costs the association, so the CPU only
+# light-sleeps, up to this long at a time, while Wi-Fi is down and waiting to
+# reconnect. Connected, it idles and modem sleep saves the power. 0: always idle.
+LIGHT_SLEEP_MS = config.get("power_light_sleep_ms", 0) if POWER_SAVE else 0
+KEEPALIVE_S = 300 if POWER_SAVE else 60
+PING_INTERVAL_S = 120 if POWER_SAVE else 15  # also measures the round trip
+MAX_MISSED_PINGS = 2  # then the link is dead and reconnected, ~2-3 pings after it went silent
+WIFI_CHECK_S = PING_INTERVAL_S if POWER_SAVE else 1  # also feeds the watchdog
+WIFI_LOST_S = 300  # reconnects failing this long reset the board
+WDT_TIMEOUT_MS = max(10000, WIFI_CHECK_S * 3000)
+PUBLISH_RATE = config.get("mqtt_publish_rate", 2)  # publishes/s, sustained
+PUBLISH_BURST = 5
+PUBLISH_QUEUE_BYTES = 2048
+MQTT_PROTOCOL = config.get("mqtt_protocol", 4)  # 4: MQTT 3.1.1, 5: MQTT 5
+# MQTT 5 only: the broker drops the session, with any /set commands queued
+# in it, after this long offline
+SESSION_EXPIRY_S = 600
+HEARTBEAT_S = config.get("mqtt_heartbeat_s", 120)
+# False: the whole state as JSON on <id>/state. True: each field on its own
+# retained topic, <id>/state/<field>, and only the fields that changed.
+STATE_FIELDS = config.get("mqtt_state_fields", False)
+TELEMETRY_S = config.get("telemetry_s", 60)
 
 TOPIC_SET = (mqtt_clientid + "/set").encode()
 TOPIC_STATE = (mqtt_clientid + "/state").encode()
+TOPIC_HEARTBEAT = (mqtt_clientid + "/heartbeat").encode()
+TOPIC_TELEMETRY = (mqtt_clientid + "/telemetry").encode()
+EPOCH_1970_S = 946684800 if time.gmtime(0)[0] == 2000 else 0
 
 # ---------- Globals ----------
-NTP_DELTA = 3155673600 if gmtime(0)[0] == 2000 else 2208988800
 rtc = machine.RTC()
+resolver = Resolver()  # DNS server set once Wi-Fi is up
+ntp = NTPClient(ntp_servers, rtc, resolver=resolver)
 wlan = network.WLAN(network.STA_IF)
+wifi = WifiConnect(wlan)
+health = telemetry.Telemetry(wlan)
+prof = Profiler(enabled=config.get("profile", False))
+wdt = Watchdog(WDT_TIMEOUT_MS)
+wdt.check("wifi lost", lambda: wifi.down_ms() < WIFI_LOST_S * 1000)
+# /set fields; bit i of a command's mask and values is field i
+COMMAND_FIELDS = ("enabled", "on", "profile")
 led = Pin(LED_PIN, Pin.OUT)
 led_string = Pin(STRING_LED_PIN, Pin.OUT)
 
-state = {"enabled": False, "on": False, "date_time": rtc.datetime()}
+state = {"enabled": False, "on": False}
+state_published = {}  # field -> value as last published
+heartbeat = {"t": 0}
+# Formatted into buffers reused for every publish
+STATE_JSON = StateJSON(("enabled", "on"))
+HEARTBEAT_JSON = StateJSON(("t",))
+TOPIC_STATE_FIELD = {k: TOPIC_STATE + b"/" + k.encode() for k in STATE_JSON.keys}
+state_changed = asyncio.Event()
 
 
 def dprint(*a):
@@ -76,176 +138,187 @@ async def blink(n=1, t_ms=SLEEP_LED_MS):
         await asyncio.sleep_ms(t_ms)
 
 
-def ts_time_utc() -> int:
-    """Return current UTC epoch seconds from NTP or 0 on failure."""
-    NTP_QUERY = bytearray(48)
-    NTP_QUERY[0] = 0x1B
-    try:
-        addr = socket.getaddrinfo(ntp_host, 123)[0][-1]
-    except OSError:
-        return 0
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    poller = select.poll()
-    poller.register(s, select.POLLIN)
-    try:
-        s.sendto(NTP_QUERY, addr)
-        if poller.poll(1000):  # 1s timeout
-            msg = s.recv(48)
-            val = struct.unpack("!I", msg[40:44])[0]
-            return max(val - NTP_DELTA, 0)
-    except OSError:
-        pass
-    finally:
-        s.close()
-    return 0
+def mqtt_publish_state(outbox):
+    # Sent by the writer task; a newer message for the topic replaces it.
+    # Retained and never expiring, so a subscriber arriving later gets it at once
+    if STATE_FIELDS:
+        for k in STATE_JSON.keys:
+            v = state[k]
+            if state_published.get(k) != v:
+                outbox.put(TOPIC_STATE_FIELD[k], STATE_JSON.value(k, v), True, expiry_s=0)
+    else:
+        outbox.put(TOPIC_STATE, STATE_JSON.dumps(state), True, expiry_s=0)
+    state_published.update(state)
 
 
-def set_rtc_from_ntp():
-    """Set RTC to UTC. Weekday is dt[6]. Subseconds=0."""
-    t = ts_time_utc()
-    if not t:
-        return False
-    dt = gmtime(t)  # (Y,M,D,h,m,s,wday,yday)
-    rtc.datetime((dt[0], dt[1], dt[2], dt[6], dt[3], dt[4], dt[5], 0))
-    return True
+def mqtt_publish_heartbeat(outbox):
+    # Gone from the broker once three heartbeats are missed (MQTT 5)
+    heartbeat["t"] = (ntp.now_ms() - ntp.tz_ms) // 1000 + EPOCH_1970_S
+    outbox.put(TOPIC_HEARTBEAT, HEARTBEAT_JSON.dumps(heartbeat), True, expiry_s=HEARTBEAT_S * 3)
 
 
-def mqtt_publish(client, topic, data):
-    # JSON -> bytes
-    payload = json.dumps(data).encode()
-    client.publish(topic, payload)
+def mqtt_publish_telemetry(outbox):
+    # Retained, so the last report before a board went quiet stays readable
+    outbox.put(TOPIC_TELEMETRY, json.dumps(health.snapshot()).encode(), True, expiry_s=0)
 
 
-def mqtt_make_on_msg(client):
-    def mqtt_on_msg(topic, msg):
-        dprint("MQTT:", topic, msg)
-        try:
-            data = json.loads(msg.decode())
-        except Exception as e:
-            dprint("JSON parse error:", e)
-            return
+def apply_commands(mask, values):
+    # Every /set since the last call, folded into one: one pin update, and
+    # state_publisher() publishes once
+    for i in range(2):
+        k = COMMAND_FIELDS[i]
+        bit = 1 << i
+        if mask & bit and state[k] != bool(values & bit):
+            state[k] = bool(values & bit)
+            state_changed.set()
+    if mask & values & 4:
+        prof.dump()
 
-        if "enabled" in data:
-            state["enabled"] = bool(data["enabled"])
-        if "on" in data:
-            state["on"] = bool(data["on"])
+    led.value(1 if state["enabled"] else 0)
+    led_string.value(1 if state["on"] else 0)
 
-        led.value(1 if state["enabled"] else 0)
-        led_string.value(1 if state["on"] else 0)
-        mqtt_publish(client, TOPIC_STATE, state)  # uses captured client
 
-    return mqtt_on_msg
+commands = CommandQueue(COMMAND_FIELDS, apply_commands)
+
+
+def mqtt_on_msg(topic, msg):
+    # topic and msg are memoryviews into the client's receive buffer, only
+    # good until this returns; the command is checked and queued here and
+    # applied by its own task, so the reader gets straight back to reading
+    if DEBUGGING:
+        dprint("MQTT:", bytes(topic), bytes(msg))
+    if not commands.push(msg):
+        dprint("Invalid command:", bytes(msg))
 
 
 # ---------- Wi-Fi ----------
 async def wifi_connect():
     wlan.active(True)
-    if not wlan.isconnected():
-        wlan.connect(config["wlan_ssid"], config["wlan_pwd"])
-        # Wait up to 15s without blocking loop
-        for _ in range(150):
-            if wlan.isconnected():
-                break
-            await asyncio.sleep_ms(100)
-    if not wlan.isconnected():
+    if POWER_SAVE:
+        # Receiver off between the AP's beacons; frames for us wait at the AP
+        wlan.config(pm=wlan.PM_POWERSAVE)
+    # Straight to the last AP if cached, otherwise up to 15s for a full
+    # connect, without blocking the loop
+    if not await wifi.reconnect(((config["wlan_ssid"], config["wlan_pwd"]),)):
         return False
     dprint("Wi-Fi:", wlan.ifconfig())
+    resolver.dns_server = wlan.ifconfig()[3]
     return True
 
 
-# Periodic Wi-Fi guard. Resets on disconnect.
-async def wifi_guard():
-    while True:
-        if not wlan.isconnected():
-            dprint("Wi-Fi lost. Resetting.")
-            machine.reset()
-        await asyncio.sleep_ms(1000)
+def wifi_check():
+    # A reconnect can take longer than the watchdog's timeout, so it gets a
+    # task of its own rather than holding up the scheduler's other jobs
+    if not wlan.isconnected() and not wifi.connecting:
+        prof.create_task(wifi_connect(), "wifi")
 
 
 # ---------- MQTT ----------
-def mqtt_connect():
-    c = MQTTClient(
+def mqtt_tls():
+    # One context for every connect, so reconnects can resume the TLS session.
+    # "mqtt_tls_cert" is a DER file of the broker's certificate, or of its CA,
+    # and pins the broker; without it the link is encrypted but not verified.
+    if not config.get("mqtt_tls"):
+        return False
+    cadata = None
+    if config.get("mqtt_tls_cert"):
+        with open(config["mqtt_tls_cert"], "rb") as f:
+            cadata = f.read()
+    return tls_context(cadata)
+
+
+async def mqtt_setup():
+    c = AsyncMQTTClient(
         client_id=mqtt_clientid,
         server=mqtt_host,
         user=mqtt_username,
         password=mqtt_password,
         keepalive=KEEPALIVE_S,
+        ssl=mqtt_tls(),
+        ping_interval_ms=0,  # pinged from the scheduler
+        max_missed_pings=MAX_MISSED_PINGS,
+        protocol=MQTT_PROTOCOL,
+        session_expiry_s=SESSION_EXPIRY_S,
     )
-    c.set_callback(mqtt_make_on_msg(c))
-    c.connect()
-    c.subscribe(TOPIC_SET, qos=0)
-    return c
+    outbox = PublishQueue(c, rate=PUBLISH_RATE, burst=PUBLISH_BURST, max_bytes=PUBLISH_QUEUE_BYTES)
+    await c.subscribe(TOPIC_SET, qos=0, handler=mqtt_on_msg)  # not connected yet, sent on connect
+    return c, outbox
 
 
-async def mqtt_service(client):
-    last_ping = now_ms()
-    while True:
+async def mqtt_ping(client):
+    if client.isconnected():
         try:
-            client.check_msg()
+            await client.ping()
         except OSError:
-            machine.reset()
+            pass  # dead link, closed; keep_connected() reconnects
 
-        if ms_since(last_ping) > (KEEPALIVE_S * 800):  # ~0.8*keepalive
-            try:
-                client.ping()
-            except OSError:
-                machine.reset()
-            last_ping = now_ms()
 
-        await asyncio.sleep_ms(20)
+async def mqtt_service(client, outbox):
+    prof.create_task(outbox.run(), "outbox")
+    # Resolve through the cache so a slow DNS server can't stall the loop
+    await client.keep_connected(resolver.lookup)  # never returns
 
 
-# ---------- 1 Hz Tick ----------
-async def tick_1hz(client):
-    period = 10000  # ms
+# ---------- State ----------
+async def state_publisher(outbox):
+    # State goes out as soon as it changes; the heartbeat is a scheduler job
     while True:
-        t0 = now_ms()
-
-        state["date_time"] = rtc.datetime()
-        try:
-            mqtt_publish(client, TOPIC_STATE, state)
-        except OSError:
-            machine.reset()
-
-        # sleep the remainder of the 1000 ms slot
-        rem = period - ms_since(t0)
-        if rem < 0:
-            rem = 0
-        await asyncio.sleep_ms(rem)
+        await state_changed.wait()
+        state_changed.clear()
+        mqtt_publish_state(outbox)
 
 
 # ---------- Main ----------
 async def main():
+    if POWER_SAVE:
+        machine.freq(80000000)
     await blink(2, 100)
 
     if not await wifi_connect():
         # slow blink → no Wi-Fi, then reset
         await blink(10, 250)
-        machine.reset()
+        telemetry.reset("no wifi")
 
-    if set_rtc_from_ntp():
+    if await ntp.sync():
         await blink(3, 150)  # RTC set indicator
+        dprint("NTP:", ntp.metrics())
     else:
         dprint("NTP failed; keeping previous RTC")
 
+    mqtt_client, outbox = await mqtt_setup()
+    prof.create_task(mqtt_service(mqtt_client, outbox), "mqtt")
     try:
-        mqtt_client = mqtt_connect()
-    except OSError:
-        dprint("MQTT connect failed. Resetting.")
-        machine.reset()
+        await asyncio.wait_for_ms(mqtt_client.wait_connected(), 15000)
+        await blink(3, 300)  # MQTT connected indicator
+    except asyncio.TimeoutError:
+        dprint("MQTT not connected yet, retrying in the background")
 
-    await blink(3, 300)  # MQTT connected indicator
-
-    # Publish initial state
-    try:
-        mqtt_publish(mqtt_client, TOPIC_STATE, state)
-    except OSError:
-        machine.reset()
+    # Publish initial state, queued until connected
+    mqtt_publish_state(outbox)
+    mqtt_publish_heartbeat(outbox)
 
     # Launch tasks
-    asyncio.create_task(wifi_guard())
-    asyncio.create_task(mqtt_service(mqtt_client))
-    await tick_1hz(mqtt_client)  # never returns
+    sched = Scheduler(light_sleep_ms=LIGHT_SLEEP_MS, wifi_powersave=POWER_SAVE, on_lag=health.lag, wlan=wlan)
+    sched.every(WIFI_CHECK_S * 1000, lambda: wdt.feed(health.lag_ms))
+    sched.every(WIFI_CHECK_S * 1000, wifi_check)
+    sched.every(PING_INTERVAL_S * 1000, lambda: mqtt_ping(mqtt_client))
+    sched.every(HEARTBEAT_S * 1000, lambda: mqtt_publish_heartbeat(outbox))
+    sched.every(TELEMETRY_S * 1000, lambda: mqtt_publish_telemetry(outbox))
+    mqtt_keys = ("reconnects", "dead_links", "refused", "retransmits", "oversized", "srtt_ms", "last_error")
+    health.add("mqtt", mqtt_client.metrics, mqtt_keys)
+    health.add("outbox", outbox.metrics, ("failed", "dropped"))
+    health.add("ntp", ntp.metrics, ("failures", "offset_ms"))
+    health.add("wifi", wifi.metrics, ("direct", "full", "lost", "direct_ms", "connect_ms"))
+    battery_mah = config.get("battery_mah", 0)
+    health.add("power", lambda: sched.metrics(battery_mah), ("wakes_per_h", "est_ma", "est_days"))
+    if prof.enabled:
+        health.add("tasks", prof.stats)
+    health.add("watchdog", wdt.metrics)
+    health.add("commands", commands.metrics, ("received", "invalid", "folded"))
+    prof.create_task(ntp.run(), "ntp")
+    prof.create_task(state_publisher(outbox), "state")
+    prof.create_task(commands.run(), "commands")
+    await prof.wrap(sched.run(), "sched")  # never returns
 
 
 # Run
@@ -0,0 +1,141 @@
+# bench_mqtt_throughput.py
+# Messages per second and heap use per message of lib/mqtt.py's
+# AsyncMQTTClient, against fake_broker.FakeBroker.
+#
+#   python host/bench_mqtt_throughput.py                   # 20000 messages each
+#   python host/bench_mqtt_throughput.py 50000 old_mqtt.py
+#
+# - publish qos0: publish() with the broker discarding what it gets
+# - publish qos1: publish() and wait_delivered(), the broker acking each one
+# - receive: run() delivering queued PUBLISHes to a callback
+#
+# "peak B/msg" is how far the traced heap rose while handling one message,
+# averaged; "kept B/msg" is what was still held after all of them. Under
+# tracemalloc they stand in for gc.mem_alloc() growth on the board. The
+# rates are CPython's and only mean something against another run.
+
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+import upy
+
+upy.install("esp32-s2")
+
+import asyncio
+
+from bench_mqtt_wire import STATE, load
+from fake_broker import FakeBroker, publish
+
+TOPIC = b"letterbox1/state"
+
+
+class Heap:
+    """Traced heap growth between calls to mark(), from begin() on."""
+
+    def begin(self):
+        tracemalloc.start()
+        self.start = self.last = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        self.peaks = 0
+        self.n = 0
+
+    def mark(self):
+        cur, peak = tracemalloc.get_traced_memory()
+        self.peaks += peak - self.last
+        self.n += 1
+        self.last = cur
+        tracemalloc.reset_peak()
+
+    def stop(self):
+        gc.collect()  # the broker and its connections hold each other
+        kept = tracemalloc.get_traced_memory()[0] - self.start
+        tracemalloc.stop()
+        return self.peaks / self.n, kept / self.n
+
+
+def _client(mqtt, broker):
+    c = mqtt.AsyncMQTTClient(b"letterbox1", "broker", keepalive=0, max_inflight=1)
+    c.set_callback(lambda t, m: None)
+    return c
+
+
+async def _publish(c, broker, n, qos, heap=None):
+    await c.connect()
+    broker.sink = qos == 0  # nothing to answer, so skip parsing
+    if heap:
+        heap.begin()
+    for _ in range(n):
+        pid = await c.publish(TOPIC, STATE, qos=qos)
+        if qos:
+            await c.wait_delivered(pid)
+        if heap:
+            heap.mark()
+
+
+async def _receive(c, broker, n, heap=None):
+    got = [0]
+
+    def cb(topic, msg):
+        got[0] += 1
+        if heap:
+            heap.mark()
+        if got[0] == n:
+            broker.drop()  # run() returns once the last one is handled
+
+    c.set_callback(cb)
+    await c.connect()
+    broker.send(publish(TOPIC, STATE) * n)
+    if heap:
+        heap.begin()
+    try:
+        await c.run()
+    except OSError:
+        pass
+    assert got[0] == n
+
+
+def bench(mqtt, name, n, measure_heap):
+    def once(heap):
+        broker = FakeBroker()
+        with broker.patch(mqtt):
+            c = _client(mqtt, broker)
+            if name == "receive":
+                f = _receive(c, broker, n, heap)
+            else:
+                f = _publish(c, broker, n, 1 if name == "publish qos1" else 0, heap)
+            asyncio.run(f)
+
+    t0 = time.perf_counter()
+    once(None)
+    rate = n / (time.perf_counter() - t0)
+    if not measure_heap:
+        return name, rate, None, None
+    heap = Heap()
+    once(heap)
+    return (name, rate) + heap.stop()
+
+
+def report(title, rows):
+    print(title)
+    print("  %-14s %10s %11s %11s" % ("", "msgs/s", "peak B/msg", "kept B/msg"))
+    for name, rate, peak, kept in rows:
+        if peak is None:
+            print("  %-14s %10d %11s %11s" % (name, rate, "-", "-"))
+        else:
+            print("  %-14s %10d %11.1f %11.1f" % (name, rate, peak, kept))
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    path = sys.argv[2] if len(sys.argv) > 2 else os.path.join(upy.LIB, "mqtt.py")
+    mqtt = load(path)
+    # The broker parses and acks every QoS 1 publish, so the heap figures would be its own
+    rows = [
+        bench(mqtt, "publish qos0", n, True),
+        bench(mqtt, "publish qos1", n, False),
+        bench(mqtt, "receive", n, True),
+    ]
+    report("%s, AsyncMQTTClient, %d messages" % (path, n), rows)
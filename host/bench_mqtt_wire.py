@@ -0,0 +1,89 @@
+# bench_mqtt_wire.py
+# Count socket writes (roughly TCP segments with Nagle off) and bytes per
+# MQTT packet sent by lib/mqtt.py.
+#
+#   python host/bench_mqtt_wire.py                 # current lib/mqtt.py
+#   python host/bench_mqtt_wire.py old_mqtt.py     # e.g. from git show <rev>:lib/mqtt.py
+#
+# The broker is fake_broker.FakeBroker, so the blocking client's round trips
+# complete. Speaking MQTT 5 it allows 10 topic aliases.
+
+import importlib.util
+import os
+import sys
+
+import upy
+
+upy.install("esp32-s2")
+
+import asyncio
+
+from fake_broker import FakeBroker
+
+STATE = b'{"enabled": true, "on": false, "date_time": [2025, 1, 1, 2, 12, 30, 45, 0]}'
+
+
+def load(path):
+    spec = importlib.util.spec_from_file_location("mqtt_under_test", path)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+
+def _measure(broker, f):
+    def totals():
+        return sum(len(c.writes) for c in broker.connections), sum(sum(c.writes) for c in broker.connections)
+
+    w0, b0 = totals()
+    f()
+    w1, b1 = totals()
+    return w1 - w0, b1 - b0
+
+
+def bench_blocking(mqtt, n=100):
+    broker = FakeBroker()
+    with broker.patch(mqtt):
+        c = mqtt.MQTTClient(b"letterbox1", "broker", user=b"user", password=b"password", keepalive=60)
+        c.set_callback(lambda t, m: None)
+        rows = [("CONNECT",) + _measure(broker, lambda: c.connect())]
+        rows.append(("SUBSCRIBE",) + _measure(broker, lambda: c.subscribe(b"letterbox1/set")))
+        w, b = _measure(broker, lambda: [c.publish(b"letterbox1/state", STATE) for _ in range(n)])
+        rows.append(("PUBLISH qos0", w / n, b / n))
+        w, b = _measure(broker, lambda: [c.publish(b"letterbox1/state", STATE, qos=1) for _ in range(n)])
+        rows.append(("PUBLISH qos1", w / n, b / n))
+    return rows
+
+
+def bench_async(mqtt, n=100, **kw):
+    broker = FakeBroker()
+    broker.connack_props = b"\x22\x00\x0a"  # MQTT 5: 10 topic aliases
+    run = asyncio.new_event_loop().run_until_complete
+    with broker.patch(mqtt):
+        c = mqtt.AsyncMQTTClient(b"letterbox1", "broker", user=b"user", password=b"password", keepalive=60, **kw)
+        c.set_callback(lambda t, m: None)
+        rows = [("CONNECT",) + _measure(broker, lambda: run(c.connect()))]
+        rows.append(("SUBSCRIBE",) + _measure(broker, lambda: run(c.subscribe(b"letterbox1/set"))))
+        w, b = _measure(broker, lambda: [run(c.publish(b"letterbox1/state", STATE)) for _ in range(n)])
+        rows.append(("PUBLISH qos0", w / n, b / n))
+    return rows
+
+
+def report(title, rows):
+    print(title)
+    print("  %-14s %8s %8s" % ("packet", "writes", "bytes"))
+    for name, w, b in rows:
+        print("  %-14s %8g %8g" % (name, w, b))
+
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(upy.LIB, "mqtt.py")
+    mqtt = load(path)
+    report("%s, MQTTClient" % path, bench_blocking(mqtt))
+    if hasattr(mqtt, "AsyncMQTTClient"):
+        report("%s, AsyncMQTTClient" % path, bench_async(mqtt))
+        try:
+            rows = bench_async(mqtt, protocol=5)
+        except TypeError:  # no MQTT 5 support in this version
+            pass
+        else:
+            report("%s, AsyncMQTTClient MQTT 5" % path, rows)
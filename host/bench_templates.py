@@ -0,0 +1,102 @@
+# bench_templates.py
+# The rp2040 status page (32 channels) rendered by WebApp.render_template()
+# from rp2040/templates/status.html, against the same page built as one
+# string and written at once, the way the JSON routes are.
+#
+#   python host/bench_templates.py [pages]
+#
+# "peak B" is how far the traced heap rose while one page was sent; under
+# tracemalloc it stands in for gc.mem_alloc() growth on the board. "first
+# byte us" is the time until the first write, "page us" until the last.
+# The times are CPython's and only mean something against another run.
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import upy
+
+upy.install("rp2040")
+
+from http import WebApp
+
+OUTPUTS = 0x8000A5A5
+INPUTS = 0x0000FF00
+SEQ = 1234
+
+
+class Writer:
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        self.first = None
+        self.writes = 0
+        self.bytes = 0
+
+    def awrite(self, buf, off=0, sz=-1):
+        if self.first is None:
+            self.first = time.perf_counter()
+        self.writes += 1
+        self.bytes += (len(buf) - off) if sz < 0 else sz
+        return
+        yield
+
+
+def naive(writer, outputs, inputs, seq):
+    html = "<!DOCTYPE html>\n<html>\n<head>\n<title>Outputs</title>\n"
+    html += '<meta http-equiv="refresh" content="5">\n'
+    html += "<style>td{padding:2px 8px}.on{background:#8c8}</style>\n</head>\n<body>\n"
+    html += "<h1>Outputs 0x%08X, inputs 0x%08X</h1>\n<table>\n" % (outputs, inputs)
+    html += "<tr><th>Channel</th><th>Output</th><th>Input</th></tr>\n"
+    for i in range(32):
+        if outputs >> i & 1:
+            html += '<tr><td>%d</td><td class="on">on</td>\n' % (i + 1)
+        else:
+            html += "<tr><td>%d</td><td>off</td>\n" % (i + 1)
+        if inputs >> i & 1:
+            html += '<td class="on">on</td></tr>\n'
+        else:
+            html += "<td>off</td></tr>\n"
+    html += "</table>\n<p>Input changes: %d</p>\n</body>\n</html>\n" % seq
+    yield from writer.awrite(html)
+
+
+def bench(name, send, pages):
+    # Warm up (and compile the template) outside the measurement
+    for _ in send(Writer()):
+        pass
+    tracemalloc.start()
+    peak = first = total = 0
+    for _ in range(pages):
+        w = Writer()
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        for _ in send(w):
+            pass
+        t1 = time.perf_counter()
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - base)
+        first += w.first - w.t0
+        total += t1 - w.t0
+    tracemalloc.stop()
+    return name, w.bytes, w.writes, peak, first * 1e6 / pages, total * 1e6 / pages
+
+
+if __name__ == "__main__":
+    pages = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    d = tempfile.mkdtemp()
+    try:
+        shutil.copy(os.path.join(upy.ROOT, "rp2040", "templates", "status.html"), d)
+        app = WebApp()
+        app.templates_dir = d
+        args = (OUTPUTS, INPUTS, SEQ)
+        rows = [bench("string", lambda w: naive(w, *args), pages)]
+        for chunk in (128, 256, 512):
+            rows.append(bench("template/%d" % chunk, lambda w: app.render_template(w, "status.html", args, chunk), pages))
+    finally:
+        shutil.rmtree(d)
+    print("rp2040 status page, %d pages" % pages)
+    print("  %-14s %7s %7s %8s %14s %9s" % ("", "bytes", "writes", "peak B", "first byte us", "page us"))
+    for name, size, writes, peak, first, total in rows:
+        print("  %-14s %7d %7d %8d %14.1f %9.1f" % (name, size, writes, peak, first, total))
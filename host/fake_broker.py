@@ -0,0 +1,374 @@
+# fake_broker.py
+# Scriptable in-process MQTT broker stand-in for lib/mqtt.py. No sockets:
+# each connection is a fake that is both the blocking socket MQTTClient uses
+# and the stream pair AsyncMQTTClient uses.
+#
+#   broker = FakeBroker()
+#   with broker.patch(mqtt):            # clients in mqtt now connect to it
+#       ...
+#   broker.received                     # [(first byte, body), ...] from clients
+#   broker.messages                     # [(topic, msg, qos, retain), ...] published to it
+#   broker.send(publish(b"t", b"msg"))  # raw bytes for the client to read
+#
+# Replies are automatic (CONNACK, SUBACK, UNSUBACK, PUBACK, PUBREC, PUBCOMP,
+# PINGRESP); on_packet(conn, op, body) can answer instead by returning True.
+# Reads return at most `chunk` bytes, to split packets anywhere, and drop()
+# closes the connection under the client. AsyncMQTTClient gets it wrapped in
+# a Stream that, like uasyncio's, only closes when its socket .s is closed. MQTT 5 clients get MQTT 5 replies
+# and their topic aliases are resolved.
+#
+# TLSBroker puts a FakeBroker behind a real TLS listener on 127.0.0.1, for
+# the clients' TLS path; it can't push anything the client didn't ask for.
+
+import asyncio
+import contextlib
+import socket
+import ssl
+import struct
+import threading
+
+
+def encode_len(n):
+    out = bytearray()
+    while True:
+        b = n & 0x7F
+        n >>= 7
+        out.append(b | 0x80 if n else b)
+        if not n:
+            return bytes(out)
+
+
+def packet(op, body=b""):
+    return bytes([op]) + encode_len(len(body)) + bytes(body)
+
+
+def publish(topic, msg, qos=0, pid=0, retain=False, dup=False, props=None):
+    """A PUBLISH for the client. props is the MQTT 5 property block without its length, or None for 3.1.1."""
+    body = struct.pack("!H", len(topic)) + topic
+    if qos:
+        body += struct.pack("!H", pid)
+    if props is not None:
+        body += encode_len(len(props)) + props
+    return packet(0x30 | dup << 3 | qos << 1 | retain, body + msg)
+
+
+def split_packets(data):
+    """Complete (first byte, body) packets at the start of data, and the unused tail."""
+    out = []
+    i = 0
+    while True:
+        j = i + 1
+        n = 0
+        sh = 0
+        while True:
+            if j >= len(data):
+                return out, data[i:]
+            b = data[j]
+            j += 1
+            n |= (b & 0x7F) << sh
+            if not b & 0x80:
+                break
+            sh += 7
+        if j + n > len(data):
+            return out, data[i:]
+        out.append((data[i], data[j : j + n]))
+        i = j + n
+
+
+def _varint(b, i):
+    n = 0
+    sh = 0
+    while True:
+        c = b[i]
+        i += 1
+        n |= (c & 0x7F) << sh
+        if not c & 0x80:
+            return n, i
+        sh += 7
+
+
+def _topic_alias(props):
+    # The topic alias in a PUBLISH property block, 0 if there is none.
+    # Only knows the properties a client puts on a PUBLISH.
+    i = 0
+    while i < len(props):
+        p = props[i]
+        if p == 0x23:
+            return props[i + 1] << 8 | props[i + 2]
+        if p == 0x02:  # message expiry
+            i += 5
+        elif p == 0x01:  # payload format
+            i += 2
+        elif p in (0x03, 0x08, 0x09):  # content type, response topic, correlation data
+            i += 3 + (props[i + 1] << 8 | props[i + 2])
+        else:
+            raise ValueError("fake broker: unexpected PUBLISH property 0x%02x" % p)
+    return 0
+
+
+class Conn:
+    """One client connection, seen from the client side."""
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.rx = bytearray()  # bytes for the client to read, from rx_pos on
+        self.rx_pos = 0
+        self.pending = b""  # partial packet from the client
+        self.closed = False
+        self.blocking = True
+        self.v5 = False
+        self.aliases = {}
+        self.writes = []  # size of each write, e.g. to count TCP segments
+        self._data = None
+
+    def feed(self, data):
+        if self.rx_pos == len(self.rx):
+            self.rx = bytearray()
+            self.rx_pos = 0
+        self.rx += data
+        if self._data:
+            self._data.set()
+
+    def close(self):
+        self.closed = True
+        if self._data:
+            self._data.set()
+
+    def _wrote(self, data):
+        if self.closed:
+            raise OSError(32, "fake broker: connection closed")
+        self.writes.append(len(data))
+        if self.broker.sink:
+            return
+        data = bytes(data)
+        pkts, self.pending = split_packets(self.pending + data)
+        for op, body in pkts:
+            self.broker._handle(self, op, body)
+
+    def _avail(self, n):
+        return min(n, len(self.rx) - self.rx_pos, self.broker.chunk or n)
+
+    # Blocking socket, as used by MQTTClient
+    def connect(self, addr):
+        pass
+
+    def setblocking(self, flag):
+        self.blocking = flag
+
+    def write(self, data, n=None):
+        self._wrote(data[:n] if n is not None else data)
+        return len(data) if n is None else n
+
+    def read(self, n):
+        n = self._avail(n)
+        if not n:
+            if self.closed:
+                return b""
+            if not self.blocking:
+                return None  # what a non-blocking MicroPython socket returns
+            raise OSError(11, "fake broker: read would block forever")
+        self.rx_pos += n
+        return bytes(self.rx[self.rx_pos - n : self.rx_pos])
+
+    # Streams, as used by AsyncMQTTClient
+    async def readinto(self, mv):
+        while self.rx_pos == len(self.rx) and not self.closed:
+            if self._data is None:
+                self._data = asyncio.Event()
+            self._data.clear()
+            await self._data.wait()
+        n = self._avail(len(mv))
+        with memoryview(self.rx) as rx:  # no copy, so benchmarks see the client's allocations
+            mv[:n] = rx[self.rx_pos : self.rx_pos + n]
+        self.rx_pos += n
+        return n
+
+    async def drain(self):
+        if self.closed:
+            raise OSError(32, "fake broker: connection closed")
+
+
+class Stream:
+    """uasyncio.Stream over a Conn: close() does nothing, as on MicroPython."""
+
+    def __init__(self, s, slow):
+        self.s = s
+        self.slow = slow
+        self.draining = False
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        self.s.close()
+
+    def write(self, data):
+        self.s.write(data)
+
+    async def readinto(self, mv):
+        return await self.s.readinto(mv)
+
+    async def drain(self):
+        # uasyncio can't queue two tasks to write one socket; here the
+        # second drain fails instead of waiting behind the first
+        if self.draining:
+            raise OSError(17, "fake broker: concurrent drain")
+        self.draining = True
+        try:
+            if self.slow:
+                await asyncio.sleep(0)
+            await self.s.drain()
+        finally:
+            self.draining = False
+
+
+class FakeBroker:
+    def __init__(self, chunk=None, session_present=False, sink=False, slow_drain=False):
+        self.chunk = chunk  # most bytes returned by one read
+        self.slow_drain = slow_drain  # drains yield, so writers can overlap
+        self.session_present = session_present
+        self.sink = sink  # discard client writes unparsed, for benchmarks
+        self.connack_rc = 0
+        self.connack_props = b""  # MQTT 5 CONNACK properties
+        self.fail_connects = 0  # refuse this many TCP connects
+        self.on_packet = None
+        self.connections = []
+        self.received = []
+        self.messages = []
+
+    @property
+    def conn(self):
+        return self.connections[-1]
+
+    def send(self, data):
+        self.conn.feed(data)
+
+    def drop(self):
+        self.conn.close()
+
+    def _connect(self):
+        if self.fail_connects:
+            self.fail_connects -= 1
+            raise OSError(111, "fake broker: connection refused")
+        c = Conn(self)
+        self.connections.append(c)
+        return c
+
+    @contextlib.contextmanager
+    def patch(self, mqtt):
+        """Point mqtt's socket and asyncio.open_connection at this broker."""
+
+        async def open_connection(host, port, **kw):
+            st = Stream(self._connect(), self.slow_drain)
+            return st, st
+
+        aio = getattr(mqtt, "asyncio", None)  # older versions are blocking only
+        saved = mqtt.socket.socket, mqtt.socket.getaddrinfo, aio and aio.open_connection
+        mqtt.socket.socket = lambda *a: self._connect()
+        mqtt.socket.getaddrinfo = lambda host, port, *a: [(2, 1, 0, "", ("127.0.0.1", port))]
+        if aio:
+            aio.open_connection = open_connection
+        try:
+            yield self
+        finally:
+            mqtt.socket.socket, mqtt.socket.getaddrinfo = saved[:2]
+            if aio:
+                aio.open_connection = saved[2]
+
+    def _handle(self, conn, op, body):
+        self.received.append((op, body))
+        t = op & 0xF0
+        if t == 0x10:
+            conn.v5 = body[6] == 5
+            conn.aliases = {}
+        elif t == 0x30:
+            self._publish(conn, op, body)
+        if self.on_packet and self.on_packet(conn, op, body):
+            return
+        v5 = conn.v5
+        if t == 0x10:
+            if v5:
+                props = encode_len(len(self.connack_props)) + self.connack_props
+                conn.feed(packet(0x20, bytes([self.session_present, self.connack_rc]) + props))
+            else:
+                conn.feed(packet(0x20, bytes([self.session_present, self.connack_rc])))
+        elif t == 0x80:
+            i = 2
+            if v5:
+                n, i = _varint(body, 2)
+                i += n
+            codes = bytearray()
+            while i < len(body):
+                i += 2 + (body[i] << 8 | body[i + 1])
+                codes.append(body[i] & 3)
+                i += 1
+            conn.feed(packet(0x90, body[:2] + (b"\0" if v5 else b"") + codes))
+        elif t == 0xA0:
+            conn.feed(packet(0xB0, body[:2]))
+        elif t == 0x30 and op & 6:
+            tl = body[0] << 8 | body[1]
+            conn.feed(packet(0x40 if op & 6 == 2 else 0x50, body[2 + tl : 4 + tl]))
+        elif t == 0x60:
+            conn.feed(packet(0x70, body[:2]))
+        elif t == 0xC0:
+            conn.feed(b"\xd0\0")
+        elif t == 0xE0:
+            conn.close()
+
+    def _publish(self, conn, op, body):
+        qos = op >> 1 & 3
+        tl = body[0] << 8 | body[1]
+        topic = body[2 : 2 + tl]
+        i = 2 + tl + (2 if qos else 0)
+        if conn.v5:
+            n, i = _varint(body, i)
+            alias = _topic_alias(body[i : i + n])
+            i += n
+            if alias and topic:
+                conn.aliases[alias] = topic
+            elif alias:
+                topic = conn.aliases[alias]
+        self.messages.append((topic, body[i:], qos, bool(op & 1)))
+
+
+class TLSBroker:
+    def __init__(self, broker, certfile):
+        self.broker = broker
+        self.ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.ctx.load_cert_chain(certfile)
+        self.sock = socket.create_server(("127.0.0.1", 0))
+        self.port = self.sock.getsockname()[1]
+        self.failed = 0  # handshakes that didn't complete
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def close(self):
+        self.sock.close()
+
+    def _accept(self):
+        while True:
+            try:
+                raw, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(raw,), daemon=True).start()
+
+    def _serve(self, raw):
+        try:
+            s = self.ctx.wrap_socket(raw, server_side=True)
+        except (OSError, ssl.SSLError):
+            self.failed += 1
+            raw.close()
+            return
+        conn = self.broker._connect()
+        with s:
+            while not conn.closed:
+                try:
+                    data = s.recv(4096)
+                except OSError:
+                    break
+                if not data:
+                    break
+                conn._wrote(data)
+                if conn.rx_pos < len(conn.rx):
+                    s.sendall(conn.rx[conn.rx_pos :])
+                    conn.rx_pos = len(conn.rx)
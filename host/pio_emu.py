@@ -0,0 +1,574 @@
+# pio_emu.py
+# Cycle-level emulator for the subset of rp2 PIO used by the rp2040 firmware,
+# plus a model of a chained 74HC595 hanging off the GPIO pins.
+#
+# Supported: pull/push (ifempty/iffull, block/noblock), out, in_, set, mov
+# between x/y/isr/osr/null, irq (set, clear, rel), nop, jmp (always, not_x,
+# x_dec, not_y, y_dec, x_not_y, not_osre), side-set, delays and
+# wrap_target/wrap. Anything else raises NotImplementedError, so a firmware
+# change that needs more of the instruction set fails loudly instead of
+# emulating the wrong thing.
+
+from collections import deque
+
+SHIFT_LEFT = 0
+SHIFT_RIGHT = 1
+JOIN_NONE = 0
+JOIN_TX = 1
+JOIN_RX = 2
+
+MAX_CYCLES = 10000000  # guard against programs that never stall
+SETTLE_CYCLES = 4096  # budget per active()/put(), enough to drain a full TX FIFO
+
+
+class GPIO:
+    """Pin levels shared by Pin objects, state machines and attached devices."""
+
+    def __init__(self):
+        self.levels = {}
+        self.listeners = []
+
+    def level(self, pin):
+        return self.levels.get(pin, 0)
+
+    def write(self, changes, t=None):
+        # All changes of one cycle are applied together, then listeners see
+        # every pin that moved as (old, new), so simultaneous edges are visible.
+        moved = {}
+        for pin, v in changes.items():
+            old = self.levels.get(pin, 0)
+            if old != v:
+                moved[pin] = (old, v)
+                self.levels[pin] = v
+        if moved:
+            for f in self.listeners:
+                f(moved, t)
+
+
+# ---------- Assembler ----------
+class Instr:
+    def __init__(self, op, *args):
+        self.op = op
+        self.args = args
+        self.sideset = None
+        self.delay = 0
+
+    def side(self, value):
+        self.sideset = value
+        return self
+
+    def __getitem__(self, delay):
+        self.delay = delay
+        return self
+
+    def __repr__(self):
+        s = "%s(%s)" % (self.op, ", ".join(str(a) for a in self.args))
+        if self.sideset is not None:
+            s += ".side(%d)" % self.sideset
+        if self.delay:
+            s += "[%d]" % self.delay
+        return s
+
+
+class Program:
+    def __init__(self, name, instrs, labels, wrap_target, wrap, config):
+        self.name = name
+        self.instrs = instrs
+        self.labels = labels
+        self.wrap_target = wrap_target
+        self.wrap = wrap
+        self.config = config
+
+    def __len__(self):
+        return len(self.instrs)
+
+
+# Operand tokens injected into the program's globals while it is assembled
+TOKENS = (
+    "pins",
+    "x",
+    "y",
+    "null",
+    "isr",
+    "osr",
+    "ifempty",
+    "iffull",
+    "block",
+    "noblock",
+    "clear",
+    "not_x",
+    "x_dec",
+    "not_y",
+    "y_dec",
+    "x_not_y",
+    "not_osre",
+    "pin",
+    "gpio",
+)
+SUPPORTED = ("nop", "jmp", "out", "pull", "in_", "push", "mov", "set", "irq")
+
+
+def rel(index):
+    return ("rel", index)
+
+
+def _count(init):
+    if init is None:
+        return 0
+    return len(init) if isinstance(init, tuple) else 1
+
+
+def assemble(f, **config):
+    """Run a @rp2.asm_pio style function and return the Program it describes."""
+    instrs = []
+    labels = {}
+    marks = {"wrap_target": 0, "wrap": None}
+
+    def emit(op):
+        def _emit(*args):
+            if op not in SUPPORTED:
+                raise NotImplementedError("PIO instruction %s() is not emulated" % op)
+            i = Instr(op, *args)
+            instrs.append(i)
+            return i
+
+        return _emit
+
+    def label(name):
+        labels[name] = len(instrs)
+
+    def wrap_target():
+        marks["wrap_target"] = len(instrs)
+
+    def wrap():
+        marks["wrap"] = len(instrs) - 1
+
+    names = {t: t for t in TOKENS}
+    for op in ("nop", "jmp", "out", "pull", "in_", "push", "mov", "set", "irq", "wait"):
+        names[op] = emit(op)
+    names.update(label=label, wrap_target=wrap_target, wrap=wrap, rel=rel)
+
+    g = f.__globals__
+    saved = {k: g[k] for k in names if k in g}
+    g.update(names)
+    try:
+        f()
+    finally:
+        for k in names:
+            if k in saved:
+                g[k] = saved[k]
+            else:
+                del g[k]
+
+    if config.get("autopull") or config.get("autopush"):
+        raise NotImplementedError("autopull/autopush are not emulated")
+    if len(instrs) > 32:
+        raise ValueError("program too long: %d instructions" % len(instrs))
+    sideset_count = _count(config.get("sideset_init"))
+    max_delay = (1 << (5 - sideset_count)) - 1
+    for i in instrs:
+        if i.delay > max_delay:
+            raise ValueError("delay %d too large with %d side-set pins: %r" % (i.delay, sideset_count, i))
+        if i.sideset is not None and i.sideset >> sideset_count:
+            raise ValueError("side-set value out of range: %r" % i)
+        if i.op == "jmp":
+            target = i.args[-1]
+            if isinstance(target, str) and target not in labels:
+                raise ValueError("unknown label %r" % target)
+
+    wrap_at = marks["wrap"] if marks["wrap"] is not None else len(instrs) - 1
+    return Program(f.__name__, instrs, labels, marks["wrap_target"], wrap_at, config)
+
+
+# ---------- State machine ----------
+class StateMachine:
+    def __init__(self, prog, freq, gpio, out_base=None, sideset_base=None, in_base=None, set_base=None):
+        cfg = prog.config
+        self.prog = prog
+        self.freq = freq
+        self.gpio = gpio
+        self.out_base = out_base
+        self.out_count = _count(cfg.get("out_init"))
+        self.set_base = set_base
+        self.set_count = _count(cfg.get("set_init"))
+        self.in_base = in_base
+        self.sideset_base = sideset_base
+        self.sideset_count = _count(cfg.get("sideset_init"))
+        self.out_shiftdir = cfg.get("out_shiftdir", SHIFT_LEFT)
+        self.in_shiftdir = cfg.get("in_shiftdir", SHIFT_LEFT)
+        self.pull_thresh = cfg.get("pull_thresh", 32) or 32
+        self.push_thresh = cfg.get("push_thresh", 32) or 32
+        join = cfg.get("fifo_join", JOIN_NONE)
+        self.tx = deque()
+        self.tx_depth = 8 if join == JOIN_TX else 0 if join == JOIN_RX else 4
+        self.rx = deque()
+        self.rx_depth = 8 if join == JOIN_RX else 0 if join == JOIN_TX else 4
+        self.irq_handler = None
+        self.irq_flags = 0
+        self.sm_index = 0  # index within its PIO block, for rel() irqs
+        self.enabled = False
+        self.stalled = False
+        self.restart()
+
+        # Initial pin levels from out_init / set_init / sideset_init
+        init = {}
+        for base, values in (
+            (out_base, cfg.get("out_init")),
+            (set_base, cfg.get("set_init")),
+            (sideset_base, cfg.get("sideset_init")),
+        ):
+            if base is None or values is None:
+                continue
+            if not isinstance(values, tuple):
+                values = (values,)
+            for n, v in enumerate(values):
+                init[base + n] = 1 if v in (1, 3) else 0  # PIO.OUT_HIGH / IN_HIGH
+        gpio.write(init)
+
+    def restart(self):
+        self.pc = self.prog.wrap_target if self.prog.instrs else 0
+        self.x = 0
+        self.y = 0
+        self.osr = 0
+        self.osr_count = 32  # OSR starts empty
+        self.isr = 0
+        self.isr_count = 0
+        self.cycles = 0
+        self.busy_cycles = 0
+        self.pulls = 0
+        self.frame_cycles = None  # busy cycles between the last two pulls
+        self._since_pull = 0
+
+    def active(self, value=None):
+        if value is None:
+            return self.enabled
+        self.enabled = bool(value)
+        if self.enabled:
+            self.advance(SETTLE_CYCLES)
+
+    def tx_fifo(self):
+        return len(self.tx)
+
+    def rx_fifo(self):
+        return len(self.rx)
+
+    def get(self):
+        # An empty FIFO blocks the caller on hardware; here the SM runs until it fills
+        for _ in range(MAX_CYCLES):
+            if self.rx:
+                v = self.rx.popleft()
+                if self.enabled and self.stalled:
+                    self.step()  # a push stalled on a full FIFO can now complete
+                return v
+            if not self.enabled or (self.step() and not self.rx):
+                raise RuntimeError("get() would block forever: nothing to push")
+        raise RuntimeError("state machine did not push within %d cycles" % MAX_CYCLES)
+
+    def put(self, value):
+        # A full FIFO blocks the caller on hardware; here the SM runs until it drains
+        while len(self.tx) >= self.tx_depth:
+            if not self.enabled:
+                raise RuntimeError("put() would block forever: state machine inactive")
+            self.step()
+        self.tx.append(value & 0xFFFFFFFF)
+        if self.enabled:
+            # Free-running programs never stall, so this is bounded; the rest
+            # of their time comes from advance() / rp2.advance()
+            self.advance(SETTLE_CYCLES)
+
+    def run(self, cycles):
+        """Execute for `cycles` clock cycles, stalled or not."""
+        end = self.cycles + cycles
+        while self.cycles < end:
+            self.step()
+
+    def advance(self, cycles):
+        """Let a free-running SM execute for up to `cycles` clock cycles.
+        Stops early once it stalls, since nothing changes until the host acts."""
+        end = self.cycles + cycles
+        while self.enabled and self.cycles < end:
+            if self.step():
+                return
+
+    def run_until_stall(self):
+        for _ in range(MAX_CYCLES):
+            if self.step():
+                return
+        raise RuntimeError("state machine did not stall within %d cycles" % MAX_CYCLES)
+
+    @property
+    def fps(self):
+        """Frames per second the program sustains when fed back to back."""
+        if not self.frame_cycles:
+            return None
+        return self.freq / self.frame_cycles
+
+    def _target(self, arg):
+        return self.prog.labels[arg] if isinstance(arg, str) else arg
+
+    def _read(self, src):
+        if src == "x":
+            return self.x
+        if src == "y":
+            return self.y
+        if src == "isr":
+            return self.isr
+        if src == "osr":
+            return self.osr
+        if src == "null":
+            return 0
+        raise NotImplementedError("mov(..., %s) is not emulated" % src)
+
+    def _in_data(self, bits, n):
+        if n == 32:
+            self.isr = bits
+        elif self.in_shiftdir == SHIFT_LEFT:
+            self.isr = ((self.isr << n) | bits) & 0xFFFFFFFF
+        else:
+            self.isr = (self.isr >> n) | (bits << (32 - n))
+        self.isr_count = min(self.isr_count + n, 32)
+
+    def _out_data(self, n):
+        mask = (1 << n) - 1
+        if self.out_shiftdir == SHIFT_LEFT:
+            data = (self.osr >> (32 - n)) & mask
+            self.osr = (self.osr << n) & 0xFFFFFFFF
+        else:
+            data = self.osr & mask
+            self.osr >>= n
+        self.osr_count = min(self.osr_count + n, 32)
+        return data
+
+    def step(self):
+        """Execute one cycle. Returns True if the SM is stalled."""
+        ins = self.prog.instrs[self.pc]
+        pins = {}
+        stalled = False
+        jump = None
+
+        if ins.op == "pull":
+            if "ifempty" in ins.args and self.osr_count < self.pull_thresh:
+                pass
+            elif self.tx:
+                self.osr = self.tx.popleft()
+                self.osr_count = 0
+                if self.pulls:
+                    self.frame_cycles = self._since_pull
+                self.pulls += 1
+                self._since_pull = 0
+            elif "noblock" in ins.args:
+                self.osr = self.x
+                self.osr_count = 0
+            else:
+                stalled = True
+        elif ins.op == "out":
+            dest, n = ins.args
+            n = n or 32
+            data = self._out_data(n)
+            if dest == "pins":
+                for b in range(min(n, self.out_count)):
+                    pins[self.out_base + b] = (data >> b) & 1
+            elif dest == "x":
+                self.x = data
+            elif dest == "y":
+                self.y = data
+            elif dest != "null":
+                raise NotImplementedError("out(%s, ...) is not emulated" % dest)
+        elif ins.op == "push":
+            if "iffull" in ins.args and self.isr_count < self.push_thresh:
+                pass
+            elif len(self.rx) < self.rx_depth:
+                self.rx.append(self.isr)
+                self.isr = 0
+                self.isr_count = 0
+            elif "noblock" in ins.args:
+                self.isr = 0
+                self.isr_count = 0
+            else:
+                stalled = True
+        elif ins.op == "in_":
+            src, n = ins.args
+            n = n or 32
+            if src == "pins":
+                bits = 0
+                for b in range(n):
+                    bits |= self.gpio.level(self.in_base + b) << b
+            else:
+                bits = self._read(src) & ((1 << n) - 1)
+            self._in_data(bits, n)
+        elif ins.op == "set":
+            dest, v = ins.args
+            if dest == "x":
+                self.x = v
+            elif dest == "y":
+                self.y = v
+            elif dest == "pins":
+                for b in range(self.set_count):
+                    pins[self.set_base + b] = (v >> b) & 1
+            else:
+                raise NotImplementedError("set(%s, ...) is not emulated" % dest)
+        elif ins.op == "mov":
+            dest, src = ins.args
+            v = self._read(src)
+            if dest == "x":
+                self.x = v
+            elif dest == "y":
+                self.y = v
+            elif dest == "isr":
+                self.isr = v
+                self.isr_count = 0
+            elif dest == "osr":
+                self.osr = v
+                self.osr_count = 0
+            else:
+                raise NotImplementedError("mov(%s, ...) is not emulated" % dest)
+        elif ins.op == "irq":
+            args = list(ins.args)
+            clr = "clear" in args
+            for a in ("clear", "noblock", "block"):
+                if a in args:
+                    if a == "block":
+                        raise NotImplementedError("irq(block, ...) is not emulated")
+                    args.remove(a)
+            index = args[0]
+            if isinstance(index, tuple):  # rel(n)
+                index = (index[1] + self.sm_index) & 3 | index[1] & 4
+            if clr:
+                self.irq_flags &= ~(1 << index)
+            else:
+                self.irq_flags |= 1 << index
+                if self.irq_handler:
+                    self.irq_handler()
+        elif ins.op == "jmp":
+            if len(ins.args) == 1:
+                jump = self._target(ins.args[0])
+            else:
+                cond, target = ins.args
+                if cond == "not_x":
+                    taken = not self.x
+                elif cond == "x_dec":
+                    taken = self.x != 0
+                    self.x = (self.x - 1) & 0xFFFFFFFF
+                elif cond == "not_y":
+                    taken = not self.y
+                elif cond == "y_dec":
+                    taken = self.y != 0
+                    self.y = (self.y - 1) & 0xFFFFFFFF
+                elif cond == "x_not_y":
+                    taken = self.x != self.y
+                elif cond == "not_osre":
+                    taken = self.osr_count < self.pull_thresh
+                else:
+                    raise NotImplementedError("jmp(%s, ...) is not emulated" % cond)
+                if taken:
+                    jump = self._target(target)
+
+        # Side-set is not optional in MicroPython's assembler: every
+        # instruction drives the side-set pins, 0 unless .side() says otherwise.
+        if self.sideset_count:
+            v = ins.sideset or 0
+            for b in range(self.sideset_count):
+                pins[self.sideset_base + b] = (v >> b) & 1
+
+        self.gpio.write(pins, self.cycles)
+        self.cycles += 1
+        self.stalled = stalled
+        if stalled:
+            return True
+
+        self.cycles += ins.delay
+        self.busy_cycles += 1 + ins.delay
+        self._since_pull += 1 + ins.delay
+        if jump is not None:
+            self.pc = jump
+        elif self.pc == self.prog.wrap:
+            self.pc = self.prog.wrap_target
+        else:
+            self.pc += 1
+        return False
+
+
+# ---------- Devices ----------
+class HC595Chain:
+    """Chained 74HC595 shift registers. Output 0 is QA of the first chip."""
+
+    def __init__(self, gpio, data, clock, latch, oe=None, chips=4):
+        self.gpio = gpio
+        self.data = data
+        self.clock = clock
+        self.latch = latch
+        self.oe = oe
+        self.bits = chips * 8
+        self.mask = (1 << self.bits) - 1
+        self.shift = 0
+        self.storage = 0
+        self.frames = 0
+        self.unchanged = 0  # frames that latched the value already shown
+        self.clocks_per_frame = None
+        self.latched = []  # (SM cycle or None, value)
+        self._clocks = 0
+        gpio.listeners.append(self._edge)
+
+    @property
+    def enabled(self):
+        return self.oe is None or not self.gpio.level(self.oe)
+
+    @property
+    def outputs(self):
+        """Value on the output pins, or None while OE is high (outputs off)."""
+        return self.storage if self.enabled else None
+
+    def _edge(self, moved, t):
+        # With both clocks rising together the storage register captures the
+        # shift register as it was before the shift (datasheet: the shift
+        # register is always one clock ahead of storage in that case).
+        if moved.get(self.latch) == (0, 1):
+            if self.frames and self.shift == self.storage:
+                self.unchanged += 1
+            self.storage = self.shift
+            self.frames += 1
+            self.clocks_per_frame = self._clocks
+            self._clocks = 0
+            self.latched.append((t, self.storage))
+        if moved.get(self.clock) == (0, 1):
+            self.shift = ((self.shift << 1) | self.gpio.level(self.data)) & self.mask
+            self._clocks += 1
+
+
+class HC165Chain:
+    """Chained 74HC165 parallel-in shift registers. QH of the chip wired to
+    the Pico is bit 31 of `inputs`, input A of the last chip is bit 0."""
+
+    def __init__(self, gpio, data, clock, load, chips=4):
+        self.gpio = gpio
+        self.data = data
+        self.clock = clock
+        self.load = load
+        self.bits = chips * 8
+        self.mask = (1 << self.bits) - 1
+        self.inputs = 0
+        self.reg = 0
+        self.loads = 0
+        gpio.listeners.append(self._edge)
+        self._load()
+
+    def set(self, inputs):
+        """Change the levels on the parallel inputs."""
+        self.inputs = inputs & self.mask
+        if not self.gpio.level(self.load):
+            self._load()
+
+    def _load(self):
+        self.reg = self.inputs
+        self._qh()
+
+    def _qh(self):
+        self.gpio.write({self.data: (self.reg >> (self.bits - 1)) & 1})
+
+    def _edge(self, moved, t):
+        if moved.get(self.load) == (1, 0):
+            self.loads += 1
+            self._load()
+        elif moved.get(self.clock) == (0, 1) and self.gpio.level(self.load):
+            self.reg = (self.reg << 1) & self.mask  # SER of the last chip tied low
+            self._qh()
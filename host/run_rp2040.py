@@ -0,0 +1,137 @@
+# run_rp2040.py
+# Run the real rp2040/main.py against the PIO emulator, with a 74HC595 chain
+# on the outputs and a 74HC165 chain on the inputs, and report latched
+# states, PIO cycles per frame and achievable frames per second.
+#
+#   python host/run_rp2040.py [seconds]
+#
+# Network services are not emulated: the NTP client and UDP control listener
+# are disabled and the HTTP server is not started, everything else in main.py
+# runs unmodified.
+
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+import upy
+
+upy.install("rp2040")
+
+import asyncio
+import machine
+import rp2
+import pio_emu
+import ntp
+import udpctl
+
+MAIN = os.path.join(upy.ROOT, "rp2040", "main.py")
+
+
+class _Done(Exception):
+    pass
+
+
+async def _ntp_sync(self):
+    return False
+
+
+async def _ntp_run(self):
+    while True:
+        await asyncio.sleep(3600)
+
+
+async def _no_server(*args, **kw):
+    return None
+
+
+async def _no_udp(self, local_ip=None):
+    while True:
+        await asyncio.sleep(3600)
+
+
+async def _pio_clock(max_cycles=5000):
+    # Free-running state machines advance with host time, capped per slice
+    # so a fast PIO clock slows the emulation down instead of blocking it
+    t0 = time.monotonic()
+    while True:
+        await asyncio.sleep(0.005)
+        t1 = time.monotonic()
+        for sm in rp2.StateMachine.machines.values():
+            if sm.emu is not None:
+                sm.emu.advance(min(int((t1 - t0) * sm.emu.freq), max_cycles))
+        t0 = t1
+
+
+def run(seconds=3.0, script=None):
+    """Run main.py for `seconds`. `script(ns, dev)` is an optional coroutine
+    run alongside the firmware tasks. Returns (main globals, devices) where
+    devices.hc595 and devices.hc165 are the emulated chains."""
+    # No network on the host: NTP, UDP control and the web server are stubbed out for the run
+    saved = (ntp.NTPClient.sync, ntp.NTPClient.run, asyncio.start_server, udpctl.UdpControl.run)
+    ntp.NTPClient.sync = _ntp_sync
+    ntp.NTPClient.run = _ntp_run
+    asyncio.start_server = _no_server
+    udpctl.UdpControl.run = _no_udp
+    machine.GPIO.listeners.clear()
+    machine.GPIO.levels.clear()
+    rp2.StateMachine.machines.clear()
+    dev = SimpleNamespace(
+        hc595=pio_emu.HC595Chain(machine.GPIO, data=10, clock=11, latch=12, oe=13, chips=4),
+        hc165=pio_emu.HC165Chain(machine.GPIO, data=6, clock=8, load=7, chips=4),
+    )
+
+    ns = {"__name__": "__main__", "__file__": MAIN}
+
+    def run_forever():
+        loop = asyncio.get_event_loop()
+        del loop.run_forever
+        loop.create_task(_pio_clock())
+        if script:
+            loop.create_task(script(ns, dev))
+        loop.call_later(seconds, loop.stop)
+        loop.run_forever()
+        tasks = asyncio.all_tasks(loop)
+        for t in tasks:
+            t.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        loop.close()
+        raise _Done
+
+    _get_loop = asyncio.get_event_loop
+
+    def get_event_loop():
+        loop = _get_loop()
+        loop.run_forever = run_forever
+        return loop
+
+    asyncio.get_event_loop = get_event_loop
+    try:
+        with open(MAIN) as f:
+            code = compile(f.read(), MAIN, "exec")
+        exec(code, ns)
+    except _Done:
+        pass
+    finally:
+        asyncio.get_event_loop = _get_loop
+        ntp.NTPClient.sync, ntp.NTPClient.run, asyncio.start_server, udpctl.UdpControl.run = saved
+    return ns, dev
+
+
+def report(ns, dev, seconds):
+    sm = ns["sm0"].emu
+    chain = dev.hc595
+    print("rp2040/main.py on the PIO emulator, %.1f s" % seconds)
+    print("  sm0: %d Hz, %s cycles/frame -> %.1f frames/s max" % (sm.freq, sm.frame_cycles, sm.fps or 0))
+    print("  puts: %d, frames latched: %d (%d unchanged)" % (sm.pulls, chain.frames, chain.unchanged))
+    print("  shift clocks/frame: %s" % chain.clocks_per_frame)
+    out = chain.outputs
+    print("  outputs: %s" % ("off (OE high)" if out is None else "0x%08X" % out))
+    sm = ns["sm1"].emu
+    print("  sm1: %d Hz, %d input loads, inputs: 0x%08X" % (sm.freq, dev.hc165.loads, ns["inputs"]))
+
+
+if __name__ == "__main__":
+    secs = float(sys.argv[1]) if len(sys.argv) > 1 else 3.0
+    ns, dev = run(secs)
+    report(ns, dev, secs)
@@ -0,0 +1,100 @@
+# Host stand-in for the MicroPython machine module.
+# Pin levels live in GPIO, shared with the PIO emulator and attached devices.
+
+import time
+
+from pio_emu import GPIO as _GPIO
+
+GPIO = _GPIO()
+
+
+class Reset(SystemExit):
+    pass
+
+
+class Pin:
+    IN = 0
+    OUT = 1
+    OPEN_DRAIN = 2
+    PULL_UP = 1
+    PULL_DOWN = 2
+
+    def __init__(self, id, mode=-1, pull=-1, value=None):
+        self.id = id
+        self.mode = mode
+        self.pull = pull
+        if value is not None:
+            self.value(value)
+        elif pull == Pin.PULL_UP and mode == Pin.IN:
+            GPIO.write({id: 1})
+
+    def value(self, v=None):
+        if v is None:
+            return GPIO.level(self.id)
+        GPIO.write({self.id: 1 if v else 0})
+
+    def __call__(self, v=None):
+        return self.value(v)
+
+    def on(self):
+        self.value(1)
+
+    def off(self):
+        self.value(0)
+
+    high = on
+    low = off
+
+    def toggle(self):
+        self.value(not self.value())
+
+
+class RTC:
+    _dt = (2000, 1, 1, 5, 0, 0, 0, 0)
+
+    def datetime(self, dt=None):
+        if dt is None:
+            return RTC._dt
+        RTC._dt = tuple(dt)
+
+
+PWRON_RESET = 1
+HARD_RESET = 2
+WDT_RESET = 3
+DEEPSLEEP_RESET = 4
+SOFT_RESET = 5
+
+
+def reset():
+    raise Reset("machine.reset()")
+
+
+def reset_cause():
+    return PWRON_RESET
+
+
+class WDT:
+    # Never fires here; feeds are counted
+    def __init__(self, id=0, timeout=5000):
+        self.timeout = timeout
+        self.feeds = 0
+
+    def feed(self):
+        self.feeds += 1
+
+
+def freq(hz=None):
+    return 125000000
+
+
+def unique_id():
+    return b"\xe6\x61\x38\x02\x03\x41\x2b\x2a"
+
+
+def idle():
+    time.sleep(0)
+
+
+def lightsleep(ms=None):
+    # Timers and sockets stop on the board; here the whole process does
+    time.sleep((ms or 0) / 1000)
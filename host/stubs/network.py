@@ -0,0 +1,67 @@
+# Host stand-in for the MicroPython network module.
+# WLAN reports an established connection unless connect() was refused:
+# set .refuse to SSIDs and BSSIDs that won't connect, .networks to what
+# scan() finds. connect() calls are logged in .connects; without a bssid
+# it joins the strongest of .networks, which config("bssid") then reports.
+
+STA_IF = 0
+AP_IF = 1
+
+STAT_IDLE = 0
+STAT_CONNECTING = 1
+STAT_GOT_IP = 3
+
+
+class WLAN:
+    PM_NONE = 0
+    PM_PERFORMANCE = 1
+    PM_POWERSAVE = 2
+
+    def __init__(self, interface=STA_IF):
+        self.interface = interface
+        self._active = False
+        self._ifconfig = ("192.168.1.50", "255.255.255.0", "192.168.1.1", "192.168.1.1")
+        self._up = True
+        self.refuse = set()
+        self.networks = []  # (ssid, bssid, channel, RSSI, security, hidden)
+        self.connects = []  # (ssid, bssid)
+        self._ap = (None, None)  # (bssid, channel) joined
+
+    def active(self, v=None):
+        if v is None:
+            return self._active
+        self._active = bool(v)
+
+    def connect(self, ssid=None, key=None, bssid=None, **kw):
+        self.connects.append((ssid, bssid))
+        self._up = ssid not in self.refuse and bssid not in self.refuse
+        aps = [n for n in self.networks if n[0] == ssid.encode() and n[1] not in self.refuse]
+        aps = [n for n in aps if bssid in (None, n[1])]
+        self._ap = max(aps, key=lambda n: n[3])[1:3] if self._up and aps else (None, None)
+
+    def disconnect(self):
+        self._up = False
+
+    def status(self, param=None):
+        if param == "rssi":
+            return -55
+        return STAT_GOT_IP if self._up else STAT_CONNECTING
+
+    def isconnected(self):
+        return self._up
+
+    def scan(self):
+        return list(self.networks)
+
+    def ifconfig(self, cfg=None):
+        if cfg is None:
+            return self._ifconfig
+        if cfg != "dhcp":
+            self._ifconfig = tuple(cfg)
+
+    def config(self, *args, **kw):
+        if args == ("bssid",):
+            return self._ap[0]
+        if args == ("channel",):
+            return self._ap[1]
+        return None
@@ -0,0 +1,88 @@
+# Host stand-in for the MicroPython rp2 module, backed by pio_emu.
+
+import pio_emu
+from machine import GPIO
+
+
+class PIO:
+    IN_LOW = 0
+    IN_HIGH = 1
+    OUT_LOW = 2
+    OUT_HIGH = 3
+    SHIFT_LEFT = pio_emu.SHIFT_LEFT
+    SHIFT_RIGHT = pio_emu.SHIFT_RIGHT
+    JOIN_NONE = pio_emu.JOIN_NONE
+    JOIN_TX = pio_emu.JOIN_TX
+    JOIN_RX = pio_emu.JOIN_RX
+
+
+def asm_pio(**config):
+    def _asm(f):
+        return pio_emu.assemble(f, **config)
+
+    return _asm
+
+
+def _pin(p):
+    return p if p is None or isinstance(p, int) else p.id
+
+
+class StateMachine:
+    machines = {}  # id -> StateMachine, for test harnesses
+
+    def __init__(self, id, prog=None, freq=-1, **kw):
+        self.id = id
+        self.emu = None
+        if prog is not None:
+            self.init(prog, freq, **kw)
+        StateMachine.machines[id] = self
+
+    def init(self, prog, freq=-1, out_base=None, sideset_base=None, in_base=None, set_base=None, **kw):
+        for k, v in kw.items():
+            if v is not None:
+                raise NotImplementedError("StateMachine(%s=...) is not emulated" % k)
+        if freq <= 0:
+            freq = 125000000
+        if not 1908 <= freq <= 125000000:
+            raise ValueError("freq out of range")
+        self.emu = pio_emu.StateMachine(
+            prog,
+            freq,
+            GPIO,
+            out_base=_pin(out_base),
+            sideset_base=_pin(sideset_base),
+            in_base=_pin(in_base),
+            set_base=_pin(set_base),
+        )
+        self.emu.sm_index = self.id & 3
+
+    def active(self, value=None):
+        return self.emu.active(value)
+
+    def restart(self):
+        self.emu.restart()
+
+    def put(self, value, shift=0):
+        self.emu.put(value << shift)
+
+    def tx_fifo(self):
+        return self.emu.tx_fifo()
+
+    def rx_fifo(self):
+        return self.emu.rx_fifo()
+
+    def get(self, buf=None, shift=0):
+        if buf is not None:
+            raise NotImplementedError("get(buf) is not emulated")
+        return self.emu.get() >> shift
+
+    def irq(self, handler=None, trigger=0, hard=False):
+        # Called as handler(sm) whenever the program executes irq()
+        self.emu.irq_handler = None if handler is None else lambda: handler(self)
+
+
+def advance(seconds):
+    """Run every active state machine for `seconds` of PIO time."""
+    for sm in StateMachine.machines.values():
+        if sm.emu is not None:
+            sm.emu.advance(int(seconds * sm.emu.freq))
@@ -0,0 +1,3 @@
+# Host stand-in for the MicroPython usocket module.
+
+from socket import *  # noqa: F401,F403
@@ -0,0 +1,79 @@
+import upy
+
+upy.install()
+
+import asyncio
+
+import pytest
+
+from commands import CommandQueue
+
+FIELDS = ("enabled", "on", "profile")
+
+
+def _queue(maxlen=8):
+    got = []
+    return CommandQueue(FIELDS, lambda mask, values: got.append((mask, values)), maxlen), got
+
+
+@pytest.mark.parametrize(
+    "msg, mask, values, scanned",
+    [
+        (b'{"on": true}', 0b010, 0b010, True),
+        (b' { "enabled" : 1 ,"on":false } ', 0b011, 0b001, True),
+        (b'{"on": 0, "on": 1}', 0b010, 0b010, True),
+        (b"{}", 0, 0, True),
+        (b'{"o\\u006e": true}', 0b010, 0b010, False),  # escaped, json.loads
+        (b'{"profile":true}', 0b100, 0b100, True),
+    ],
+)
+def test_valid(msg, mask, values, scanned):
+    q, _ = _queue()
+    assert q.push(memoryview(msg))
+    assert (q._mask, q._value, q.scanned) == (mask, values, int(scanned))
+
+
+@pytest.mark.parametrize(
+    "msg",
+    [b'{"bogus": true}', b'{"on": 2}', b'{"on": "yes"}', b'{"on": null}', b"[1]", b"not json", b'{"on": true', b'{"on": {}}'],
+)
+def test_invalid(msg):
+    q, _ = _queue()
+    assert not q.push(msg) and q.invalid == 1 and not len(q)
+
+
+def test_burst_is_one_update():
+    q, got = _queue(maxlen=2)
+
+    async def main():
+        task = asyncio.create_task(q.run())
+        q.push(b'{"on": true}')
+        q.push(b'{"enabled": true}')
+        q.push(b'{"on": false}')  # full, folded into the last one
+        q.push(b'{"profile": true}')
+        await asyncio.sleep(0.01)
+        q.push(b'{"enabled": false}')
+        await asyncio.sleep(0.01)
+        task.cancel()
+
+    asyncio.run(main())
+    assert got == [(0b111, 0b101), (0b001, 0b000)]
+    assert q.folded == 2 and q.batches == 2 and q.max_queued == 2
+
+
+@pytest.mark.parametrize(
+    "msg, mask, values",
+    [
+        (b'{"set": 5, "clear": 2}', 0b111, 0b101),
+        (b'{"clear": 7, "on": true}', 0b111, 0b010),
+        (b'{"set": 4, "clear": 4}', 0b100, 0b000),  # the later one wins
+    ],
+)
+def test_masks(msg, mask, values):
+    q = CommandQueue(FIELDS, None, masks=True)
+    escaped = msg.replace(b'"set"', b'"s\\u0065t"').replace(b'"clear"', b'"cl\\u0065ar"')  # json.loads
+    for m in (msg, escaped):
+        assert q.push(m)
+        assert (q._mask, q._value) == (mask, values)
+    assert not q.push(b'{"set": 8}') and not q.push(b'{"set": true}')
+    assert not CommandQueue(FIELDS, None).push(b'{"set": 1}')  # masks off
@@ -0,0 +1,407 @@
+import upy
+
+upy.install("esp32-s2")
+
+import asyncio
+
+import pytest
+
+import mqtt
+from fake_broker import FakeBroker, packet, publish
+
+
+def _run(broker, f, **kw):
+    # Run f(client) on a fresh loop with an AsyncMQTTClient connected to broker
+    async def main():
+        c = mqtt.AsyncMQTTClient(b"dev", "broker", **kw)
+        return await f(c)
+
+    with broker.patch(mqtt):
+        return asyncio.run(main())
+
+
+async def _until(cond, ms=1000):
+    for _ in range(ms // 5):
+        if cond():
+            return
+        await asyncio.sleep(0.005)
+    raise AssertionError("timed out")
+
+
+def _keep(c, **kw):
+    return asyncio.create_task(c.keep_connected(min_backoff_ms=5, max_backoff_ms=10, **kw))
+
+
+@pytest.mark.parametrize(
+    "n, header",
+    [
+        (0, b"\x00"),
+        (127, b"\x7f"),
+        (128, b"\x80\x01"),
+        (16383, b"\xff\x7f"),
+        (16384, b"\x80\x80\x01"),
+        (2097151, b"\xff\xff\x7f"),
+        (2097152, b"\x80\x80\x80\x01"),
+    ],
+)
+def test_remaining_length_encoding(n, header):
+    c = mqtt.MQTTClient(b"dev", "broker")
+    i = c._begin(0x30, n)
+    assert bytes(c._obuf[1:i]) == header
+
+
+def test_publish_sizes_round_trip():
+    broker = FakeBroker()
+    sizes = [0, 1, 120, 121, 122, 16380, 20000]
+
+    async def f(c):
+        await c.connect()
+        for n in sizes:
+            await c.publish(b"t", bytes(n % 251 for n in range(n)))
+
+    _run(broker, f)
+    assert [len(m[1]) for m in broker.messages] == sizes
+    assert broker.messages[-1][1] == bytes(n % 251 for n in range(20000))
+
+
+@pytest.mark.parametrize("chunk", [1, 3, None])
+def test_fragmented_and_coalesced_reads(chunk):
+    broker = FakeBroker(chunk=chunk)
+    got = []
+    big = bytes(range(256)) * 3
+
+    async def f(c):
+        await c.subscribe(b"a/#", handler=lambda t, m: got.append((bytes(t), bytes(m))))
+        task = _keep(c)
+        await c.wait_connected()
+        # Two packets in one write, the second one larger than the receive buffer
+        broker.send(publish(b"a/1", b"x") + publish(b"a/2", big))
+        await _until(lambda: len(got) == 2)
+        task.cancel()
+
+    _run(broker, f, rx_size=64)
+    assert got == [(b"a/1", b"x"), (b"a/2", big)]
+
+
+def test_pingresp_between_publish_and_puback():
+    broker = FakeBroker()
+
+    def on_packet(conn, op, body):
+        if op == 0x32:  # answer a ping first, then the publish
+            conn.feed(b"\xd0\0" + packet(0x40, body[3:5]))
+            return True
+
+    broker.on_packet = on_packet
+
+    async def f(c):
+        task = _keep(c)
+        await c.wait_connected()
+        c._ping_sent()
+        pid = await c.publish(b"t", b"m", qos=1)
+        await asyncio.wait_for(c.wait_delivered(pid), 1)
+        task.cancel()
+        return c
+
+    c = _run(broker, f)
+    assert c.rtt_ms is not None and not c._pings and not c._inflight
+
+
+def test_blocking_client_ping_and_nonblocking_read():
+    broker = FakeBroker()
+    got = []
+
+    def on_packet(conn, op, body):
+        if op == 0x32:  # a PINGRESP ahead of the PUBACK
+            conn.feed(b"\xd0\0" + packet(0x40, body[3:5]))
+            return True
+
+    broker.on_packet = on_packet
+    with broker.patch(mqtt):
+        c = mqtt.MQTTClient(b"dev", "broker")
+        c.set_callback(lambda t, m: got.append((t, m)))
+        c.connect()
+        c.ping()
+        c.publish(b"t", b"m", qos=1)  # skips the PINGRESP, returns on the PUBACK
+        assert c.rtt_ms is not None
+        assert c.check_msg() is None  # read(1) returns None, nothing waiting
+        broker.send(publish(b"t", b"hello"))
+        assert c.check_msg() == 0x30
+    assert got == [(b"t", b"hello")]
+
+
+def test_blocking_client_refuses_qos2():
+    broker = FakeBroker()
+    with broker.patch(mqtt):
+        c = mqtt.MQTTClient(b"dev", "broker")
+        c.set_callback(lambda t, m: None)
+        c.connect()
+        with pytest.raises(ValueError):
+            c.publish(b"t", b"m", qos=2)
+        with pytest.raises(ValueError):
+            c.subscribe(b"t", qos=2)
+    assert [op for op, _ in broker.received] == [0x10]
+
+
+def test_malformed_length_reconnects():
+    broker = FakeBroker()
+
+    async def f(c):
+        task = _keep(c)
+        await c.wait_connected()
+        broker.send(b"\x30\xff\xff\xff\xff\x01")  # five length bytes
+        await _until(lambda: len(broker.connections) == 2 and c.isconnected())
+        task.cancel()
+        return c
+
+    c = _run(broker, f)
+    assert c.reconnects == 1 and c.metrics()["last_error"] == "OSError(-1)"
+    assert broker.connections[0].closed  # the socket, not just the stream
+
+
+def test_unanswered_pings_close_the_socket():
+    broker = FakeBroker()
+    broker.on_packet = lambda conn, op, body: op == 0xC0 and len(broker.connections) == 1  # no PINGRESP
+
+    async def f(c):
+        task = _keep(c)
+        await c.wait_connected()
+        await _until(lambda: len(broker.connections) == 2 and c.isconnected())
+        task.cancel()
+        return c
+
+    c = _run(broker, f, ping_interval_ms=20, max_missed_pings=2)
+    assert broker.connections[0].closed and c.dead_links == 1 and c.reconnects == 1
+    assert [op for op, _ in broker.received].count(0xC0) == 2
+
+
+def test_concurrent_writers_are_serialised():
+    broker = FakeBroker(slow_drain=True)
+
+    async def f(c):
+        c.set_callback(lambda t, m: None)
+        task = _keep(c)
+        await c.wait_connected()
+        sends = [c.publish(b"t", b"%d" % i, qos=i % 2) for i in range(20)] + [c.ping()]
+        await asyncio.gather(*sends)
+        broker.send(publish(b"in", b"m", qos=1, pid=7))  # its PUBACK too
+        await _until(lambda: len(broker.received) == 23)
+        task.cancel()
+        return c
+
+    c = _run(broker, f, protocol=5, max_inflight=20)
+    assert [m for _, m, _, _ in broker.messages] == [b"%d" % i for i in range(20)]
+    assert c.reconnects == 0 and c.last_error is None and broker.received[-1] == (0x40, b"\0\7")
+
+
+def test_oversized_packet_is_skipped():
+    broker = FakeBroker(chunk=16)
+    got = []
+
+    async def f(c):
+        c.set_callback(lambda t, m: got.append(bytes(m)))
+        task = _keep(c)
+        await c.wait_connected()
+        broker.send(publish(b"t", bytes(500)) + publish(b"t", b"after"))
+        await _until(lambda: got)
+        task.cancel()
+        return c
+
+    c = _run(broker, f, rx_size=32, max_packet=100)
+    assert got == [b"after"] and c.oversized == 1
+
+
+def test_reconnect_resends_inflight_and_resubscribes():
+    broker = FakeBroker()
+    broker.on_packet = lambda conn, op, body: op == 0x32 and len(broker.connections) == 1  # no PUBACK yet
+
+    async def f(c):
+        await c.subscribe(b"cmd", handler=lambda t, m: None)
+        task = _keep(c)
+        await c.wait_connected()
+        pid = await c.publish(b"t", b"m", qos=1)
+        broker.fail_connects = 2
+        broker.drop()
+        with pytest.raises(OSError):
+            await c.wait_delivered(pid)
+        await _until(lambda: not c._inflight)
+        task.cancel()
+        return c
+
+    c = _run(broker, f)
+    ops = [op for op, _ in broker.received]
+    # The session was not kept, so the subscription is renewed before the resend
+    assert ops == [0x10, 0x82, 0x32, 0x10, 0x82, 0x3A]
+    assert c.reconnects == 3
+
+
+def test_persistent_session_is_not_resubscribed():
+    broker = FakeBroker(session_present=True)
+
+    async def f(c):
+        await c.subscribe(b"cmd", handler=lambda t, m: None)
+        task = _keep(c)
+        await c.wait_connected()
+        broker.drop()
+        await _until(lambda: len(broker.connections) == 2 and c.isconnected())
+        task.cancel()
+
+    _run(broker, f)
+    assert [op for op, _ in broker.received] == [0x10, 0x82, 0x10]
+
+
+def test_qos2_delivered_once():
+    broker = FakeBroker()
+    got = []
+
+    async def f(c):
+        c.set_callback(lambda t, m: got.append(bytes(m)))
+        task = _keep(c)
+        await c.wait_connected()
+        broker.send(publish(b"t", b"once", qos=2, pid=7))
+        broker.send(publish(b"t", b"once", qos=2, pid=7, dup=True))
+        await _until(lambda: len(broker.received) == 3)
+        broker.send(packet(0x62, b"\0\x07"))
+        await _until(lambda: len(broker.received) == 4)
+        task.cancel()
+
+    _run(broker, f)
+    assert got == [b"once"]
+    assert broker.received[1:] == [(0x50, b"\0\x07"), (0x50, b"\0\x07"), (0x70, b"\0\x07")]
+
+
+def test_mqtt5_topic_alias_and_refusal():
+    broker = FakeBroker()
+    broker.connack_props = b"\x22\x00\x04\x21\x00\x01"  # 4 topic aliases, receive maximum 1
+
+    def on_packet(conn, op, body):
+        if op == 0x32:  # refuse it, "not authorized", once the client is waiting
+            asyncio.get_running_loop().call_later(0.01, conn.feed, packet(0x40, body[11:13] + b"\x87"))
+            return True
+
+    broker.on_packet = on_packet
+
+    async def f(c):
+        task = _keep(c)
+        await c.wait_connected()
+        for i in range(3):
+            await c.publish(b"dev/state", b"%d" % i)
+        pid = await c.publish(b"dev/state", b"q", qos=1)
+        with pytest.raises(mqtt.MQTTException):
+            await asyncio.wait_for(c.wait_delivered(pid), 1)
+        task.cancel()
+        return c
+
+    c = _run(broker, f, protocol=5, message_expiry_s=30)
+    assert [m[:2] for m in broker.messages] == [(b"dev/state", b"0"), (b"dev/state", b"1"), (b"dev/state", b"2"), (b"dev/state", b"q")]
+    # The topic goes once, then only its alias
+    assert [len(b) for op, b in broker.received if op == 0x30] == [21, 12, 12]
+    assert c._send_max == 1 and c.refused == 1
+
+
+
+def test_publish_queue_retain_and_expiry():
+    broker = FakeBroker()
+
+    async def f(c):
+        q = mqtt.PublishQueue(c, rate=100, burst=10)
+        q.put(b"dev/state", b"old", True, expiry_s=0)
+        q.put(b"dev/state", b"new", True, expiry_s=0)  # replaces "old"
+        q.put(b"dev/heartbeat", b"1", True, expiry_s=360)
+        task = _keep(c)
+        run = asyncio.create_task(q.run())
+        await _until(lambda: len(broker.messages) == 2)
+        task.cancel()
+        run.cancel()
+        return q
+
+    q = _run(broker, f, protocol=5, message_expiry_s=30)
+    assert [m[:2] + m[3:] for m in broker.messages] == [(b"dev/state", b"new", True), (b"dev/heartbeat", b"1", True)]
+    state, beat = [b for op, b in broker.received if op == 0x31]
+    # No expiry property on the state, 360 s on the heartbeat
+    assert state[11] == 0 and beat[15:21] == b"\x05\x02\x00\x00\x01\x68"
+    assert q.coalesced == 1
+
+def _tls_broker():
+    import os
+    import ssl
+
+    from fake_broker import TLSBroker
+
+    here = os.path.join(os.path.dirname(__file__), "tls")
+
+    def der(name):
+        # Self-signed, so the certificate is also what a board would pin
+        with open(os.path.join(here, name)) as f:
+            pem = f.read()
+        end = pem.index(ssl.PEM_FOOTER) + len(ssl.PEM_FOOTER)
+        return ssl.PEM_cert_to_DER_cert(pem[:end])
+
+    broker = FakeBroker()
+    return broker, TLSBroker(broker, os.path.join(here, "broker.pem")), der("broker.pem"), der("other.pem")
+
+
+def test_tls_context_reused_and_session_resumed():
+    broker, tls, pinned, _ = _tls_broker()
+    try:
+        c = mqtt.MQTTClient(b"dev", "localhost", port=tls.port, ssl=mqtt.tls_context(pinned))
+        for _ in range(3):
+            c.connect()
+            c.disconnect()
+        asyncio.run(_until(lambda: len(broker.received) == 6))  # the broker thread may still be reading
+    finally:
+        tls.close()
+    assert c.tls_handshakes == 3 and c.tls_resumed == 2
+    assert [op for op, _ in broker.received] == [0x10, 0xE0] * 3
+
+
+def test_tls_pinned_certificate_mismatch():
+    broker, tls, _, other = _tls_broker()
+    try:
+        c = mqtt.MQTTClient(b"dev", "localhost", port=tls.port, ssl=mqtt.tls_context(other))
+        with pytest.raises(OSError):
+            c.connect()
+    finally:
+        tls.close()
+    assert not broker.received  # nothing, credentials included, went out
+
+
+def test_tls_async_client():
+    broker, tls, pinned, _ = _tls_broker()
+
+    async def main():
+        c = mqtt.AsyncMQTTClient(b"dev", "localhost", port=tls.port, ssl=mqtt.tls_context(pinned))
+        await c.connect()
+        await c.publish(b"t", b"secure")
+        await c.disconnect()
+        return c
+
+    try:
+        c = asyncio.run(main())
+    finally:
+        tls.close()
+    assert c.tls_handshakes == 1 and broker.messages[0][:2] == (b"t", b"secure")
+
+
+def test_rp2040_outputs(monkeypatch):
+    import run_rp2040
+
+    import config
+
+    monkeypatch.setitem(config.config, "mqtt_host", "127.0.0.1")
+    monkeypatch.setitem(config.config, "mqtt_clientid", "board1")
+    broker = FakeBroker()
+    seen = {}
+
+    async def script(ns, dev):
+        await asyncio.sleep(0.2)
+        broker.send(publish(b"board1/outputs/set", b'{"op1": true, "op3": true}'))
+        broker.send(publish(b"board1/outputs/set", b'{"set": 48, "clear": 4}'))
+        await asyncio.sleep(0.3)
+        seen["outputs"] = ns["outputs"]
+        seen["latched"] = dev.hc595.outputs
+
+    with broker.patch(mqtt):
+        run_rp2040.run(0.6, script)
+    assert seen["outputs"] == seen["latched"] == 0x31
+    assert broker.messages[-1][0] == b"board1/outputs" and broker.messages[-1][1] == b'{"outputs": 49}'
+    assert (b"board1/inputs", b'{"inputs": 0, "seq": 0}', 0, True) in broker.messages
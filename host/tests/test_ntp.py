@@ -0,0 +1,124 @@
+import upy
+
+upy.install()
+
+import asyncio
+import time
+
+import pytest
+
+import ntp
+
+
+class _Clock:
+    """ticks_ms that only moves when the client sleeps."""
+
+    def __init__(self, monkeypatch):
+        self.t = 0
+        monkeypatch.setattr(time, "ticks_ms", lambda: self.t)
+        monkeypatch.setattr(asyncio, "sleep_ms", self.sleep_ms)
+
+    async def sleep_ms(self, ms):
+        self.t += ms
+
+
+class _RTC:
+    def __init__(self):
+        self.writes = []
+
+    def datetime(self, dt):
+        self.writes.append(dt)
+
+
+class _Resolver:
+    async def resolve(self, host, port):
+        return (host, port)
+
+
+def _client(monkeypatch, samples):
+    # samples() gives (offset_ms, delay_ms) for each query
+    c = ntp.NTPClient(["a", "b"], _RTC(), samples=1, resolver=_Resolver())
+
+    async def query(addr):
+        return samples(c)
+
+    monkeypatch.setattr(c, "_query", query)
+    return c
+
+
+def test_adjust_moves_clock_not_rtc(monkeypatch):
+    clock = _Clock(monkeypatch)
+    c = _client(monkeypatch, None)
+    t0 = c.now_ms()
+    clock.t += 1500
+    assert c.now_ms() == t0 + 1500
+    c._adjust(-250)
+    assert c.now_ms() == t0 + 1250 and c._rtc_err_ms == -250 and not c.rtc.writes
+
+
+def test_rtc_written_on_second_boundary(monkeypatch):
+    clock = _Clock(monkeypatch)
+    c = _client(monkeypatch, lambda c: (0, 10))
+    clock.t += 123
+    now = []
+    rtc_datetime = c.rtc.datetime
+    c.rtc.datetime = lambda dt: (now.append(c.now_ms()), rtc_datetime(dt))
+    asyncio.run(c._write_rtc())
+    assert now[0] % 1000 == 0
+    dt = time.gmtime(now[0] // 1000)
+    assert c.rtc.writes == [(dt[0], dt[1], dt[2], dt[6], dt[3], dt[4], dt[5], 0)]
+    assert c.steps == 1 and c._rtc_err_ms == 0
+
+
+def test_step_only_past_step_ms(monkeypatch):
+    _Clock(monkeypatch)
+    offsets = iter([(3000, 20), (3000, 5), (100, 20), (100, 5), (ntp.STEP_MS - 50, 5), (0, 5)])
+    c = _client(monkeypatch, lambda c: next(offsets))
+    assert asyncio.run(c.sync())  # the first sync always sets the RTC
+    assert c.offset_ms == 3000 and c.delay_ms == 5 and c.steps == 1
+    assert asyncio.run(c.sync())
+    assert c.steps == 1 and c._rtc_err_ms == 100  # slewed, RTC left alone
+    assert asyncio.run(c.sync())
+    assert c.steps == 2 and c._rtc_err_ms == 0  # 100 + 450 >= STEP_MS
+
+
+def test_failed_sync(monkeypatch):
+    _Clock(monkeypatch)
+    c = _client(monkeypatch, lambda c: None)
+    assert not asyncio.run(c.sync())
+    assert c.failures == 1 and c.syncs == 0 and not c.rtc.writes
+
+
+@pytest.mark.parametrize("ppm", [40, -120])
+def test_drift_converges(monkeypatch, ppm):
+    # The true time runs ppm faster than ticks_ms; each query sees the difference
+    clock = _Clock(monkeypatch)
+    start = {}
+
+    def sample(c):
+        if not start:
+            start["ms"] = c.now_ms()
+        true_ms = start["ms"] + clock.t + clock.t * ppm // 1000000
+        return true_ms - c.now_ms(), 5
+
+    c = _client(monkeypatch, sample)
+
+    async def main():
+        for _ in range(6):
+            assert await c.sync()
+            await c._hold(3600)
+
+    asyncio.run(main())
+    assert c.drift_ppm == pytest.approx(ppm, abs=2)
+    # Slewing between syncs leaves little for the next one to correct
+    assert abs(c.offset_ms) <= 10
+
+
+def test_large_offset_not_taken_as_drift(monkeypatch):
+    clock = _Clock(monkeypatch)
+    offsets = iter([(0, 5), (0, 5), (60000, 5), (60000, 5)])
+    c = _client(monkeypatch, lambda c: next(offsets))
+    asyncio.run(c.sync())
+    clock.t += 3600 * 1000
+    asyncio.run(c.sync())
+    assert c.drift_ppm == 0 and c.steps == 2
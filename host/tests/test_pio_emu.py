@@ -0,0 +1,159 @@
+import upy
+
+upy.install("rp2040")
+
+import asyncio
+
+import pytest
+
+import machine
+import rp2
+import pio_emu
+import run_rp2040
+
+
+def _sm0():
+    # The program and wiring from rp2040/main.py
+    @rp2.asm_pio(out_init=rp2.PIO.OUT_LOW, sideset_init=(rp2.PIO.OUT_HIGH, rp2.PIO.OUT_LOW))
+    def pio_prog():
+        wrap_target()
+        pull(ifempty)
+        label("bitloop")
+        out(pins, 1)
+        nop().side(0x00)[1]
+        nop().side(0x01)[1]
+        jmp(not_osre, "bitloop")
+        nop().side(0x03)[1]
+        nop().side(0x01)[1]
+        wrap()
+
+    machine.GPIO.listeners.clear()
+    machine.GPIO.levels.clear()
+    chain = pio_emu.HC595Chain(machine.GPIO, data=10, clock=11, latch=12, chips=4)
+    sm = rp2.StateMachine(0, pio_prog, freq=2000, out_base=machine.Pin(10), sideset_base=machine.Pin(11))
+    sm.active(1)
+    return sm, chain
+
+
+def test_latches_each_word():
+    sm, chain = _sm0()
+    for v in (0x00000001, 0x80000000, 0xDEADBEEF, 0x0000A5A5, 0):
+        sm.put(v)
+        assert chain.outputs == v
+    assert chain.frames == 5
+    assert [v for _, v in chain.latched] == [0x00000001, 0x80000000, 0xDEADBEEF, 0x0000A5A5, 0]
+
+
+def test_frame_timing():
+    sm, chain = _sm0()
+    sm.put(1)
+    sm.put(2)
+    # pull + 32 * (out, nop[1], nop[1], jmp) + 2 * nop[1]
+    assert sm.emu.frame_cycles == 1 + 32 * 6 + 4
+    assert sm.emu.fps == pytest.approx(2000 / 197)
+    # Latch and clock rise together once per frame, so 33 shift clocks
+    assert chain.clocks_per_frame == 33
+
+
+def test_unchanged_frames_counted():
+    sm, chain = _sm0()
+    for v in (5, 5, 5, 6):
+        sm.put(v)
+    assert chain.frames == 4
+    assert chain.unchanged == 2
+
+
+def test_unsupported_instruction_rejected():
+    with pytest.raises(NotImplementedError):
+
+        @rp2.asm_pio()
+        def prog():
+            wait(1, pin, 0)
+
+
+def test_delay_limited_by_sideset_count():
+    with pytest.raises(ValueError):
+
+        @rp2.asm_pio(sideset_init=(rp2.PIO.OUT_LOW, rp2.PIO.OUT_LOW))
+        def prog():
+            nop().side(0)[8]
+
+
+def test_main_drives_chain():
+    async def script(ns, dev):
+        ns["update_output"]("op3", 1)
+        ns["update_output"]("op16", 1)
+
+    ns, dev = run_rp2040.run(1.3, script)
+    assert ns["sm0"].emu.frame_cycles == 197
+    assert dev.hc595.enabled
+    assert dev.hc595.outputs == 0x8004
+    # The NTP and web server stubs don't outlive the run
+    assert run_rp2040.ntp.NTPClient.sync is not run_rp2040._ntp_sync
+    assert run_rp2040.asyncio.start_server is not run_rp2040._no_server
+
+
+def _sm1():
+    # Reuse pio_in_prog from a short run of rp2040/main.py
+    ns, _ = run_rp2040.run(0.01)
+    machine.GPIO.listeners.clear()
+    machine.GPIO.levels.clear()
+    chain = pio_emu.HC165Chain(machine.GPIO, data=6, clock=8, load=7, chips=4)
+    sm = pio_emu.StateMachine(ns["pio_in_prog"], 1000000, machine.GPIO, in_base=6, sideset_base=7)
+    irqs = []
+    sm.irq_handler = lambda: irqs.append(sm.cycles)
+    sm.enabled = True
+    return sm, chain, irqs
+
+
+def test_inputs_pushed_on_change_only():
+    sm, chain, irqs = _sm1()
+    sm.run(5000)
+    assert sm.rx_fifo() == 0  # all low, same as the initial word
+    chain.set(0x80000001)
+    sm.run(4000)  # DEBOUNCE samples
+    assert list(sm.rx) == [0x80000001]
+    assert len(irqs) == 1
+    sm.run(5000)
+    assert sm.rx_fifo() == 1
+
+
+def test_input_glitch_filtered():
+    sm, chain, irqs = _sm1()
+    sm.run(1000)
+    chain.set(0x00000100)
+    sm.run(100)  # shorter than one sample period
+    chain.set(0)
+    sm.run(5000)
+    assert sm.rx_fifo() == 0 and not irqs
+
+
+def test_input_bounce_filtered():
+    # Contact bounce lasting several samples, then settling on the new value
+    sm, chain, irqs = _sm1()
+    sm.run(1000)
+    for i in range(8):
+        chain.set(0x00000100 if i % 2 == 0 else 0)
+        sm.run(700)  # about two samples each
+    assert sm.rx_fifo() == 0 and not irqs
+    chain.set(0x00000100)
+    sm.run(4000)
+    assert list(sm.rx) == [0x00000100] and len(irqs) == 1
+
+
+def test_sample_period():
+    sm, chain, irqs = _sm1()
+    sm.run(32800)
+    # One load every 328 cycles while inputs are steady, the first at cycle 0
+    assert chain.loads == 32800 // 328
+
+
+def test_main_reads_inputs():
+    async def script(ns, dev):
+        dev.hc165.set(0x00000005)
+        await asyncio.sleep(0.05)
+        dev.hc165.set(0x00000004)
+
+    ns, dev = run_rp2040.run(0.2, script)
+    assert ns["inputs"] == 0x00000004
+    assert [e[2:] for e in ns["input_events"]] == [(0x5, 0), (0, 0x1)]
@@ -0,0 +1,76 @@
+import upy
+
+upy.install()
+
+import asyncio
+import time
+
+import telemetry
+from profiler import Profiler
+from watchdog import Watchdog
+
+
+def test_steps_and_longest_block():
+    prof = Profiler()
+
+    async def worker():
+        for _ in range(3):
+            await asyncio.sleep(0)
+        time.sleep(0.02)  # a blocking call, e.g. getaddrinfo
+
+    async def main():
+        await prof.create_task(worker(), "worker")
+        return await prof.wrap(asyncio.sleep(0, "done"), "inline")
+
+    assert asyncio.run(main()) == "done"
+    s = prof.stats()
+    assert s["worker"]["steps"] == 4 and s["worker"]["max_step_us"] >= 20000
+    assert s["inline"]["steps"] == 2
+    prof.reset()
+    assert prof.stats()["worker"]["steps"] == 0
+
+
+def test_disabled_is_a_plain_task():
+    prof = Profiler(enabled=False)
+
+    async def main():
+        coro = asyncio.sleep(0)
+        assert prof.wrap(coro, "x") is coro
+        await coro
+
+    asyncio.run(main())
+    assert prof.stats() == {}
+
+
+def test_watchdog_stops_feeding(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # where the reason is left
+    up = [True]
+    wd = Watchdog(5000, max_lag_ms=100, max_slow=2)
+    wd.check("wifi lost", lambda: up[0])
+    assert wd.feed(5) and wd.feed(500) and wd.feed(5) and wd.feed(500)  # not twice in a row
+    assert wd._wdt.timeout == 5000 and wd._wdt.feeds == 4
+    up[0] = False
+    assert not wd.feed(5) and not wd.feed(5) and wd.failed == "wifi lost"
+    assert telemetry.Telemetry().reset_cause == "wifi lost"
+
+    wd = Watchdog(5000, max_lag_ms=100, max_slow=2)
+    wd.feed(500)
+    assert not wd.feed(500) and wd.failed == "loop lag 500 ms"
+
+
+def test_rp2040_profile(monkeypatch):
+    import run_rp2040
+
+    import config
+
+    monkeypatch.setitem(config.config, "profile", True)
+    seen = {}
+
+    async def script(ns, dev):
+        await asyncio.sleep(1.2)
+        seen.update(ns["prof"].stats())
+        seen["feeds"] = ns["wdt"].feeds
+
+    run_rp2040.run(1.3, script)
+    assert seen["inputs"]["steps"] > 0 and seen["outputs"]["steps"] > 0
+    assert seen["feeds"] == 1
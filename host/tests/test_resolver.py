@@ -0,0 +1,100 @@
+import upy
+
+upy.install()
+
+import asyncio
+import struct
+import time
+
+import pytest
+
+import resolver
+from resolver import Resolver
+
+
+def _name(host):
+    return b"".join(bytes([len(p)]) + p.encode() for p in host.split(".")) + b"\0"
+
+
+def _rr(name, rtype, ttl, rdata):
+    return name + struct.pack("!HHIH", rtype, 1, ttl, len(rdata)) + rdata
+
+
+def _answer(qid, host, answers, flags=0x8180):
+    msg = struct.pack("!HHHHHH", qid, flags, 1, len(answers), 0, 0) + _name(host) + b"\0\x01\0\x01"
+    return msg + b"".join(answers)
+
+
+def test_parse_compressed_name():
+    # The answer's name is a pointer to the question at offset 12
+    msg = _answer(7, "mqtt.lan", [_rr(b"\xc0\x0c", 1, 300, bytes([192, 168, 1, 9]))])
+    assert Resolver()._parse(msg, 7) == ("192.168.1.9", 300)
+
+
+def test_parse_cname_then_a():
+    # mqtt.lan CNAME broker.lan, broker.lan A; the A record's name points into the CNAME's data
+    cname = _name("broker.lan")
+    a_name = struct.pack("!H", 0xC000 | (12 + len(_name("mqtt.lan")) + 4 + 2 + 10))
+    msg = _answer(
+        9,
+        "mqtt.lan",
+        [_rr(b"\xc0\x0c", 5, 3600, cname), _rr(a_name, 1, 120, bytes([10, 0, 0, 2]))],
+    )
+    assert Resolver()._parse(msg, 9) == ("10.0.0.2", 120)
+
+
+def test_parse_rejects():
+    r = Resolver()
+    a = [_rr(b"\xc0\x0c", 1, 300, bytes([10, 0, 0, 1]))]
+    assert r._parse(_answer(1, "x.lan", a), 2) is None  # someone else's answer
+    assert r._parse(_answer(1, "x.lan", a, flags=0x0100), 1) is None  # a query, not a response
+    assert r._parse(_answer(1, "x.lan", [], flags=0x8183), 1) is None  # NXDOMAIN
+    assert r._parse(_answer(1, "x.lan", [_rr(b"\xc0\x0c", 5, 300, _name("y.lan"))]), 1) is None
+    assert r._parse(b"\0" * 11, 1) is None
+
+
+class _Clock:
+    def __init__(self, monkeypatch):
+        self.t = 0
+        monkeypatch.setattr(time, "ticks_ms", lambda: self.t)
+
+
+def _resolver(answers):
+    # answers: list of (ip, ttl) or None, one per query
+    r = Resolver("192.168.1.1")
+    r.queries = 0
+
+    async def query(host):
+        r.queries += 1
+        return answers.pop(0)
+
+    r._query = query
+    return r
+
+
+@pytest.mark.parametrize("ttl, kept_s", [(5, resolver.MIN_TTL_S), (600, 600), (10**6, resolver.MAX_TTL_S)])
+def test_ttl_clamped(monkeypatch, ttl, kept_s):
+    clock = _Clock(monkeypatch)
+    r = _resolver([("10.0.0.1", ttl), ("10.0.0.2", ttl)])
+    assert asyncio.run(r.lookup("a.lan")) == "10.0.0.1"
+    clock.t += kept_s * 1000 - 1
+    assert asyncio.run(r.lookup("a.lan")) == "10.0.0.1" and r.hits == 1
+    clock.t += 1
+    assert asyncio.run(r.lookup("a.lan")) == "10.0.0.2" and r.queries == 2
+
+
+def test_stale_fallback_and_cold_failure(monkeypatch):
+    clock = _Clock(monkeypatch)
+    r = _resolver([("10.0.0.1", 60), None, None])
+    asyncio.run(r.lookup("a.lan"))
+    clock.t += 61000
+    assert asyncio.run(r.lookup("a.lan")) == "10.0.0.1"
+    assert r.stale == 1 and r.failures == 1
+    with pytest.raises(OSError):
+        asyncio.run(r.lookup("b.lan"))
+    assert r.failures == 2 and r.cached("b.lan") is None
+
+
+def test_ip_not_looked_up():
+    r = _resolver([])
+    assert asyncio.run(r.lookup("192.168.1.20")) == "192.168.1.20" and r.queries == 0
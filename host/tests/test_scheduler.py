@@ -0,0 +1,76 @@
+import upy
+
+upy.install()
+
+import asyncio
+
+import machine
+import network
+
+import scheduler
+
+
+def _run(s, ms, *tasks):
+    async def main():
+        for t in tasks:
+            asyncio.create_task(t)
+        try:
+            await asyncio.wait_for(s.run(), ms / 1000)
+        except asyncio.TimeoutError:
+            pass
+
+    asyncio.run(main())
+
+
+def test_jobs_share_wakes():
+    s = scheduler.Scheduler(quantum_ms=10)
+    got = []
+    s.every(20, lambda: got.append(2))
+    s.every(40, lambda: got.append(4))
+
+    async def job():
+        got.append("async")
+
+    s.every(40, job)
+    _run(s, 95)
+    # Steps 2, 4, 6, 8: the 40 ms jobs ride on the 20 ms job's wakes
+    assert got == [2, 2, 4, "async", 2, 2, 4, "async"] and s.wakes == 4
+
+
+def test_failing_job_is_counted():
+    s = scheduler.Scheduler(quantum_ms=10)
+    s.every(10, lambda: 1 // 0)
+    _run(s, 35)
+    assert s.errors == s.wakes == 3
+
+
+def test_light_sleep_stops_at_other_timers(monkeypatch):
+    slept = []
+    lightsleep = machine.lightsleep
+    monkeypatch.setattr(machine, "lightsleep", lambda ms: slept.append(ms) or lightsleep(ms))
+    s = scheduler.Scheduler(quantum_ms=200, light_sleep_ms=60)
+    s.every(200, lambda: None)
+
+    async def other():
+        await asyncio.sleep(0.1)
+
+    _run(s, 250, other())
+    # Capped at light_sleep_ms, and never past the other task's wakeup
+    assert max(slept) == 60 and min(slept) < 60 and s.wakes == 1
+    assert sum(slept) == s.slept_ms
+    m = s.metrics(battery_mah=2000)
+    assert 0 < m["est_ma"] and m["est_days"] > 0
+
+
+def test_no_light_sleep_while_wifi_is_up(monkeypatch):
+    slept = []
+    monkeypatch.setattr(machine, "lightsleep", lambda ms: slept.append(ms))
+    wlan = network.WLAN()
+    s = scheduler.Scheduler(quantum_ms=100, light_sleep_ms=50, wlan=wlan)
+    s.every(100, lambda: None)
+    _run(s, 250)
+    assert not slept and s.wakes == 2
+
+    wlan.disconnect()
+    _run(s, 150)
+    assert slept and s.light_sleeps == len(slept)
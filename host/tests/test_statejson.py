@@ -0,0 +1,37 @@
+import json
+
+import upy
+
+upy.install()
+
+import pytest
+
+from statejson import StateJSON
+
+
+@pytest.mark.parametrize(
+    "d",
+    [
+        {"enabled": True, "on": False, "n": 0},
+        {"enabled": False, "on": None, "n": -1234567890123},
+        {"enabled": True, "on": True, "n": 2**63 - 1},
+    ],
+)
+def test_matches_json_dumps(d):
+    s = StateJSON(("enabled", "on", "n"))
+    assert bytes(s.dumps(d)) == json.dumps(d).encode()
+
+
+def test_buffer_is_reused():
+    s = StateJSON(("on",))
+    a = s.dumps({"on": False})
+    b = s.dumps({"on": True})
+    assert a.obj is b.obj and bytes(b) == b'{"on": true}'
+    assert bytes(StateJSON(()).dumps({})) == b"{}"
+
+
+def test_value_and_unsupported():
+    s = StateJSON(("on", "n"))
+    assert bytes(s.value("on", False)) == b"false" and bytes(s.value("n", -7)) == b"-7"
+    with pytest.raises(TypeError):
+        s.dumps({"on": "yes", "n": 1})
@@ -0,0 +1,49 @@
+import upy
+
+upy.install()
+
+import gc
+
+import machine
+import pytest
+
+import telemetry
+
+
+def test_reset_reason_survives_reset(tmp_path):
+    path = str(tmp_path / "reason.txt")
+    assert telemetry.Telemetry(reset_file=path).reset_cause == "power on"
+    with pytest.raises(machine.Reset):
+        telemetry.reset("wifi lost", path)
+    assert telemetry.Telemetry(reset_file=path).reset_cause == "wifi lost"
+    # Read once; the next reset is machine's own again
+    assert telemetry.Telemetry(reset_file=path).reset_cause == "power on"
+
+
+def test_snapshot(tmp_path):
+    import network
+
+    t = telemetry.Telemetry(network.WLAN(), reset_file=str(tmp_path / "none"))
+    t.add("mqtt", lambda: {"reconnects": 2, "rtt_ms": 9, "other": 1}, ("reconnects", "rtt_ms", "missing"))
+    t.lag(3)
+    t.lag(40)
+    t.lag(5)
+    m = t.snapshot()
+    assert m["mqtt"] == {"reconnects": 2, "rtt_ms": 9}
+    assert (m["lag_ms"], m["max_lag_ms"], m["rssi"], m["reset"]) == (5, 40, -55, "power on")
+    assert 0 < m["largest_free"] <= m["mem_free"] == gc.mem_free()
+    assert t.snapshot()["max_lag_ms"] == 5  # the worst since the last snapshot
+
+
+def test_rp2040_health_route():
+    import asyncio
+    import run_rp2040
+
+    seen = {}
+
+    async def script(ns, dev):
+        await asyncio.sleep(0.3)
+        seen.update(ns["health"].snapshot())
+
+    run_rp2040.run(0.4, script)
+    assert seen["up_s"] == 0 and "ntp" in seen and seen["lag_ms"] >= 0
@@ -0,0 +1,72 @@
+import upy
+
+upy.install("rp2040")
+
+import os
+import shutil
+
+import pytest
+
+import template
+from http import WebApp
+
+TEMPLATES = os.path.join(upy.ROOT, "rp2040", "templates")
+
+
+def _render(text, *args):
+    ns = {}
+    exec(template.translate(text), ns)
+    return b"".join(s if isinstance(s, bytes) else s.encode() for s in ns["render"](*args))
+
+
+class _Writer:
+    def __init__(self):
+        self.writes = []
+
+    def awrite(self, buf, off=0, sz=-1):
+        self.writes.append(bytes(buf[off : None if sz < 0 else off + sz]))
+        return
+        yield
+
+
+def test_translate():
+    text = "{% args items, title='x' %}\n<h1>{{ title }}</h1>{# skipped #}\n{% for i in items %}\n{% if i % 2 %}\n<i>{{ i }}</i>\n{% elif i == 0 %}\nzero\n{% else %}\n<b>{{ i }}</b>\n{% endif %}\n{% endfor %}\n"
+    assert _render(text, [0, 1, 2]) == b"<h1>x</h1>\nzero\n<i>1</i>\n<b>2</b>\n"
+    assert _render("{% if 0 %}{% endif %}") == b""
+    for bad in ("{% for i in x %}", "{% endif %}", "{{ x", "{% spam %}", "a{% args x %}"):
+        with pytest.raises(ValueError):
+            template.translate(bad)
+
+
+def test_load_caches_compiled_module(tmp_path):
+    d = str(tmp_path)
+    with open(d + "/a.html", "w") as f:
+        f.write("{% args n %}n={{ n }}")
+    render = template.load(d, "a.html")
+    assert b"".join(x if isinstance(x, bytes) else x.encode() for x in render(3)) == b"n=3"
+    assert os.path.exists(d + "/a_html.py")
+
+    # Recompiled only once the template is newer
+    with open(d + "/a.html", "w") as f:
+        f.write("{% args n %}m={{ n }}")
+    os.utime(d + "/a.html", (1, 1))
+    assert template.load(d, "a.html") is render
+    os.utime(d + "/a.html", (2**31, 2**31))
+    assert b"".join(x if isinstance(x, bytes) else x.encode() for x in template.load(d, "a.html")(3)) == b"m=3"
+
+    # Compiled copy alone
+    os.remove(d + "/a.html")
+    assert template.load(d, "a.html")
+
+
+def test_status_page_streams(tmp_path):
+    shutil.copy(os.path.join(TEMPLATES, "status.html"), str(tmp_path))
+    app = WebApp()
+    app.templates_dir = str(tmp_path)
+    w = _Writer()
+    for _ in app.render_template(w, "status.html", (0x80000005, 0x2, 7), chunk=128):
+        pass
+    page = b"".join(w.writes)
+    assert sum(len(x) > 128 for x in w.writes) == 1 and len(w.writes) > 10  # the head, written as is
+    assert page.count(b"<tr><td>") == 32 and page.count(b'class="on"') == 4
+    assert b"0x80000005" in page and b"Input changes: 7" in page
@@ -0,0 +1,111 @@
+import upy
+
+upy.install("rp2040")
+
+import udpctl
+
+KEY = "secret"
+
+
+def _ctl(**kw):
+    state = {"outputs": 0}
+
+    def apply(set_mask, clear_mask):
+        state["outputs"] = (state["outputs"] & ~clear_mask & 0xFFFFFFFF) | set_mask
+        return state["outputs"]
+
+    kw.setdefault("clock", lambda: 1000)
+    return udpctl.UdpControl(KEY, 3, apply, groups=(7,), **kw), state
+
+
+def test_applies_masks_and_acks():
+    ctl, state = _ctl()
+    assert ctl.handle(udpctl.pack(KEY, 1, 3, 10, 1000, 0x0F, 0)) is None
+    ack = ctl.handle(udpctl.pack(KEY, 1, 3, 11, 1000, 0x10, 0x03, udpctl.FLAG_ACK))
+    assert state["outputs"] == 0x1C
+    flags, sender, board, seq, _, outputs, _ = udpctl.unpack(KEY, ack)
+    assert flags & udpctl.FLAG_REPLY and (sender, board, seq, outputs) == (1, 3, 11, 0x1C)
+
+
+def test_targets():
+    ctl, state = _ctl()
+    ctl.handle(udpctl.pack(KEY, 1, 4, 1, 1000, 0x1, 0))  # another board
+    ctl.handle(udpctl.pack(KEY, 1, 8, 2, 1000, 0x2, 0, udpctl.FLAG_GROUP))  # another group
+    assert state["outputs"] == 0 and ctl.ignored == 2
+    ctl.handle(udpctl.pack(KEY, 1, 7, 3, 1000, 0x4, 0, udpctl.FLAG_GROUP))
+    ctl.handle(udpctl.pack(KEY, 1, udpctl.ALL, 4, 1000, 0x8, 0))
+    assert state["outputs"] == 0xC
+
+
+def test_rejects_bad_mac_and_replays():
+    ctl, state = _ctl()
+    pkt = udpctl.pack(KEY, 1, 3, 5, 1000, 0x1, 0)
+    ctl.handle(udpctl.pack("wrong", 1, 3, 6, 1000, 0x2, 0))
+    ctl.handle(pkt[:-1] + bytes([pkt[-1] ^ 1]))
+    assert ctl.rejected == 2
+    ctl.handle(pkt)
+    ctl.handle(pkt)  # same sequence number
+    ctl.handle(udpctl.pack(KEY, 1, 3, 4, 1000, 0x4, 0))  # older
+    ctl.handle(udpctl.pack(KEY, 2, 3, 1, 900, 0x8, 0))  # outside the time window
+    assert ctl.replays == 3 and state["outputs"] == 0x1
+    ctl.handle(udpctl.pack(KEY, 2, 3, 1, 1010, 0x8, 0))  # sequence numbers are per sender
+    assert state["outputs"] == 0x9
+
+
+def test_sequence_wraps():
+    ctl, state = _ctl(clock=None)
+    ctl.handle(udpctl.pack(KEY, 1, 3, 0xFFFFFFFF, 0, 0x1, 0))
+    ctl.handle(udpctl.pack(KEY, 1, 3, 0, 0, 0x2, 0))
+    assert state["outputs"] == 0x3 and ctl.replays == 0
+
+
+def test_main_applies_without_waiting_for_refresh():
+    import asyncio
+    import run_rp2040
+
+    seen = {}
+
+    async def script(ns, dev):
+        await asyncio.sleep(0.1)
+        ctl = ns["udpctl"]
+        ctl.handle(udpctl.pack(ctl.key, 1, ctl.board_id, 1, 0, 0x8001, 0))
+        await asyncio.sleep(0.3)
+        seen["outputs"] = dev.hc595.outputs
+
+    run_rp2040.run(0.5, script)
+    assert seen["outputs"] == 0x8001
+
+
+def test_rejects_datagrams_from_before_boot(monkeypatch):
+    # Captured within WINDOW_S but before a reboot, when _seqs was lost
+    monkeypatch.setattr(udpctl.time, "ticks_ms", lambda: 20000)
+    ctl, state = _ctl()
+    ctl.handle(udpctl.pack(KEY, 1, 3, 5, 975, 0x1, 0))
+    assert ctl.replays == 1 and state["outputs"] == 0
+    ctl.handle(udpctl.pack(KEY, 1, 3, 6, 985, 0x2, 0))
+    assert state["outputs"] == 0x2
+
+
+def test_bad_group_addr_does_not_stop_startup():
+    ctl, _ = _ctl(group_addr="239.x.1.1", port=0)
+    ctl._open().close()
+
+
+def test_main_clock_is_unix_time(monkeypatch):
+    # On a port whose epoch is 2000, utc_seconds() still counts from 1970
+    import asyncio
+    import time
+    import run_rp2040
+
+    gmtime = time.gmtime
+    monkeypatch.setattr(time, "gmtime", lambda s=None: (2000, 1, 1, 0, 0, 0, 5, 1, 0) if s == 0 else gmtime(s))
+    seen = {}
+
+    async def script(ns, dev):
+        ntp = ns["ntp"]
+        ntp.syncs = 1
+        ntp.now_ms = lambda: int((time.time() - 946684800) * 1000) + ntp.tz_ms
+        seen["t"] = ns["utc_seconds"]()
+
+    run_rp2040.run(0.1, script)
+    assert abs(seen["t"] - time.time()) < 2
@@ -0,0 +1,118 @@
+import upy
+
+upy.install()
+
+import asyncio
+import json
+import time
+
+import network
+
+from wifi import WifiConnect
+
+NEAR = b"\x02\x00\x00\x00\x00\x02"
+FAR = b"\x02\x00\x00\x00\x00\x01"
+
+
+def _wlan():
+    w = network.WLAN()
+    w.networks = [(b"home", FAR, 1, -80, 3, False), (b"home", NEAR, 6, -50, 3, False), (b"other", FAR, 11, -40, 3, False)]
+    return w
+
+
+def test_full_then_direct(tmp_path):
+    path = str(tmp_path / "wifi.json")
+    w = _wlan()
+    wc = WifiConnect(w, path=path, static=True)
+    assert asyncio.run(wc.connect("home", "pwd"))
+    assert w.connects == [("home", None)]
+    with open(path) as f:
+        e = json.load(f)["home"]
+    assert bytes(e["bssid"]) == NEAR and e["channel"] == 6 and e["ifconfig"][0] == "192.168.1.50"
+
+    w.ifconfig(("0.0.0.0", "0.0.0.0", "0.0.0.0", "0.0.0.0"))
+    assert asyncio.run(wc.connect("home", "pwd"))
+    assert w.connects[-1] == ("home", NEAR) and w.ifconfig()[0] == "192.168.1.50"
+    assert wc.metrics()["direct"] == 1 and "connect_ms" not in wc.metrics()
+
+
+def test_direct_fails_over_to_full(tmp_path):
+    path = str(tmp_path / "wifi.json")
+    w = _wlan()
+    wc = WifiConnect(w, path=path, direct_ms=100, timeout_ms=100)
+    asyncio.run(wc.connect("home", "pwd"))
+    w.refuse.add(NEAR)
+    w.networks = w.networks[:1]
+    assert asyncio.run(wc.connect("home", "pwd"))
+    assert w.connects[-2:] == [("home", NEAR), ("home", None)]
+    with open(path) as f:
+        assert bytes(json.load(f)["home"]["bssid"]) == FAR
+    assert wc.metrics()["full"] == 2
+
+    w.refuse.add("home")
+    assert not asyncio.run(wc.connect("home", "pwd"))
+    with open(path) as f:
+        assert "home" not in json.load(f)
+
+
+def test_remembers_the_ap_joined(tmp_path):
+    path = str(tmp_path / "wifi.json")
+    w = _wlan()
+    w.refuse.add(NEAR)  # the strongest, but not the one joined
+    assert asyncio.run(WifiConnect(w, path=path).connect("home", "pwd"))
+    with open(path) as f:
+        e = json.load(f)["home"]
+    assert bytes(e["bssid"]) == FAR and e["channel"] == 1
+
+
+def test_lease_reused_only_when_static_and_fresh(tmp_path, monkeypatch):
+    path = str(tmp_path / "wifi.json")
+    w = _wlan()
+    asyncio.run(WifiConnect(w, path=path).connect("home", "pwd"))
+    for wc, t, reused in (
+        (WifiConnect(w, path=path), 0, False),
+        (WifiConnect(w, path=path, static=True, lease_s=600), 599, True),
+        (WifiConnect(w, path=path, static=True, lease_s=600), 601, False),
+        (WifiConnect(w, path=path, static=True, lease_s=600), -1, False),  # clock not set yet
+    ):
+        monkeypatch.setattr(time, "time", lambda t0=time.time(), t=t: t0 + t)
+        w.ifconfig(("0.0.0.0", "0.0.0.0", "0.0.0.0", "0.0.0.0"))
+        assert asyncio.run(wc.connect("home", "pwd"))
+        assert wc.metrics()["direct"] == 1 and (w.ifconfig()[0] == "192.168.1.50") == reused
+        monkeypatch.undo()
+
+
+def test_reconnect(tmp_path):
+    w = _wlan()
+    wc = WifiConnect(w, path=str(tmp_path / "wifi.json"), direct_ms=100, timeout_ms=100)
+    ssids = (("home", "pwd"), ("other", "pwd2"))
+    assert asyncio.run(wc.reconnect(ssids)) and w.connects == [] and wc.down_ms() == 0
+
+    w.disconnect()
+    w.refuse.add("home")
+    assert asyncio.run(wc.reconnect(ssids))
+    assert w.connects == [("home", None), ("other", None)] and wc.metrics()["lost"] == 1
+
+    w.refuse.add("other")
+    w.disconnect()
+    assert not asyncio.run(wc.reconnect(ssids))
+    assert wc.down_ms() >= 200 and wc.metrics()["lost"] == 2
+    w.refuse.clear()
+    assert asyncio.run(wc.reconnect(ssids)) and wc.down_ms() == 0
+
+
+def test_rp2040_reconnects_at_runtime(monkeypatch, tmp_path):
+    import run_rp2040
+
+    monkeypatch.chdir(tmp_path)  # the cache file
+    seen = {}
+
+    async def script(ns, dev):
+        ns["wlan"].disconnect()
+        await asyncio.sleep(2.5)
+        seen["up"] = ns["wlan"].isconnected()
+        seen["lost"] = ns["wifi"].lost
+        seen["failed"] = ns["wdt"].failed
+
+    run_rp2040.run(2.6, script)
+    assert seen == {"up": True, "lost": 1, "failed": None}
@@ -0,0 +1,66 @@
+# udpctl_send.py
+# Send a UDP control datagram (rp2040/udpctl.py) to one board, a group or the whole fleet.
+#
+#   python host/udpctl_send.py --key KEY --to 239.255.50.50 --all --set 0x5 --clear 0x2
+#   python host/udpctl_send.py --key KEY --to 192.168.1.50 --board 3 --set 0x1 --ack
+#
+# The sequence number defaults to the current time in ms, so it keeps
+# increasing across runs without any state.
+
+import argparse
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "rp2040"))
+
+import udpctl
+
+
+def main():
+    p = argparse.ArgumentParser(description="Send a UDP control datagram")
+    p.add_argument("--key", required=True)
+    p.add_argument("--to", required=True, help="board address or multicast group")
+    p.add_argument("--port", type=int, default=5005)
+    p.add_argument("--sender", type=int, default=1, help="this controller's id, 0-255")
+    t = p.add_mutually_exclusive_group(required=True)
+    t.add_argument("--board", type=int)
+    t.add_argument("--group", type=int)
+    t.add_argument("--all", action="store_true")
+    p.add_argument("--set", type=lambda v: int(v, 0), default=0)
+    p.add_argument("--clear", type=lambda v: int(v, 0), default=0)
+    p.add_argument("--seq", type=int, default=None)
+    p.add_argument("--ack", action="store_true", help="wait for acks for one second")
+    a = p.parse_args()
+
+    flags = udpctl.FLAG_ACK if a.ack else 0
+    if a.all:
+        target = udpctl.ALL
+    elif a.group is not None:
+        target = a.group
+        flags |= udpctl.FLAG_GROUP
+    else:
+        target = a.board
+    seq = a.seq if a.seq is not None else int(time.time() * 1000) & 0xFFFFFFFF
+    pkt = udpctl.pack(a.key, a.sender, target, seq, int(time.time()), a.set, a.clear, flags)
+
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+    s.sendto(pkt, (a.to, a.port))
+    if not a.ack:
+        return
+    s.settimeout(0.2)
+    end = time.monotonic() + 1
+    while time.monotonic() < end:
+        try:
+            msg, addr = s.recvfrom(64)
+        except socket.timeout:
+            continue
+        r = udpctl.unpack(a.key, msg)
+        if r and r[0] & udpctl.FLAG_REPLY and r[3] == seq:
+            print("%s board %d outputs 0x%08X" % (addr[0], r[2], r[5]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+# upy.py
+# Makes CPython look enough like MicroPython to run the firmware on the host.
+#
+#   import upy
+#   upy.install("rp2040")   # stubs, lib/ and the board folder go on sys.path
+#
+# Adds the MicroPython-only parts of time and asyncio that the firmware uses
+# (ticks_*, sleep_ms, wait_for_ms, ThreadSafeFlag, a get_event_loop that
+# always returns a loop, gc.mem_free/mem_alloc), and puts the hardware stand-ins in host/stubs ahead of everything.
+
+import os
+import sys
+import time
+import asyncio
+import gc
+import warnings
+
+HOST = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HOST)
+STUBS = os.path.join(HOST, "stubs")
+LIB = os.path.join(ROOT, "lib")
+
+_HEAP_BYTES = 192 * 1024  # gc.mem_free(), roughly a Pico W after boot
+_TICKS_PERIOD = 1 << 30
+_TICKS_MAX = _TICKS_PERIOD - 1
+_TICKS_HALF = _TICKS_PERIOD // 2
+
+
+def ticks_ms():
+    return int(time.monotonic() * 1000) & _TICKS_MAX
+
+
+def ticks_us():
+    return int(time.monotonic() * 1000000) & _TICKS_MAX
+
+
+def ticks_diff(a, b):
+    return ((a - b + _TICKS_HALF) & _TICKS_MAX) - _TICKS_HALF
+
+
+def ticks_add(a, delta):
+    return (a + delta) & _TICKS_MAX
+
+
+def sleep_ms(ms):
+    time.sleep(ms / 1000)
+
+
+def sleep_us(us):
+    time.sleep(us / 1000000)
+
+
+async def _sleep_ms(ms):
+    await asyncio.sleep(ms / 1000)
+
+
+async def _wait_for_ms(aw, ms):
+    return await asyncio.wait_for(aw, ms / 1000)
+
+
+class ThreadSafeFlag(asyncio.Event):
+    # Set from IRQ handlers on the device; here handlers run on the loop thread
+    async def wait(self):
+        await super().wait()
+        self.clear()
+
+
+_get_event_loop = asyncio.get_event_loop
+
+
+def _get_loop():
+    # MicroPython has a single loop that always exists
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        pass
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        try:
+            loop = _get_event_loop()
+            if not loop.is_closed():
+                return loop
+        except RuntimeError:
+            pass
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    return loop
+
+
+def install(board=None):
+    """Patch time/asyncio and put stubs, lib/ and the board folder on sys.path."""
+    for name, f in (
+        ("ticks_ms", ticks_ms),
+        ("ticks_us", ticks_us),
+        ("ticks_diff", ticks_diff),
+        ("ticks_add", ticks_add),
+        ("sleep_ms", sleep_ms),
+        ("sleep_us", sleep_us),
+    ):
+        setattr(time, name, f)
+    asyncio.sleep_ms = _sleep_ms
+    asyncio.wait_for_ms = _wait_for_ms
+    asyncio.get_event_loop = _get_loop
+    asyncio.ThreadSafeFlag = ThreadSafeFlag
+    gc.mem_free = lambda: _HEAP_BYTES
+    gc.mem_alloc = lambda: 0
+
+    paths = [STUBS, LIB]
+    if board:
+        paths.append(os.path.join(ROOT, board))
+        # Board modules shadow stdlib/other boards' modules of the same name
+        for name in ("http", "config", "main"):
+            sys.modules.pop(name, None)
+    for p in reversed(paths):
+        if p in sys.path:
+            sys.path.remove(p)
+        sys.path.insert(0, p)
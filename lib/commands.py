@@ -0,0 +1,236 @@
+# commands.py
+# Incoming JSON commands, taken off the MQTT read path and applied by a task
+# of their own.
+# - push(msg) validates a payload against a fixed set of boolean fields and
+#   queues it; it is cheap enough to call from the client's message callback
+# - Flat payloads such as {"on": true, "enabled": 0} are scanned in place,
+#   straight from the receive buffer, without json.loads and without
+#   allocating; anything else (escapes, nesting, other values) goes through
+#   json.loads and gets the same checks
+# - With masks=True, "set" and "clear" take integer bitmasks over all the
+#   fields at once: {"set": 5, "clear": 2} sets fields 0 and 2, clears field 1
+# - An unknown field, a field value other than true/false/0/1 or a mask
+#   with bits beyond the fields rejects the whole command
+# - run() folds everything queued since it last woke, oldest first, into one
+#   call of apply(mask, values): bit i of mask says field i was set, bit i of
+#   values what to. A burst of commands costs one pin update and one publish
+# - The queue holds maxlen commands; when it is full the newest command is
+#   folded into the last one queued, so nothing is lost
+
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+_TRUE = b"true"
+_FALSE = b"false"
+_SET = -2  # field index of the "set" and "clear" masks
+_CLEAR = -3
+
+
+def _skip(b, i, n):
+    while i < n and b[i] in (32, 9, 10, 13):
+        i += 1
+    return i
+
+
+def _at(b, i, n, word):
+    # word found at b[i]
+    k = len(word)
+    if i + k > n:
+        return False
+    for j in range(k):
+        if b[i + j] != word[j]:
+            return False
+    return True
+
+
+class CommandQueue:
+    def __init__(self, fields, apply, maxlen=8, masks=False):
+        # Over 30 fields the masks are no longer small ints, and allocate
+        self.fields = tuple(fields)
+        self._keys = [f.encode() for f in self.fields]
+        self.masks = masks
+        self._all = (1 << len(self.fields)) - 1
+        self.apply = apply
+        self.maxlen = maxlen
+        self._masks = [0] * maxlen  # ring of queued commands
+        self._values = [0] * maxlen
+        self._head = 0
+        self._len = 0
+        self._mask = 0  # the command just parsed
+        self._value = 0
+        self._ready = asyncio.Event()
+
+        # Metrics
+        self.received = 0
+        self.scanned = 0  # parsed without json.loads
+        self.invalid = 0
+        self.folded = 0  # merged into a queued command, queue full
+        self.batches = 0  # apply() calls
+        self.max_queued = 0
+
+    def _field(self, b, i, j):
+        # Index of the key at b[i:j], -1 if unknown
+        for f in range(len(self._keys)):
+            k = self._keys[f]
+            if len(k) == j - i and _at(b, i, j, k):
+                return f
+        if self.masks and j - i in (3, 5):
+            if _at(b, i, j, b"set"):
+                return _SET
+            if _at(b, i, j, b"clear"):
+                return _CLEAR
+        return -1
+
+    def _set(self, f, v, is_bool):
+        # False if v doesn't suit field f
+        if f >= 0:
+            if v not in (0, 1):
+                return False
+            bit = 1 << f
+        elif is_bool or v & ~self._all:
+            return False
+        else:
+            bit = v
+            v = f == _SET
+        self._mask |= bit
+        if v:
+            self._value |= bit
+        else:
+            self._value &= ~bit
+        return True
+
+    def _scan(self, b):
+        # True: parsed, False: invalid, None: not a flat payload, use json.loads
+        n = len(b)
+        i = _skip(b, 0, n)
+        if i >= n or b[i] != 123:  # {
+            return None
+        i = _skip(b, i + 1, n)
+        if i < n and b[i] == 125:  # }
+            return _skip(b, i + 1, n) == n or None
+        while True:
+            if i >= n or b[i] != 34:  # "
+                return None
+            j = i + 1
+            while j < n and b[j] != 34:
+                if b[j] == 92:  # backslash
+                    return None
+                j += 1
+            f = self._field(b, i + 1, j)
+            if f == -1:
+                return False
+            i = _skip(b, j + 1, n)
+            if i >= n or b[i] != 58:  # :
+                return None
+            i = _skip(b, i + 1, n)
+            is_bool = True
+            if _at(b, i, n, _TRUE):
+                v = 1
+                i += 4
+            elif _at(b, i, n, _FALSE):
+                v = 0
+                i += 5
+            elif i < n and 48 <= b[i] <= 57:
+                is_bool = False
+                v = 0
+                while i < n and 48 <= b[i] <= 57:
+                    v = v * 10 + b[i] - 48
+                    i += 1
+            else:
+                return None
+            if not self._set(f, v, is_bool):
+                return False
+            i = _skip(b, i, n)
+            if i < n and b[i] == 44:  # ,
+                i = _skip(b, i + 1, n)
+                continue
+            if i < n and b[i] == 125:
+                return _skip(b, i + 1, n) == n or None
+            return None
+
+    def _load(self, b):
+        try:
+            d = json.loads(bytes(b))
+        except ValueError:
+            return False
+        if not isinstance(d, dict):
+            return False
+        for k, v in d.items():
+            if k in self.fields:
+                f = self.fields.index(k)
+            elif self.masks and k in ("set", "clear"):
+                f = _SET if k == "set" else _CLEAR
+            else:
+                return False
+            is_bool = v is True or v is False
+            if not (is_bool or (type(v) is int and v >= 0)) or not self._set(f, int(v), is_bool):
+                return False
+        return True
+
+    def push(self, msg):
+        """Validate and queue a command. Returns False if it was rejected."""
+        self.received += 1
+        self._mask = self._value = 0
+        ok = self._scan(msg)
+        if ok:
+            self.scanned += 1
+        elif ok is None:
+            self._mask = self._value = 0
+            ok = self._load(msg)
+        if not ok:
+            self.invalid += 1
+            return False
+        if not self._mask:
+            return True  # {}: nothing to do
+        if self._len == self.maxlen:
+            i = (self._head + self._len - 1) % self.maxlen
+            self._masks[i] |= self._mask
+            self._values[i] = (self._values[i] & ~self._mask) | self._value
+            self.folded += 1
+        else:
+            i = (self._head + self._len) % self.maxlen
+            self._masks[i] = self._mask
+            self._values[i] = self._value
+            self._len += 1
+            if self._len > self.max_queued:
+                self.max_queued = self._len
+        self._ready.set()
+        return True
+
+    def __len__(self):
+        return self._len
+
+    async def run(self):
+        """Apply queued commands forever, everything queued at once."""
+        while True:
+            while not self._len:
+                self._ready.clear()
+                await self._ready.wait()
+            mask = value = 0
+            while self._len:
+                m = self._masks[self._head]
+                mask |= m
+                value = (value & ~m) | self._values[self._head]
+                self._head = (self._head + 1) % self.maxlen
+                self._len -= 1
+            self.batches += 1
+            r = self.apply(mask, value)
+            if r is not None:
+                await r
+
+    def metrics(self):
+        return {
+            "received": self.received,
+            "scanned": self.scanned,
+            "invalid": self.invalid,
+            "folded": self.folded,
+            "batches": self.batches,
+            "max_queued": self.max_queued,
+        }
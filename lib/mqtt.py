@@ -0,0 +1,1163 @@
+# forked from: https://github.com/micropython/micropython-lib/tree/master/micropython/umqtt.simple
+import time
+import errno
+import random
+import usocket as socket
+import ustruct as struct
+from ubinascii import hexlify
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+
+class MQTTException(Exception):
+    pass
+
+
+def tls_context(cadata=None):
+    """An SSLContext for ssl=, made once and reused for every connect.
+    cadata (DER) becomes the only trusted certificate: the broker's own
+    self-signed certificate pins the broker, a private CA pins its issuer,
+    and either is checked during the handshake, before anything is sent.
+    Without cadata the link is encrypted but the broker is not verified."""
+    import ssl
+
+    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    if cadata:
+        ctx.verify_mode = ssl.CERT_REQUIRED
+        ctx.load_verify_locations(cadata=cadata)
+    else:
+        if hasattr(ctx, "check_hostname"):  # CPython refuses CERT_NONE otherwise
+            ctx.check_hostname = False
+        ctx.verify_mode = ssl.CERT_NONE
+    return ctx
+
+
+def _wait_writable(s):
+    # For a socket outside uasyncio's streams, until its connect completes
+    yield asyncio.core._io_queue.queue_write(s)
+
+
+def _close(w):
+    # uasyncio's Stream.close() does nothing: closing the socket is what frees
+    # it and wakes a task reading from it. CPython's closes the transport
+    s = getattr(w, "s", None)
+    if s is None:
+        w.close()
+    else:
+        s.close()
+
+
+def _b(s):
+    return s.encode() if isinstance(s, str) else s
+
+
+def _varint(b, i):
+    # Variable byte integer at b[i], returns (value, index after it)
+    n = 0
+    sh = 0
+    while True:
+        c = b[i]
+        i += 1
+        n |= (c & 0x7F) << sh
+        if not c & 0x80:
+            return n, i
+        sh += 7
+
+
+# MQTT 5 property ids by value type, anything else is a single byte
+_PROP_U32 = (0x02, 0x11, 0x18, 0x27)
+_PROP_U16 = (0x13, 0x21, 0x22, 0x23)
+_PROP_STR = (0x03, 0x08, 0x09, 0x12, 0x15, 0x16, 0x1A, 0x1C, 0x1F)
+
+
+def _props(b, i):
+    """MQTT 5 properties at b[i] -> ({id: value}, index after them).
+    Strings and binary data are copied, user properties are skipped."""
+    n, i = _varint(b, i)
+    end = i + n
+    out = {}
+    while i < end:
+        p = b[i]
+        i += 1
+        if p in _PROP_U32:
+            v = b[i] << 24 | b[i + 1] << 16 | b[i + 2] << 8 | b[i + 3]
+            i += 4
+        elif p in _PROP_U16:
+            v = b[i] << 8 | b[i + 1]
+            i += 2
+        elif p == 0x0B:  # subscription identifier
+            v, i = _varint(b, i)
+        elif p in _PROP_STR:
+            k = b[i] << 8 | b[i + 1]
+            v = bytes(b[i + 2 : i + 2 + k])
+            i += 2 + k
+        elif p == 0x26:  # user property, a string pair
+            for _ in range(2):
+                i += 2 + (b[i] << 8 | b[i + 1])
+            continue
+        else:
+            v = b[i]
+            i += 1
+        out[p] = v
+    return out, end
+
+
+# Subscription filters by level, for routing incoming topics to handlers.
+# A node is [children by level, handlers]; "+" and "#" are ordinary child
+# keys, so a lookup visits at most a few branches per topic level.
+class TopicTrie:
+    def __init__(self):
+        self.root = [{}, []]
+
+    def add(self, topic_filter, handler):
+        node = self.root
+        for level in _b(topic_filter).split(b"/"):
+            node = node[0].setdefault(level, [{}, []])
+        if handler not in node[1]:
+            node[1].append(handler)
+
+    def remove(self, topic_filter):
+        # Drop the filter's handlers and prune empty branches
+        path = [self.root]
+        levels = _b(topic_filter).split(b"/")
+        for level in levels:
+            node = path[-1][0].get(level)
+            if node is None:
+                return
+            path.append(node)
+        path[-1][1].clear()
+        for i in range(len(levels) - 1, -1, -1):
+            if path[i + 1][0] or path[i + 1][1]:
+                break
+            del path[i][0][levels[i]]
+
+    def match(self, topic):
+        """Handlers of every filter matching topic, in no particular order."""
+        out = []
+        levels = bytes(topic).split(b"/")
+        # Wildcards don't match topics starting with $ (e.g. $SYS) at the first level
+        self._match(self.root, levels, 0, out, levels[0][:1] != b"$")
+        return out
+
+    def _match(self, node, levels, i, out, wild):
+        children = node[0]
+        if wild:
+            n = children.get(b"#")
+            if n:
+                out.extend(n[1])  # also matches the parent level
+        if i == len(levels):
+            out.extend(node[1])
+            return
+        n = children.get(levels[i])
+        if n:
+            self._match(n, levels, i + 1, out, True)
+        if wild:
+            n = children.get(b"+")
+            if n:
+                self._match(n, levels, i + 1, out, True)
+
+
+# Blocking client, QoS 0 and 1 only: QoS 2, the reusable receive buffer
+# and MQTT 5 are AsyncMQTTClient's, below.
+class MQTTClient:
+    def __init__(
+        self,
+        client_id,
+        server,
+        port=0,
+        user=None,
+        password=None,
+        keepalive=0,
+        ssl=False,
+        ssl_params={},
+        max_missed_pings=2,
+    ):
+        if port == 0:
+            port = 8883 if ssl else 1883
+        self.client_id = client_id
+        self.sock = None
+        self.server = server
+        self.port = port
+        self.ssl = ssl
+        self.ssl_params = ssl_params
+        self.pid = 0
+        self.cb = None
+        self.user = user
+        self.pswd = password
+        self.keepalive = keepalive
+        self.lw_topic = None
+        self.lw_msg = None
+        self.lw_qos = 0
+        self.lw_retain = False
+        self._tls_session = None  # offered on the next connect to skip the full handshake
+        self.tls_handshakes = 0
+        self.tls_resumed = 0
+        self.protocol = 4  # MQTT 3.1.1; AsyncMQTTClient can also speak 5
+        self.max_missed_pings = max_missed_pings
+        self._pings = []  # ticks_ms of PINGREQs not answered yet, oldest first
+        # Round trip estimate from PINGREQ/PINGRESP, smoothed as in RFC 6298
+        self.rtt_ms = None
+        self.srtt_ms = None
+        self.rttvar_ms = None
+        self.dead_links = 0
+        # Outgoing packets are built here whole and sent with one write. Encode
+        # before slicing _omv: a larger packet replaces the buffer.
+        self._obuf = bytearray(128)
+        self._omv = memoryview(self._obuf)
+
+    def _begin(self, op, sz):
+        # Fixed header for a packet with sz bytes after it, returns where the rest goes
+        assert sz < 268435456
+        if len(self._obuf) < sz + 5:
+            self._obuf = bytearray(sz + 5)
+            self._omv = memoryview(self._obuf)
+        b = self._obuf
+        b[0] = op
+        i = 1
+        while sz > 0x7F:
+            b[i] = (sz & 0x7F) | 0x80
+            sz >>= 7
+            i += 1
+        b[i] = sz
+        return i + 1
+
+    def _put(self, i, data):
+        n = len(data)
+        self._obuf[i : i + n] = data
+        return i + n
+
+    def _put_str(self, i, s):
+        struct.pack_into("!H", self._obuf, i, len(s))
+        return self._put(i + 2, s)
+
+    def _ping_sent(self):
+        # False, and the link is dead, once max_missed_pings in a row went unanswered
+        if len(self._pings) >= self.max_missed_pings:
+            self.dead_links += 1
+            return False
+        self._pings.append(time.ticks_ms())
+        return True
+
+    def _pong(self):
+        if not self._pings:
+            return
+        r = time.ticks_diff(time.ticks_ms(), self._pings.pop(0))
+        self.rtt_ms = r
+        if self.srtt_ms is None:
+            self.srtt_ms = r
+            self.rttvar_ms = r // 2
+        else:
+            self.rttvar_ms = (3 * self.rttvar_ms + abs(self.srtt_ms - r)) // 4
+            self.srtt_ms = (7 * self.srtt_ms + r) // 8
+
+    # ssl is an SSLContext, or True for one made here from ssl_params
+    # ("cadata", "server_hostname") on the first connect and then kept
+    def _tls_context(self):
+        if self.ssl is True:
+            self.ssl = tls_context(self.ssl_params.get("cadata"))
+        return self.ssl
+
+    def _tls_hostname(self):
+        return self.ssl_params.get("server_hostname", self.server)
+
+    def _tls_wrap(self, sock, **kw):
+        ctx = self._tls_context()
+        kw["server_hostname"] = self._tls_hostname()
+        if self._tls_session is not None:
+            try:
+                return ctx.wrap_socket(sock, session=self._tls_session, **kw)
+            except TypeError:  # no session resumption in this port
+                self._tls_session = None
+        return ctx.wrap_socket(sock, **kw)
+
+    def _tls_done(self, tls):
+        # After the CONNACK, when the handshake and any session ticket are in
+        self.tls_handshakes += 1
+        if getattr(tls, "session_reused", False):
+            self.tls_resumed += 1
+        self._tls_session = getattr(tls, "session", None)
+
+    def _recv_len(self):
+        n = 0
+        sh = 0
+        while 1:
+            b = self.sock.read(1)[0]
+            n |= (b & 0x7F) << sh
+            if not b & 0x80:
+                return n
+            sh += 7
+
+    def set_callback(self, f):
+        self.cb = f
+
+    def set_last_will(self, topic, msg, retain=False, qos=0):
+        assert 0 <= qos <= 2
+        assert topic
+        self.lw_topic = topic
+        self.lw_msg = msg
+        self.lw_qos = qos
+        self.lw_retain = retain
+
+    # Encode CONNECT into the output buffer, returns its length
+    def _encode_connect(self, clean_session):
+        cid = _b(self.client_id)
+        sz = 10 + 2 + len(cid)
+        v5 = self.protocol == 5
+        if v5:
+            # Session expiry interval, receive maximum
+            props = struct.pack("!BBIBH", 8, 0x11, self.session_expiry_s, 0x21, self.max_inflight)
+            sz += len(props)
+        flags = clean_session << 1
+        if self.user is not None:
+            user = _b(self.user)
+            pswd = _b(self.pswd)
+            sz += 2 + len(user) + 2 + len(pswd)
+            flags |= 0xC0
+        if self.lw_topic:
+            lw_topic = _b(self.lw_topic)
+            lw_msg = _b(self.lw_msg)
+            sz += 2 + len(lw_topic) + 2 + len(lw_msg) + v5
+            flags |= 0x4 | (self.lw_qos & 0x1) << 3 | (self.lw_qos & 0x2) << 3
+            flags |= self.lw_retain << 5
+        assert self.keepalive < 65536
+
+        i = self._begin(0x10, sz)
+        struct.pack_into("!H4sBBH", self._obuf, i, 4, b"MQTT", self.protocol, flags, self.keepalive)
+        i += 10
+        if v5:
+            i = self._put(i, props)
+        i = self._put_str(i, cid)
+        if self.lw_topic:
+            if v5:
+                self._obuf[i] = 0  # no will properties
+                i += 1
+            i = self._put_str(i, lw_topic)
+            i = self._put_str(i, lw_msg)
+        if self.user is not None:
+            i = self._put_str(i, user)
+            i = self._put_str(i, pswd)
+        return i
+
+    # Encode PUBLISH into the output buffer, returns its length.
+    # MQTT 5 only: expiry in seconds, 0 for none; a topic alias, with an
+    # empty topic once the alias is known to the broker.
+    def _encode_publish(self, topic, msg, retain, qos, pid, expiry=0, alias=0):
+        sz = 2 + len(topic) + len(msg)
+        if qos > 0:
+            sz += 2
+        if self.protocol == 5:
+            plen = (5 if expiry else 0) + (3 if alias else 0)
+            sz += 1 + plen
+        i = self._begin(0x30 | qos << 1 | retain, sz)
+        i = self._put_str(i, topic)
+        if qos > 0:
+            struct.pack_into("!H", self._obuf, i, pid)
+            i += 2
+        if self.protocol == 5:
+            self._obuf[i] = plen
+            i += 1
+            if expiry:
+                struct.pack_into("!BI", self._obuf, i, 0x02, expiry)
+                i += 5
+            if alias:
+                struct.pack_into("!BH", self._obuf, i, 0x23, alias)
+                i += 3
+        return self._put(i, msg)
+
+    # Encode SUBSCRIBE for [(topic, qos), ...] into the output buffer, returns its length
+    def _encode_subscribe(self, topics, pid):
+        v5 = self.protocol == 5
+        sz = 2 + v5
+        for topic, qos in topics:
+            sz += 2 + len(topic) + 1
+        i = self._begin(0x82, sz)
+        struct.pack_into("!H", self._obuf, i, pid)
+        i += 2
+        if v5:
+            self._obuf[i] = 0  # no properties
+            i += 1
+        for topic, qos in topics:
+            i = self._put_str(i, topic)
+            self._obuf[i] = qos
+            i += 1
+        return i
+
+    # Encode UNSUBSCRIBE for [topic, ...] into the output buffer, returns its length
+    def _encode_unsubscribe(self, topics, pid):
+        v5 = self.protocol == 5
+        sz = 2 + v5
+        for topic in topics:
+            sz += 2 + len(topic)
+        i = self._begin(0xA2, sz)
+        struct.pack_into("!H", self._obuf, i, pid)
+        i += 2
+        if v5:
+            self._obuf[i] = 0
+            i += 1
+        for topic in topics:
+            i = self._put_str(i, topic)
+        return i
+
+    # addr: socket address already resolved by the caller (e.g. from a
+    # cached resolver). When None, the server name is resolved here.
+    def connect(self, clean_session=True, addr=None):
+        self.sock = socket.socket()
+        if addr is None:
+            addr = socket.getaddrinfo(self.server, self.port)[0][-1]
+        self.sock.connect(addr)
+        if self.ssl:
+            self.sock = self._tls_wrap(self.sock)
+        self._pings = []
+        n = self._encode_connect(clean_session)
+        # print(hex(n), hexlify(self._omv[:n], ":"))
+        self.sock.write(self._omv[:n])
+        resp = self.sock.read(4)
+        assert resp[0] == 0x20 and resp[1] == 0x02
+        if resp[3] != 0:
+            raise MQTTException(resp[3])
+        if self.ssl:
+            self._tls_done(self.sock)
+        return resp[2] & 1
+
+    def disconnect(self):
+        self.sock.write(b"\xe0\0")
+        self.sock.close()
+
+    # Raises OSError when the previous max_missed_pings pings went unanswered
+    def ping(self):
+        if not self._ping_sent():
+            raise OSError(-1)
+        self.sock.write(b"\xc0\0")
+
+    def publish(self, topic, msg, retain=False, qos=0):
+        if qos == 2:
+            raise ValueError("QoS 2 unsupported")
+        pid = 0
+        if qos > 0:
+            self.pid += 1
+            pid = self.pid
+        n = self._encode_publish(_b(topic), _b(msg), retain, qos, pid)
+        # print(hex(n), hexlify(self._omv[:n], ":"))
+        self.sock.write(self._omv[:n])
+        if qos == 1:
+            while 1:
+                op = self.wait_msg()
+                if op == 0x40:
+                    sz = self.sock.read(1)
+                    assert sz == b"\x02"
+                    rcv_pid = self.sock.read(2)
+                    rcv_pid = rcv_pid[0] << 8 | rcv_pid[1]
+                    if pid == rcv_pid:
+                        return
+
+    def subscribe(self, topic, qos=0):
+        assert self.cb is not None, "Subscribe callback is not set"
+        if qos == 2:
+            raise ValueError("QoS 2 unsupported")  # the broker would send QoS 2 messages
+        self.pid += 1
+        n = self._encode_subscribe([(_b(topic), qos)], self.pid)
+        # print(hex(n), hexlify(self._omv[:n], ":"))
+        self.sock.write(self._omv[:n])
+        while 1:
+            op = self.wait_msg()
+            if op == 0x90:
+                resp = self.sock.read(4)
+                # print(resp)
+                assert resp[1] << 8 | resp[2] == self.pid
+                if resp[3] == 0x80:
+                    raise MQTTException(resp[3])
+                return
+
+    # Wait for a single incoming MQTT message and process it.
+    # Subscribed messages are delivered to a callback previously
+    # set by .set_callback() method. Other (internal) MQTT
+    # messages processed internally.
+    def wait_msg(self):
+        res = self.sock.read(1)
+        self.sock.setblocking(True)
+        if res is None:
+            return None
+        if res == b"":
+            raise OSError(-1)
+        if res == b"\xd0":  # PINGRESP
+            sz = self.sock.read(1)[0]
+            assert sz == 0
+            self._pong()
+            return None
+        op = res[0]
+        if op & 0xF0 != 0x30:
+            return op
+        sz = self._recv_len()
+        topic_len = self.sock.read(2)
+        topic_len = (topic_len[0] << 8) | topic_len[1]
+        topic = self.sock.read(topic_len)
+        sz -= topic_len + 2
+        if op & 6:
+            pid = self.sock.read(2)
+            pid = pid[0] << 8 | pid[1]
+            sz -= 2
+        msg = self.sock.read(sz)
+        self.cb(topic, msg)
+        if op & 6 == 2:
+            pkt = bytearray(b"\x40\x02\0\0")
+            struct.pack_into("!H", pkt, 2, pid)
+            self.sock.write(pkt)
+        elif op & 6 == 4:
+            raise ValueError("QoS 2 unsupported")
+        return op
+
+    # Checks whether a pending message from server is available.
+    # If not, returns immediately with None. Otherwise, does
+    # the same processing as wait_msg.
+    def check_msg(self):
+        self.sock.setblocking(False)
+        return self.wait_msg()
+
+
+# MQTTClient on uasyncio streams. run() sleeps until bytes arrive, reads
+# whole packets and delivers PUBLISHes to the callback as soon as they land,
+# so nothing polls and nothing blocks the loop mid-packet. The callback may
+# be a plain function or a coroutine function.
+#
+# Incoming packets are read into one reusable buffer and the callback gets
+# the topic and payload as memoryview slices of it, so receiving allocates
+# next to nothing. The slices are only valid until the callback returns;
+# copy them (bytes(msg)) to keep them. Packets larger than max_packet are
+# skipped.
+#
+# QoS 1 and 2 publishes go into an in-flight window of up to max_inflight
+# packets. publish() returns the packet id as soon as the packet is sent, and
+# the acknowledgement is handled by run(). Anything not acknowledged within
+# retry_ms is sent again, with the DUP flag set.
+#
+# keep_connected() owns the connection: it connects with a persistent
+# session, runs the reader, and reconnects after a jittered exponential
+# backoff whenever the link drops. Subscriptions are remembered and renewed
+# if the broker lost the session; packets in flight are sent again.
+#
+# While run() is reading, a PINGREQ goes out every ping_interval_ms (half
+# the keepalive by default; 0 leaves pinging to the caller, e.g. from a
+# scheduler shared with other periodic jobs). The round trip of each is measured (rtt_ms,
+# srtt_ms, rttvar_ms), and once max_missed_pings in a row go unanswered the
+# link is declared dead and closed, so keep_connected() reconnects instead
+# of waiting for a write to fail.
+#
+# With ssl= a context from tls_context() (or True), the same context is used
+# for every connect and the TLS session of the last connection is offered, so
+# a reconnect usually resumes it instead of repeating the full handshake.
+#
+# Each subscription can have its own handler, called as handler(topic, msg);
+# incoming topics are routed through a TopicTrie, so "+" and "#" filters
+# work. Messages no handler matches go to the set_callback() callback.
+#
+# protocol=5 speaks MQTT 5 instead of 3.1.1:
+# - QoS 0 publishes use topic aliases, so a repeated topic costs 3 bytes
+#   instead of the whole string, up to the broker's topic alias maximum
+# - Publishes carry a message expiry (message_expiry_s, or per publish), so
+#   the broker drops them rather than deliver them late
+# - The session expires session_expiry_s after the connection drops, along
+#   with anything the broker queued for it
+# - The in-flight window is capped at the broker's receive maximum, and ours
+#   (max_inflight) is sent to it; its server keepalive is honoured
+# - Refusals come back as reason codes: a failed SUBACK, PUBACK or PUBREC
+#   raises MQTTException(code), a DISCONNECT from the broker drops the link
+class AsyncMQTTClient(MQTTClient):
+    def __init__(
+        self,
+        *args,
+        max_inflight=8,
+        retry_ms=5000,
+        rx_size=512,
+        max_packet=8192,
+        protocol=4,
+        message_expiry_s=0,
+        session_expiry_s=3600,
+        ping_interval_ms=None,
+        **kw
+    ):
+        super().__init__(*args, **kw)
+        self.ping_interval_ms = ping_interval_ms
+        assert protocol in (4, 5)
+        self.protocol = protocol
+        self.message_expiry_s = message_expiry_s
+        self.session_expiry_s = session_expiry_s
+        self.max_inflight = max_inflight
+        self._send_max = max_inflight  # lowered to the broker's receive maximum
+        self._alias_max = 0  # broker's topic alias maximum
+        self._aliases = {}  # topic -> alias, for this connection only
+        self.retry_ms = retry_ms
+        self.max_packet = max_packet
+        self.reader = None
+        self.writer = None
+        self._tls = None  # the wrapped socket, when wrapped here
+        self._rbuf = bytearray(rx_size)
+        self._rmv = memoryview(self._rbuf)
+        self._rpos = 0  # start of the current packet
+        self._rnext = 0  # start of the next one
+        self._rend = 0  # end of buffered data
+        self._connected = False
+        self._reading = False
+        self._rlock = asyncio.Lock()  # one reader at a time, run() or a waiter
+        self._wlock = asyncio.Lock()  # one packet written at a time, see _send()
+        self._waiting = {}  # (packet type, pid) -> [Event, packet body]
+        self._inflight = {}  # pid -> [packet, awaited ack type, sent ticks_ms, Event or None]
+        self._window = asyncio.Event()  # set whenever a window slot frees up
+        self._queued = asyncio.Event()  # set when a packet goes in flight
+        self._qos2_rx = set()  # pids of QoS 2 messages delivered but not yet released
+        self._subs = {}  # topic filter -> qos, renewed on reconnect
+        self._handlers = TopicTrie()
+        self._up = asyncio.Event()  # set while connected
+
+        # Metrics
+        self.retransmits = 0
+        self.oversized = 0
+        self.reconnects = 0
+        self.refused = 0
+        self.last_error = None  # why the last connection ended or failed
+
+    async def _readinto(self, mv):
+        r = self.reader
+        if hasattr(r, "readinto"):
+            return await r.readinto(mv)
+        data = await r.read(len(mv))  # CPython streams have no readinto
+        mv[: len(data)] = data
+        return len(data)
+
+    async def _fill(self, need):
+        # Make sure `need` bytes from _rpos on are in the buffer
+        buf = self._rbuf
+        if self._rpos + need > len(buf):
+            k = self._rend - self._rpos
+            if need > len(buf):
+                nb = bytearray(need)
+                nb[:k] = self._rmv[self._rpos : self._rend]
+                self._rbuf = buf = nb
+                self._rmv = memoryview(nb)
+            else:
+                for j in range(k):  # move the partial packet to the front
+                    buf[j] = buf[self._rpos + j]
+            self._rpos = 0
+            self._rend = k
+        while self._rend - self._rpos < need:
+            n = await self._readinto(self._rmv[self._rend :])
+            if not n:
+                raise OSError(-1)  # connection closed by the broker
+            self._rend += n
+
+    async def _skip(self, n):
+        # Discard n bytes without growing the buffer
+        while True:
+            k = min(n, self._rend - self._rpos)
+            self._rpos += k
+            n -= k
+            if not n:
+                return
+            self._rpos = self._rend = 0
+            await self._fill(1)
+
+    async def _next(self):
+        """Read the next packet. Returns (first byte, body memoryview); the
+        view is only valid until the next call."""
+        while True:
+            self._rpos = self._rnext
+            if self._rpos == self._rend:
+                self._rpos = self._rend = 0
+            i = 1
+            n = 0
+            sh = 0
+            while True:
+                await self._fill(i + 1)
+                b = self._rbuf[self._rpos + i]
+                n |= (b & 0x7F) << sh
+                i += 1
+                if not b & 0x80:
+                    break
+                sh += 7
+                if i > 4:
+                    raise OSError(-1)  # malformed remaining length, the stream is lost
+            if i + n <= self.max_packet:
+                break
+            self.oversized += 1
+            await self._skip(i + n)
+            self._rnext = self._rpos
+        await self._fill(i + n)
+        p = self._rpos
+        self._rnext = p + i + n
+        return self._rbuf[p], self._rmv[p + i : p + i + n]
+
+    # host: server address already resolved by the caller (e.g. from a
+    # cached resolver). When None, the server name is resolved here.
+    async def _open(self, host):
+        if not self.ssl:
+            return await asyncio.open_connection(host, self.port)
+        if not hasattr(asyncio, "Stream"):  # CPython's asyncio wraps the socket itself, without resumption
+            return await asyncio.open_connection(
+                host, self.port, ssl=self._tls_context(), server_hostname=self._tls_hostname()
+            )
+        # uasyncio.open_connection, but wrapping the socket here so the last session can be offered
+        ai = socket.getaddrinfo(host, self.port, 0, socket.SOCK_STREAM)[0]
+        s = socket.socket(ai[0], ai[1], ai[2])
+        s.setblocking(False)
+        try:
+            s.connect(ai[-1])
+        except OSError as e:
+            if e.errno != errno.EINPROGRESS:
+                raise
+        s = self._tls_wrap(s, do_handshake_on_connect=False)
+        s.setblocking(False)
+        self._tls = s
+        st = asyncio.Stream(s)
+        await _wait_writable(s)
+        return st, st
+
+    async def _send(self, pkt):
+        # Every task writes through here, so their packets can't interleave
+        # on the wire. pkt may be a view of _obuf, which the next encode
+        # overwrites: it is copied if it has to wait for the lock
+        if self._wlock.locked():
+            pkt = bytes(pkt)
+        async with self._wlock:
+            self.writer.write(pkt)
+            await self.writer.drain()
+
+    async def connect(self, clean_session=True, host=None):
+        self._tls = None
+        self.reader, self.writer = await self._open(host or self.server)
+        self._rpos = self._rnext = self._rend = 0
+        self._pings = []
+        n = self._encode_connect(clean_session)
+        await self._send(self._omv[:n])
+        op, resp = await self._next()
+        assert op == 0x20
+        if resp[1] != 0:
+            raise MQTTException(resp[1])
+        if self.ssl:
+            self._tls_done(self._tls or self.writer.get_extra_info("ssl_object"))
+        self._aliases = {}
+        if self.protocol == 5:
+            props = _props(resp, 2)[0]
+            self._send_max = min(self.max_inflight, props.get(0x21, 65535))
+            self._alias_max = props.get(0x22, 0)
+            self.keepalive = props.get(0x13, self.keepalive)
+        self._connected = True
+        return resp[0] & 1
+
+    async def disconnect(self):
+        try:
+            await self._send(b"\xe0\0")
+        finally:
+            self.close()
+
+    def close(self):
+        if self.writer:
+            _close(self.writer)
+        self.reader = self.writer = None
+        self._connected = False
+        self._up.clear()
+
+    def isconnected(self):
+        return self._connected
+
+    async def wait_connected(self):
+        await self._up.wait()
+
+    async def ping(self):
+        """Send a PINGREQ. Once max_missed_pings in a row went unanswered,
+        closes the connection instead and raises OSError."""
+        if not self._ping_sent():
+            _close(self.writer)  # wakes the reader, so run() ends
+            raise OSError(-1)
+        await self._send(b"\xc0\0")
+
+    async def _pinger(self):
+        interval = self.keepalive * 500 if self.ping_interval_ms is None else self.ping_interval_ms
+        if not interval:
+            return
+        while True:
+            await asyncio.sleep_ms(interval)
+            try:
+                await self.ping()
+            except OSError:
+                return  # dead or dropped, run() is ending
+
+    async def _wait(self, ev):
+        # Set by run() when it is reading, otherwise read packets here until it is
+        while not ev.is_set():
+            if not self._connected:
+                raise OSError(-1)
+            if self._reading:
+                await ev.wait()
+            else:
+                async with self._rlock:
+                    if not ev.is_set() and not self._reading:
+                        await self._read_packet()
+
+    async def _wait_ack(self, op, pid):
+        w = [asyncio.Event(), None]
+        self._waiting[(op, pid)] = w
+        try:
+            await self._wait(w[0])
+        finally:
+            self._waiting.pop((op, pid), None)
+        if w[1] is None:
+            raise OSError(-1)  # connection lost while waiting
+        return w[1]
+
+    def _next_pid(self):
+        while True:
+            self.pid = self.pid % 65535 + 1
+            if self.pid not in self._inflight:
+                return self.pid
+
+    async def publish(self, topic, msg, retain=False, qos=0, expiry_s=None):
+        """Send a PUBLISH. For QoS 1 and 2, waits for a free window slot and
+        returns the packet id; wait_delivered(pid) waits for the handshake.
+        expiry_s overrides message_expiry_s, MQTT 5 only."""
+        if not self._connected:
+            raise OSError(-1)
+        topic = _b(topic)
+        msg = _b(msg)
+        expiry = self.message_expiry_s if expiry_s is None else expiry_s
+        if qos == 0:
+            alias = 0
+            if self._alias_max:
+                alias = self._aliases.get(topic, 0)
+                if alias:
+                    topic = b""
+                elif len(self._aliases) < self._alias_max:
+                    alias = self._aliases[topic] = len(self._aliases) + 1
+            n = self._encode_publish(topic, msg, retain, 0, 0, expiry, alias)
+            await self._send(self._omv[:n])
+            return None
+
+        # Packets in flight may be resent after a reconnect, when the
+        # aliases are gone, so they always carry the topic
+        while len(self._inflight) >= self._send_max:
+            self._window.clear()
+            await self._wait(self._window)
+        if not self._connected:
+            raise OSError(-1)
+        pid = self._next_pid()
+        n = self._encode_publish(topic, msg, retain, qos, pid, expiry)
+        pkt = bytearray(self._omv[:n])  # kept for retransmission
+        self._inflight[pid] = [pkt, 0x40 if qos == 1 else 0x50, time.ticks_ms(), None, 0]
+        self._queued.set()
+        await self._send(pkt)
+        return pid
+
+    async def wait_delivered(self, pid):
+        """Wait until the QoS 1/2 publish with this pid is acknowledged. Raises OSError if the connection
+        drops first, MQTTException(reason code) if an MQTT 5 broker refuses it."""
+        e = self._inflight.get(pid)
+        if e is None:
+            return
+        if e[3] is None:
+            e[3] = asyncio.Event()
+        await self._wait(e[3])
+        if self._inflight.get(pid) is e:
+            raise OSError(-1)
+        if e[4] >= 0x80:
+            raise MQTTException(e[4])
+
+    def _delivered(self, pid, reason=0):
+        e = self._inflight.pop(pid)
+        e[4] = reason
+        if reason >= 0x80:
+            self.refused += 1
+        if e[3]:
+            e[3].set()
+        self._window.set()
+
+    async def subscribe(self, topic, qos=0, handler=None):
+        """Subscribe now if connected. Either way the subscription is renewed by keep_connected()."""
+        await self.subscribe_many([(topic, qos, handler)])
+
+    async def subscribe_many(self, subs):
+        """Subscribe to [(topic filter, qos, handler or None), ...] with one SUBSCRIBE."""
+        topics = []
+        for topic, qos, handler in subs:
+            assert handler or self.cb is not None, "Subscribe callback is not set"
+            topic = _b(topic)
+            self._subs[topic] = qos
+            if handler:
+                self._handlers.add(topic, handler)
+            topics.append((topic, qos))
+        if self._connected:
+            await self._subscribe(topics)
+
+    async def _subscribe(self, topics):
+        pid = self._next_pid()
+        n = self._encode_subscribe(topics, pid)
+        await self._send(self._omv[:n])
+        resp = await self._wait_ack(0x90, pid)
+        # One return code per filter, 0x80 and up for a refused one
+        j = _props(resp, 2)[1] if self.protocol == 5 else 2
+        for i in range(j, len(resp)):
+            if resp[i] >= 0x80:
+                raise MQTTException(resp[i], topics[i - j][0])
+
+    async def unsubscribe(self, *topics):
+        """Unsubscribe from one or more topic filters with one UNSUBSCRIBE, and drop their handlers."""
+        topics = [_b(t) for t in topics]
+        for topic in topics:
+            self._subs.pop(topic, None)
+            self._handlers.remove(topic)
+        if self._connected:
+            pid = self._next_pid()
+            n = self._encode_unsubscribe(topics, pid)
+            await self._send(self._omv[:n])
+            await self._wait_ack(0xB0, pid)
+
+    # Read one whole packet and process it. Returns the packet type.
+    async def _read_packet(self):
+        op, body = await self._next()
+        t = op & 0xF0
+        if t == 0x30:
+            await self._on_publish(op, body)
+            return op
+        if t == 0xD0:  # PINGRESP
+            self._pong()
+            return op
+        if t == 0xE0:  # MQTT 5 broker closing the connection, with a reason code
+            raise MQTTException(body[0] if body else 0)
+        pid = body[0] << 8 | body[1]
+        rc = body[2] if len(body) > 2 else 0  # MQTT 5 reason code
+        e = self._inflight.get(pid)
+        if t == 0x40 or t == 0x70:  # PUBACK, PUBCOMP
+            if e and e[1] == t:
+                self._delivered(pid, rc)
+        elif t == 0x50 and rc >= 0x80:  # PUBREC refusing it ends the exchange
+            if e and e[1] == 0x50:
+                self._delivered(pid, rc)
+        elif t == 0x50:  # PUBREC: the broker has it, release it
+            if e and e[1] != 0x40:
+                e[0] = bytearray(struct.pack("!BBH", 0x62, 2, pid))
+                e[1] = 0x70
+                e[2] = time.ticks_ms()
+            await self._send(struct.pack("!BBH", 0x62, 2, pid))
+        elif t == 0x60:  # PUBREL for a QoS 2 message we received
+            self._qos2_rx.discard(pid)
+            await self._send(struct.pack("!BBH", 0x70, 2, pid))
+        else:  # SUBACK and friends
+            w = self._waiting.get((t, pid))
+            if w:
+                w[1] = bytes(body)  # the buffer is reused
+                w[0].set()
+        return op
+
+    async def _on_publish(self, op, body):
+        topic_len = body[0] << 8 | body[1]
+        topic = body[2 : 2 + topic_len]
+        i = 2 + topic_len
+        qos = (op >> 1) & 3
+        if qos:
+            pid = body[i] << 8 | body[i + 1]
+            i += 2
+        if self.protocol == 5:
+            n, i = _varint(body, i)
+            i += n  # properties, nothing here needs them
+        # A QoS 2 message is delivered once, however often the broker resends it before PUBREL
+        if qos < 2 or pid not in self._qos2_rx:
+            msg = body[i:]
+            handlers = self._handlers.match(topic)
+            if not handlers and self.cb:
+                handlers = (self.cb,)
+            for f in handlers:
+                r = f(topic, msg)
+                if r is not None:
+                    await r
+        if qos == 1:
+            await self._send(struct.pack("!BBH", 0x40, 2, pid))
+        elif qos == 2:
+            self._qos2_rx.add(pid)
+            await self._send(struct.pack("!BBH", 0x50, 2, pid))
+
+    async def _retransmit(self):
+        while True:
+            if not self._inflight:  # don't wake the CPU for nothing
+                self._queued.clear()
+                await self._queued.wait()
+            await asyncio.sleep_ms(self.retry_ms // 2)
+            async with self._wlock:
+                now = time.ticks_ms()
+                for e in list(self._inflight.values()):
+                    if time.ticks_diff(now, e[2]) < self.retry_ms:
+                        continue
+                    pkt = e[0]
+                    if pkt[0] & 0xF0 == 0x30:
+                        pkt[0] |= 0x08  # DUP
+                    e[2] = now
+                    self.retransmits += 1
+                    self.writer.write(pkt)
+                await self.writer.drain()
+
+    async def _resend(self):
+        async with self._wlock:
+            for e in self._inflight.values():
+                pkt = e[0]
+                if pkt[0] & 0xF0 == 0x30:
+                    pkt[0] |= 0x08  # DUP
+                e[2] = time.ticks_ms()
+                self.writer.write(pkt)
+            await self.writer.drain()
+
+    async def keep_connected(self, lookup=None, min_backoff_ms=1000, max_backoff_ms=60000, timeout_ms=10000):
+        """Connect and stay connected, never returns. lookup(host) resolves the
+        server name each time, e.g. Resolver.lookup."""
+        backoff = min_backoff_ms
+        first = True
+        while True:
+            try:
+                host = await lookup(self.server) if lookup else None
+                present = await asyncio.wait_for_ms(self.connect(False, host), timeout_ms)
+                if not present:
+                    self._qos2_rx.clear()
+                if (first or not present) and self._subs:
+                    await self._subscribe(list(self._subs.items()))
+                await self._resend()
+                first = False
+                backoff = min_backoff_ms
+                self._up.set()
+                await self.run()
+            except Exception as e:  # dropped, refused or timed out, try again
+                self.last_error = repr(e)
+            self.close()
+            self.reconnects += 1
+            await asyncio.sleep_ms(random.randint(backoff // 2, backoff))
+            backoff = min(backoff * 2, max_backoff_ms)
+
+    # Process incoming packets until the connection drops, then raise OSError.
+    async def run(self):
+        self._reading = True
+        retry = asyncio.create_task(self._retransmit())
+        pinger = asyncio.create_task(self._pinger())
+        try:
+            while True:
+                async with self._rlock:
+                    await self._read_packet()
+        finally:
+            self._reading = False
+            self._connected = False
+            retry.cancel()
+            pinger.cancel()
+            for w in self._waiting.values():
+                w[0].set()
+            for e in self._inflight.values():
+                if e[3]:
+                    e[3].set()
+            self._window.set()
+
+    def metrics(self):
+        return {
+            "connected": self._connected,
+            "rtt_ms": self.rtt_ms,
+            "srtt_ms": self.srtt_ms,
+            "rttvar_ms": self.rttvar_ms,
+            "unanswered_pings": len(self._pings),
+            "dead_links": self.dead_links,
+            "reconnects": self.reconnects,
+            "inflight": len(self._inflight),
+            "retransmits": self.retransmits,
+            "refused": self.refused,
+            "oversized": self.oversized,
+            "last_error": self.last_error,
+            "tls_handshakes": self.tls_handshakes,
+            "tls_resumed": self.tls_resumed,
+        }
+
+
+# Outgoing publishes, drained by one writer task (run()). Only the newest
+# message per topic is kept, so a burst of updates to one topic costs one
+# publish. Sending is limited by a token bucket of `rate` publishes a second
+# with bursts of up to `burst`. Queued payloads are capped at max_bytes and
+# max_items; the oldest topics are dropped to make room. While the client is
+# offline messages stay queued, within the same limits, until it reconnects.
+class PublishQueue:
+    def __init__(self, client, rate=5, burst=10, max_bytes=4096, max_items=32):
+        self.client = client
+        self.rate = rate
+        self.burst = burst
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self._topics = []  # oldest first
+        self._msgs = {}  # topic -> (msg, retain, qos, expiry_s)
+        self._bytes = 0
+        self._tokens = burst
+        self._t = time.ticks_ms()
+        self._ready = asyncio.Event()
+
+        # Metrics
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def put(self, topic, msg, retain=False, qos=0, expiry_s=None):
+        """Queue msg for topic, replacing anything still queued for it. Never blocks.
+        expiry_s overrides the client's message_expiry_s (MQTT 5). msg is kept, not
+        copied, until sent, so a reused buffer must only be refilled for the same topic."""
+        old = self._msgs.get(topic)
+        if old:
+            self._bytes -= len(old[0])
+            self.coalesced += 1
+        else:
+            self._topics.append(topic)
+        self._msgs[topic] = (msg, retain, qos, expiry_s)
+        self._bytes += len(msg)
+        while (self._bytes > self.max_bytes or len(self._topics) > self.max_items) and len(self._topics) > 1:
+            t = self._topics[0] if self._topics[0] != topic else self._topics[1]
+            self._topics.remove(t)
+            self._bytes -= len(self._msgs.pop(t)[0])
+            self.dropped += 1
+        self._ready.set()
+
+    def __len__(self):
+        return len(self._topics)
+
+    async def _take_token(self):
+        while True:
+            now = time.ticks_ms()
+            self._tokens = min(self.burst, self._tokens + time.ticks_diff(now, self._t) * self.rate / 1000)
+            self._t = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep_ms(int((1 - self._tokens) * 1000 / self.rate) + 1)
+
+    # Send queued messages forever. A failed publish is put back (unless a
+    # newer message for the topic arrived meanwhile) and sent after reconnect.
+    async def run(self):
+        while True:
+            while not self._topics:
+                self._ready.clear()
+                await self._ready.wait()
+            if not self.client.isconnected():
+                await self.client.wait_connected()
+                continue
+            await self._take_token()
+            topic = self._topics.pop(0)
+            m = self._msgs.pop(topic)
+            self._bytes -= len(m[0])
+            try:
+                await self.client.publish(topic, *m)
+            except OSError:
+                if topic not in self._msgs:
+                    self._topics.insert(0, topic)
+                    self._msgs[topic] = m
+                    self._bytes += len(m[0])
+                self.failed += 1
+                continue
+            self.sent += 1
+
+    def metrics(self):
+        return {
+            "queued": len(self._topics),
+            "bytes": self._bytes,
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+            "failed": self.failed,
+        }
@@ -0,0 +1,255 @@
+# ntp.py
+# Asynchronous SNTP client shared by the rp2040 and esp32-s2 firmware.
+# - Queries several servers without blocking the event loop
+# - Keeps the sample with the lowest round-trip delay
+# - Keeps a ms clock on ticks_ms, so offsets are not limited by RTC resolution
+# - Estimates drift between syncs and slews the ms clock in small increments;
+#   the RTC is only stepped once it is STEP_MS or more away from it
+# - Resyncs on an adaptive schedule
+
+import time
+import struct
+from time import gmtime
+
+try:
+    import usocket as socket
+except ImportError:
+    import socket
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+# (date(2000, 1, 1) - date(1900, 1, 1)).days * 24*60*60
+# (date(1970, 1, 1) - date(1900, 1, 1)).days * 24*60*60
+NTP_DELTA = 3155673600 if gmtime(0)[0] == 2000 else 2208988800
+
+MIN_INTERVAL_S = 1024  # ~17 min, first resyncs
+MAX_INTERVAL_S = 36 * 3600  # resync interval once drift is under control
+RETRY_S = 60  # after a failed sync
+STEP_MS = 500  # RTC error that triggers a step
+SLEW_CHECK_MS = 60000  # how often the drift correction is applied
+REBASE_MS = 24 * 3600 * 1000  # keep ticks_diff well inside its range
+MAX_DRIFT_PPM = 500  # larger offsets are treated as clock steps, not drift
+
+
+def epoch_ms():
+    """Local RTC time in ms since the port epoch. Only as fine as the RTC."""
+    try:
+        return time.time_ns() // 1000000
+    except AttributeError:
+        return time.time() * 1000
+
+
+def _ntp_ms(msg, i):
+    # 64 bit NTP timestamp -> ms since the port epoch
+    sec, frac = struct.unpack_from("!II", msg, i)
+    return (sec - NTP_DELTA) * 1000 + ((frac * 1000) >> 32)
+
+
+class NTPClient:
+    def __init__(
+        self,
+        servers,
+        rtc,
+        utc_offset_hrs=0,
+        samples=2,
+        timeout_ms=1000,
+        min_interval_s=MIN_INTERVAL_S,
+        max_interval_s=MAX_INTERVAL_S,
+        resolver=None,
+    ):
+        if isinstance(servers, str):
+            servers = [servers]
+        self.servers = servers
+        self.rtc = rtc
+        self.tz_ms = int(utc_offset_hrs * 3600000)
+        self.samples = samples
+        self.timeout_ms = timeout_ms
+        self.min_interval_s = min_interval_s
+        self.max_interval_s = max_interval_s
+        self.resolver = resolver
+        self.interval_s = min_interval_s
+        self._pkt = bytearray(48)
+
+        # Metrics
+        self.offset_ms = 0
+        self.delay_ms = 0
+        self.jitter_ms = 0
+        self.drift_ppm = 0.0
+        self.steps = 0
+        self.syncs = 0
+        self.failures = 0
+
+        # ms clock: _base_ms at ticks _base_ticks, advanced by ticks_ms
+        self._base_ms = None
+        self._base_ticks = 0
+        self._rtc_err_ms = 0  # corrections not yet written to the RTC
+        self._synced_at = None  # ticks_ms of last successful sync
+        self._slewed_ms = 0  # drift corrections applied since then
+
+    def now_ms(self):
+        """Local time in ms since the port epoch, with ticks_ms resolution."""
+        t = time.ticks_ms()
+        if self._base_ms is None:
+            self._base_ms = epoch_ms()
+            self._base_ticks = t
+            return self._base_ms
+        d = time.ticks_diff(t, self._base_ticks)
+        if d > REBASE_MS:
+            self._base_ms += d
+            self._base_ticks = t
+            d = 0
+        return self._base_ms + d
+
+    def _adjust(self, delta_ms):
+        self.now_ms()
+        self._base_ms += delta_ms
+        self._rtc_err_ms += delta_ms
+
+    async def _write_rtc(self):
+        """Set the RTC from the ms clock, landing on a whole second boundary."""
+        wait = (1000 - self.now_ms() % 1000) % 1000
+        if wait:
+            await asyncio.sleep_ms(wait)
+        # rtc.datetime takes (year, month, day, weekday, hours, minutes, seconds, subseconds)
+        dt = gmtime((self.now_ms() + 500) // 1000)  # (Y,M,D,h,m,s,wday,yday)
+        self.rtc.datetime((dt[0], dt[1], dt[2], dt[6], dt[3], dt[4], dt[5], 0))
+        self._rtc_err_ms = 0
+        self.steps += 1
+
+    async def _query(self, addr):
+        """Single request/response. Returns (offset_ms, delay_ms) or None."""
+        pkt = self._pkt
+        for i in range(48):
+            pkt[i] = 0
+        pkt[0] = 0x1B  # LI=0, VN=3, mode=3 (client)
+        t1 = self.now_ms()
+        # Our transmit time is echoed back as the originate timestamp
+        struct.pack_into(
+            "!II", pkt, 40, (t1 // 1000 + NTP_DELTA) & 0xFFFFFFFF, ((t1 % 1000) << 32) // 1000
+        )
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.setblocking(False)
+        try:
+            k1 = time.ticks_ms()
+            s.sendto(pkt, addr)
+            msg = await asyncio.wait_for_ms(asyncio.StreamReader(s).read(48), self.timeout_ms)
+            k4 = time.ticks_ms()
+        except (OSError, asyncio.TimeoutError):
+            return None
+        finally:
+            s.close()
+
+        if not msg or len(msg) < 48:
+            return None
+        # Server mode, not a kiss-o'-death, not unsynchronised, answers our request
+        if msg[0] & 0x07 != 4 or msg[1] == 0 or msg[0] >> 6 == 3:
+            return None
+        if msg[24:32] != pkt[40:48]:
+            return None
+
+        t2 = _ntp_ms(msg, 32) + self.tz_ms
+        t3 = _ntp_ms(msg, 40) + self.tz_ms
+        t4 = t1 + time.ticks_diff(k4, k1)
+        delay = (t4 - t1) - (t3 - t2)
+        offset = ((t2 - t1) + (t3 - t4)) // 2
+        return offset, max(delay, 0)
+
+    async def sync(self):
+        """Query all servers and correct the clock to the best sample. Returns True on success."""
+        offsets = []
+        best = None
+        for host in self.servers:
+            try:
+                if self.resolver:
+                    addr = await self.resolver.resolve(host, 123)
+                else:
+                    addr = socket.getaddrinfo(host, 123)[0][-1]
+            except OSError:
+                continue
+            for _ in range(self.samples):
+                r = await self._query(addr)
+                if r is None:
+                    continue
+                offsets.append(r[0])
+                if best is None or r[1] < best[1]:
+                    best = r
+
+        if best is None:
+            self.failures += 1
+            return False
+
+        offset, delay = best
+        n = len(offsets)
+        self.jitter_ms = int((sum((o - offset) ** 2 for o in offsets) / n) ** 0.5)
+        self.offset_ms = offset
+        self.delay_ms = delay
+
+        # Drift is the error accumulated since the last sync, including what was slewed
+        if self._synced_at is not None:
+            elapsed = time.ticks_diff(time.ticks_ms(), self._synced_at)
+            drift = offset + self._slewed_ms
+            if elapsed > 60000 and abs(drift) * 1000000 < MAX_DRIFT_PPM * elapsed:
+                ppm = drift * 1000000 / elapsed
+                self.drift_ppm = (self.drift_ppm + ppm) / 2 if self.drift_ppm else ppm
+
+        self._adjust(offset)
+        if abs(self._rtc_err_ms) >= STEP_MS or not self.syncs:
+            await self._write_rtc()
+        self._synced_at = time.ticks_ms()
+        self._slewed_ms = 0
+        self.syncs += 1
+        return True
+
+    async def _hold(self, secs):
+        """Wait until the next sync, slewing the ms clock by the estimated drift."""
+        t0 = time.ticks_ms()
+        wait_ms = secs * 1000
+        while True:
+            rem = wait_ms - time.ticks_diff(time.ticks_ms(), t0)
+            if rem <= 0:
+                return
+            await asyncio.sleep_ms(min(rem, SLEW_CHECK_MS))
+            self.now_ms()  # rebase if needed
+            if self._synced_at is None or not self.drift_ppm:
+                continue
+            elapsed = time.ticks_diff(time.ticks_ms(), self._synced_at)
+            due = int(self.drift_ppm * elapsed / 1000000) - self._slewed_ms
+            if due:
+                self._adjust(due)
+                self._slewed_ms += due
+            if abs(self._rtc_err_ms) >= STEP_MS:
+                await self._write_rtc()
+
+    async def run(self):
+        """Resync forever. Call sync() first if the RTC must be set before other tasks start."""
+        if self._synced_at is not None:
+            await self._hold(self.interval_s)
+        while True:
+            if await self.sync():
+                # Back off while the clock stays close, tighten up after a large correction
+                if abs(self.offset_ms) < STEP_MS:
+                    self.interval_s = min(self.interval_s * 2, self.max_interval_s)
+                else:
+                    self.interval_s = self.min_interval_s
+                await self._hold(self.interval_s)
+            else:
+                await self._hold(RETRY_S)
+
+    def metrics(self):
+        age = None
+        if self._synced_at is not None:
+            age = time.ticks_diff(time.ticks_ms(), self._synced_at) // 1000
+        return {
+            "offset_ms": self.offset_ms,
+            "delay_ms": self.delay_ms,
+            "jitter_ms": self.jitter_ms,
+            "drift_ppm": self.drift_ppm,
+            "interval_s": self.interval_s,
+            "age_s": age,
+            "syncs": self.syncs,
+            "steps": self.steps,
+            "failures": self.failures,
+        }
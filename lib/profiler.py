@@ -0,0 +1,118 @@
+# profiler.py
+# Where the event loop's time goes, per task.
+# - create_task(coro, name) runs coro wrapped so each step, the run from one
+#   await to the next, is timed with ticks_us
+# - Per task: steps, total run time and the longest step. Nothing else runs
+#   during a step, so that is the longest the task blocked the loop (a
+#   blocking getaddrinfo, a gc.collect(), a synchronous write)
+# - How late each wake came after the task was due: its timer, or the poll
+#   that found its socket ready. MicroPython only, CPython's loop doesn't
+#   keep a task's due time
+# - stats() for a report, dump() prints one
+# - With enabled=False, create_task() is asyncio.create_task() and costs nothing
+
+import time
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+try:
+    from collections.abc import Coroutine as _Base  # CPython's create_task() wants one
+except ImportError:
+    _Base = object
+
+
+class _Stats:
+    def __init__(self):
+        self.steps = 0
+        self.run_us = 0
+        self.max_us = 0
+        self.late_ms = 0  # summed, over the steps it was known for
+        self.max_late_ms = 0
+
+
+class _Timed(_Base):
+    def __init__(self, coro, s):
+        self.coro = coro
+        self.s = s
+
+    def send(self, v):
+        return self._step(self.coro.send, v)
+
+    def throw(self, *a):
+        return self._step(self.coro.throw, *a)
+
+    def close(self):
+        self.coro.close()
+
+    def __await__(self):
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.send(None)
+
+    def _step(self, f, a, *more):
+        s = self.s
+        due = getattr(asyncio.current_task(), "ph_key", None)
+        t0 = time.ticks_us()
+        if due is not None:
+            late = time.ticks_diff(time.ticks_ms(), due)
+            if late > 0:
+                s.late_ms += late
+                if late > s.max_late_ms:
+                    s.max_late_ms = late
+        try:
+            return f(a, *more)
+        finally:
+            dt = time.ticks_diff(time.ticks_us(), t0)
+            s.steps += 1
+            s.run_us += dt
+            if dt > s.max_us:
+                s.max_us = dt
+
+
+class Profiler:
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._tasks = {}  # name -> _Stats
+
+    def wrap(self, coro, name):
+        """coro, timed under name. Tasks of the same name are counted together."""
+        if not self.enabled:
+            return coro
+        s = self._tasks.get(name)
+        if s is None:
+            s = self._tasks[name] = _Stats()
+        return _Timed(coro, s)
+
+    def create_task(self, coro, name):
+        return asyncio.create_task(self.wrap(coro, name))
+
+    def reset(self):
+        for s in self._tasks.values():
+            s.__init__()
+
+    def stats(self):
+        out = {}
+        for name, s in self._tasks.items():
+            out[name] = {
+                "steps": s.steps,
+                "run_ms": s.run_us // 1000,
+                "max_step_us": s.max_us,
+                "avg_late_ms": s.late_ms // s.steps if s.steps else 0,
+                "max_late_ms": s.max_late_ms,
+            }
+        return out
+
+    def dump(self):
+        print("%-12s %8s %8s %12s %12s %12s" % ("task", "steps", "run ms", "max step us", "avg late ms", "max late ms"))
+        for name, s in self.stats().items():
+            print(
+                "%-12s %8d %8d %12d %12d %12d"
+                % (name, s["steps"], s["run_ms"], s["max_step_us"], s["avg_late_ms"], s["max_late_ms"])
+            )
@@ -0,0 +1,147 @@
+# resolver.py
+# Cached, non-blocking DNS resolution shared by the rp2040 and esp32-s2 firmware.
+# - A record queries go over UDP straight to the DNS server and are awaited,
+#   so a slow resolver never stalls the event loop
+# - Answers are cached for their TTL
+# - The last known address is served when the DNS server cannot be reached
+# - Nothing here blocks: a host that has never resolved raises OSError
+
+import time
+import struct
+
+try:
+    import usocket as socket
+except ImportError:
+    import socket
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+MIN_TTL_S = 60
+MAX_TTL_S = 24 * 3600
+
+
+def _is_ip(host):
+    parts = host.split(".")
+    if len(parts) != 4:
+        return False
+    for p in parts:
+        if not p.isdigit() or int(p) > 255:
+            return False
+    return True
+
+
+def _skip_name(msg, i):
+    # Skip a (possibly compressed) domain name, return index after it
+    while True:
+        n = msg[i]
+        if n == 0:
+            return i + 1
+        if n & 0xC0 == 0xC0:
+            return i + 2
+        i += n + 1
+
+
+class Resolver:
+    def __init__(self, dns_server=None, timeout_ms=1500, retries=2):
+        self.dns_server = dns_server  # e.g. wlan.ifconfig()[3]
+        self.timeout_ms = timeout_ms
+        self.retries = retries
+        self._cache = {}  # host -> [ip, expires ticks_ms]
+        self._id = time.ticks_ms() & 0xFFFF
+
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.failures = 0
+
+    def _request(self, host, qid):
+        q = bytearray(struct.pack("!HHHHHH", qid, 0x0100, 1, 0, 0, 0))  # RD, 1 question
+        for label in host.split("."):
+            q.append(len(label))
+            q.extend(label.encode())
+        q.extend(b"\0\0\x01\0\x01")  # root, QTYPE=A, QCLASS=IN
+        return q
+
+    def _parse(self, msg, qid):
+        """Returns (ip, ttl_s) of the first A record in the answer to query qid, or None."""
+        if len(msg) < 12:
+            return None
+        rid, flags, qd, an = struct.unpack_from("!HHHH", msg, 0)
+        if rid != qid or not flags & 0x8000 or flags & 0x000F:
+            return None
+        i = 12
+        for _ in range(qd):
+            i = _skip_name(msg, i) + 4
+        for _ in range(an):
+            i = _skip_name(msg, i)
+            rtype, rclass, ttl, rdlen = struct.unpack_from("!HHIH", msg, i)
+            i += 10
+            if rtype == 1 and rclass == 1 and rdlen == 4:
+                return "%d.%d.%d.%d" % (msg[i], msg[i + 1], msg[i + 2], msg[i + 3]), ttl
+            i += rdlen  # CNAME etc.
+        return None
+
+    async def _query(self, host):
+        server = socket.getaddrinfo(self.dns_server, 53)[0][-1]
+        for _ in range(self.retries):
+            # Each request gets its own id, so concurrent lookups can't take each other's answers
+            self._id = (self._id + 1) & 0xFFFF
+            qid = self._id
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            s.setblocking(False)
+            try:
+                s.sendto(self._request(host, qid), server)
+                msg = await asyncio.wait_for_ms(asyncio.StreamReader(s).read(512), self.timeout_ms)
+                r = self._parse(msg, qid) if msg else None
+                if r:
+                    return r
+            except (OSError, IndexError, asyncio.TimeoutError):
+                pass
+            finally:
+                s.close()
+        return None
+
+    def cached(self, host):
+        """Last known address for host, expired or not, or None."""
+        e = self._cache.get(host)
+        return e[0] if e else None
+
+    async def lookup(self, host):
+        """Resolve host to a dotted IPv4 string. Raises OSError if it has never resolved."""
+        if _is_ip(host):
+            return host
+        e = self._cache.get(host)
+        if e and time.ticks_diff(e[1], time.ticks_ms()) > 0:
+            self.hits += 1
+            return e[0]
+
+        self.misses += 1
+        r = await self._query(host) if self.dns_server else None
+        if r:
+            ttl = min(max(r[1], MIN_TTL_S), MAX_TTL_S)
+            self._cache[host] = [r[0], time.ticks_add(time.ticks_ms(), ttl * 1000)]
+            return r[0]
+
+        self.failures += 1
+        if e:
+            self.stale += 1
+            return e[0]
+        raise OSError("DNS lookup failed: %s" % host)
+
+    async def resolve(self, host, port):
+        """Socket address for host:port, as socket.getaddrinfo()[0][-1] would give."""
+        ip = await self.lookup(host)
+        return socket.getaddrinfo(ip, port)[0][-1]
+
+    def metrics(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+            "failures": self.failures,
+            "entries": len(self._cache),
+        }
@@ -0,0 +1,141 @@
+# scheduler.py
+# One task for the firmware's periodic jobs, so they wake the CPU together.
+# - Jobs run on a shared grid of quantum_ms; a wake happens only on a step
+#   where some job is due, and periods that are multiples of each other
+#   (15 s pings, a 120 s heartbeat) share their wakes
+# - With light_sleep_ms, the CPU light-sleeps between wakes instead of
+#   idling, until the next timer of any task but never longer than
+#   light_sleep_ms: incoming data is only read after it, so it bounds how
+#   late a command is acted on
+# - machine.lightsleep() stops the radio for its whole length, long enough
+#   to lose the AP, so given a wlan it only light-sleeps while that is down.
+#   While connected, Wi-Fi modem sleep (wlan.config(pm=PM_POWERSAVE)) is
+#   what saves power, and the CPU idles
+# - Counts wakes and time asleep, and estimates the average current from them
+
+import time
+import machine
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+# Rough ESP32-S2 datasheet figures in mA, for comparing settings rather than
+# a measurement: awake (CPU idle, by MHz), in light sleep, and the averaged
+# cost of staying associated with Wi-Fi modem sleep at minimum and maximum
+AWAKE_MA = {240: 22, 160: 17, 80: 13}
+LIGHT_SLEEP_MA = 0.75
+WIFI_MA = 10
+WIFI_POWERSAVE_MA = 3
+MIN_LIGHT_SLEEP_MS = 20  # shorter gaps are idled through
+
+
+def _next_timer_ms():
+    # Until the next sleeping task is due, None if none is (tasks waiting on
+    # sockets or events have no timer)
+    try:
+        t = asyncio.core._task_queue.peek()
+    except AttributeError:  # CPython
+        loop = asyncio.get_event_loop()
+        if loop._ready:
+            return 0
+        if not loop._scheduled:
+            return None
+        return max(0, int((loop._scheduled[0].when() - loop.time()) * 1000))
+    if t is None:
+        return None
+    return max(0, time.ticks_diff(t.ph_key, time.ticks_ms()))
+
+
+class Scheduler:
+    def __init__(self, quantum_ms=1000, light_sleep_ms=0, wifi_powersave=False, on_lag=None, wlan=None):
+        self.quantum_ms = quantum_ms
+        self.wlan = wlan
+        self.on_lag = on_lag  # called with how late each wake was, e.g. Telemetry.lag
+        self.light_sleep_ms = light_sleep_ms
+        self.wifi_powersave = wifi_powersave
+        self._jobs = []  # (every n quanta, fn)
+        self._n = 0  # quanta since run()
+
+        # Metrics
+        self.wakes = 0
+        self.light_sleeps = 0
+        self.slept_ms = 0
+        self.up_ms = 0
+        self._t = time.ticks_ms()
+        self.errors = 0
+
+    def every(self, period_ms, fn):
+        """Call fn() every period_ms, rounded to whole quanta. A coroutine
+        function is awaited, so a slow one delays the jobs after it."""
+        self._jobs.append((max(1, (period_ms + self.quantum_ms // 2) // self.quantum_ms), fn))
+
+    def _uptime(self):
+        now = time.ticks_ms()
+        self.up_ms += time.ticks_diff(now, self._t)
+        self._t = now
+
+    async def _sleep_until(self, t):
+        while True:
+            rem = time.ticks_diff(t, time.ticks_ms())
+            if rem <= 0:
+                return
+            if not self.light_sleep_ms or self.wlan and self.wlan.isconnected():
+                await asyncio.sleep_ms(rem)
+                continue
+            d = _next_timer_ms()
+            d = rem if d is None else min(rem, d)
+            if d < MIN_LIGHT_SLEEP_MS:
+                await asyncio.sleep_ms(d)  # let that task run first
+                continue
+            d = min(d, self.light_sleep_ms)
+            machine.lightsleep(d)
+            self.light_sleeps += 1
+            self.slept_ms += d
+            await asyncio.sleep_ms(0)  # read what arrived meanwhile
+
+    async def run(self):
+        t = time.ticks_ms()
+        while True:
+            # The next step on which any job is due
+            n = min((self._n // k + 1) * k for k, _ in self._jobs) if self._jobs else self._n + 1
+            t = time.ticks_add(t, (n - self._n) * self.quantum_ms)
+            self._n = n
+            await self._sleep_until(t)
+            late = time.ticks_diff(time.ticks_ms(), t)
+            if self.on_lag:
+                self.on_lag(late)
+            if late > self.quantum_ms:
+                t = time.ticks_add(t, late)  # blocked for a while; don't catch up in a burst
+            self.wakes += 1
+            self._uptime()
+            for k, fn in self._jobs:
+                if n % k:
+                    continue
+                try:
+                    r = fn()
+                    if r is not None:
+                        await r
+                except Exception as e:
+                    self.errors += 1
+                    print("Scheduler:", repr(e))
+
+    def metrics(self, battery_mah=0):
+        self._uptime()
+        up = self.up_ms or 1
+        awake = AWAKE_MA.get(machine.freq() // 1000000, AWAKE_MA[240])
+        asleep = min(self.slept_ms, up)
+        ma = (awake * (up - asleep) + LIGHT_SLEEP_MA * asleep) / up
+        ma += WIFI_POWERSAVE_MA if self.wifi_powersave else WIFI_MA
+        m = {
+            "wakes": self.wakes,
+            "light_sleeps": self.light_sleeps,
+            "wakes_per_h": (self.wakes + self.light_sleeps) * 3600000 // up,
+            "asleep_pct": asleep * 100 // up,
+            "est_ma": round(ma, 2),
+            "errors": self.errors,
+        }
+        if battery_mah:
+            m["est_days"] = round(battery_mah / ma / 24, 1)
+        return m
@@ -0,0 +1,90 @@
+# statejson.py
+# Fixed-schema JSON for state that is published over and over.
+# - The keys, quotes and separators are encoded once, up front
+# - Values (bools, ints, None) are formatted straight into a buffer that is
+#   reused for every call, and a memoryview of it is returned
+# - Nothing is allocated per call, apart from ints too big to be small ints
+#
+# The memoryview is only valid until the next call on the same StateJSON, so
+# give each topic its own: PublishQueue then replaces the queued message with
+# the new one before the buffer could be sent half rewritten.
+
+_TRUE = b"true"
+_FALSE = b"false"
+_NULL = b"null"
+_INT_MAX = 20  # digits and sign of a 64 bit int
+
+
+def _put_int(buf, i, n):
+    if n < 0:
+        buf[i] = 45  # -
+        i += 1
+        n = -n
+    j = i
+    while True:
+        buf[j] = 48 + n % 10
+        n //= 10
+        j += 1
+        if not n:
+            break
+    # Digits came out last first
+    k = j - 1
+    while i < k:
+        buf[i], buf[k] = buf[k], buf[i]
+        i += 1
+        k -= 1
+    return j
+
+
+def _put_value(buf, i, v):
+    if v is True:
+        c = _TRUE
+    elif v is False:
+        c = _FALSE
+    elif v is None:
+        c = _NULL
+    elif isinstance(v, int):
+        return _put_int(buf, i, v)
+    else:
+        raise TypeError("statejson: unsupported value %r" % (v,))
+    n = len(c)
+    buf[i : i + n] = c
+    return i + n
+
+
+class StateJSON:
+    def __init__(self, keys):
+        self.keys = tuple(keys)
+        # '{"a": ', ', "b": ', ... then '}'
+        self._parts = [('{"' if i == 0 else ', "').encode() + k.encode() + b'": ' for i, k in enumerate(self.keys)]
+        size = 2 + sum(len(p) for p in self._parts) + _INT_MAX * len(self.keys)
+        self._buf = bytearray(size)
+        self._mv = memoryview(self._buf)
+        # One value alone, per key, for a topic per field
+        self._vbufs = {k: bytearray(_INT_MAX) for k in self.keys}
+
+    def dumps(self, d):
+        """d as a JSON object, its keys in schema order, as a memoryview."""
+        buf = self._buf
+        parts = self._parts
+        keys = self.keys
+        i = 0
+        for j in range(len(keys)):  # no iterator object, unlike zip()
+            p = parts[j]
+            n = len(p)
+            buf[i : i + n] = p
+            i = _put_value(buf, i + n, d[keys[j]])
+        if not self.keys:
+            buf[0] = 123  # {
+            i = 1
+        buf[i] = 125  # }
+        return self._mv[: i + 1]
+
+    def value(self, k, v):
+        """v alone as JSON, for key k's own topic, as a memoryview."""
+        if v is True:
+            return _TRUE
+        if v is False:
+            return _FALSE
+        buf = self._vbufs[k]
+        return memoryview(buf)[: _put_value(buf, 0, v)]
@@ -0,0 +1,126 @@
+# telemetry.py
+# Device health for the rp2040 and esp32-s2 firmware.
+# - Heap: free, allocated and the largest free block (fragmentation shows as
+#   a largest block much smaller than the free total)
+# - Event loop lag: how late a timer fired, last and worst since the last snapshot
+# - Wi-Fi RSSI, uptime, and why the board last reset, including the reason
+#   given to reset() when the firmware reset itself
+# - Counters from other modules, e.g. MQTTClient.metrics(), picked by key
+
+import gc
+import os
+import time
+import machine
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+RESET_FILE = "reset_reason.txt"
+
+
+def _reset_causes():
+    names = {}
+    for attr, name in (
+        ("PWRON_RESET", "power on"),
+        ("HARD_RESET", "hard"),
+        ("WDT_RESET", "watchdog"),
+        ("DEEPSLEEP_RESET", "deep sleep"),
+        ("SOFT_RESET", "soft"),
+    ):
+        if hasattr(machine, attr):
+            names[getattr(machine, attr)] = name
+    return names
+
+
+def set_reset_reason(reason, path=RESET_FILE):
+    """Leave the reason for the coming reset for the next boot's Telemetry."""
+    try:
+        with open(path, "w") as f:
+            f.write(reason)
+    except OSError:
+        pass
+
+
+def reset(reason, path=RESET_FILE):
+    """machine.reset(), leaving the reason for the next boot's Telemetry."""
+    set_reset_reason(reason, path)
+    machine.reset()
+
+
+def largest_free():
+    """Largest heap block that can be allocated, found by bisection. Costs a
+    few garbage collections, so call it once a snapshot, not in a hot path."""
+    gc.collect()
+    lo = 0
+    hi = gc.mem_free()
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        try:
+            b = bytearray(mid)
+            del b
+            lo = mid
+        except MemoryError:
+            hi = mid - 1
+    gc.collect()
+    return lo
+
+
+class Telemetry:
+    def __init__(self, wlan=None, reset_file=RESET_FILE):
+        self.wlan = wlan
+        self._sources = []  # (name, fn, keys)
+        self.lag_ms = 0
+        self.max_lag_ms = 0  # since the last snapshot
+        self.up_ms = 0
+        self._t = time.ticks_ms()
+        self.reset_cause = _reset_causes().get(machine.reset_cause(), "unknown")
+        try:
+            with open(reset_file) as f:
+                self.reset_cause = f.read()
+            os.remove(reset_file)
+        except OSError:
+            pass  # not reset by reset()
+
+    def add(self, name, fn, keys=None):
+        """Include fn(), a dict of counters, under name; only those of keys it has, if given."""
+        self._sources.append((name, fn, keys))
+
+    def _uptime(self):
+        # Often enough that ticks_ms can't wrap in between
+        now = time.ticks_ms()
+        self.up_ms += time.ticks_diff(now, self._t)
+        self._t = now
+
+    def lag(self, ms):
+        """Record how late a timer fired."""
+        self._uptime()
+        self.lag_ms = ms
+        if ms > self.max_lag_ms:
+            self.max_lag_ms = ms
+
+    async def run(self, probe_ms=1000):
+        """Measure the event loop lag with a timer of its own."""
+        while True:
+            t = time.ticks_add(time.ticks_ms(), probe_ms)
+            await asyncio.sleep_ms(probe_ms)
+            self.lag(max(0, time.ticks_diff(time.ticks_ms(), t)))
+
+    def snapshot(self):
+        self._uptime()
+        m = {
+            "up_s": self.up_ms // 1000,
+            "reset": self.reset_cause,
+            "mem_free": gc.mem_free(),
+            "mem_alloc": gc.mem_alloc(),
+            "largest_free": largest_free(),
+            "lag_ms": self.lag_ms,
+            "max_lag_ms": self.max_lag_ms,
+            "rssi": self.wlan.status("rssi") if self.wlan and self.wlan.isconnected() else None,
+        }
+        self.max_lag_ms = self.lag_ms
+        for name, fn, keys in self._sources:
+            d = fn()
+            m[name] = {k: d[k] for k in keys if k in d} if keys else d
+        return m
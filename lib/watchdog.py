@@ -0,0 +1,79 @@
+# watchdog.py
+# Feeds the hardware watchdog (machine.WDT) only while the firmware is
+# healthy, so a stuck loop or a failed check resets the board.
+# - feed(lag_ms) is called from a timer, run()'s own or a shared scheduler's;
+#   a loop that blocks can't call it, and the WDT fires
+# - A lag over max_lag_ms max_slow times in a row, or a check returning
+#   False, stops the feeding for good; the reason is left for Telemetry
+# - The WDT can't be stopped once started, so it starts on the first feed
+#   (boot can take longer than its timeout)
+
+import time
+import machine
+
+import telemetry
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+
+class Watchdog:
+    def __init__(self, timeout_ms, max_lag_ms=1000, max_slow=3):
+        self.timeout_ms = timeout_ms
+        self.max_lag_ms = max_lag_ms
+        self.max_slow = max_slow
+        self._checks = []  # (reason, fn)
+        self._wdt = None
+        self._slow = 0  # lags over max_lag_ms in a row
+        self.failed = None  # reason feeding stopped
+
+        # Metrics
+        self.feeds = 0
+        self.slow = 0
+
+    def check(self, reason, fn):
+        """Stop feeding, and so reset, once fn() returns False."""
+        self._checks.append((reason, fn))
+
+    def _fail(self, reason):
+        self.failed = reason
+        print("Watchdog:", reason)
+        telemetry.set_reset_reason(reason)
+
+    def feed(self, lag_ms=0):
+        """Feed the WDT if the loop and the checks are healthy. Returns whether it did."""
+        if self.failed:
+            return False
+        if lag_ms > self.max_lag_ms:
+            self.slow += 1
+            self._slow += 1
+            if self._slow >= self.max_slow:
+                self._fail("loop lag %d ms" % lag_ms)
+                return False
+        else:
+            self._slow = 0
+        for reason, fn in self._checks:
+            if not fn():
+                self._fail(reason)
+                return False
+        if self._wdt is None:
+            self._wdt = machine.WDT(timeout=self.timeout_ms)
+        self._wdt.feed()
+        self.feeds += 1
+        return True
+
+    async def run(self, probe_ms=1000, on_lag=None):
+        """Feed from a timer of its own, measuring the loop lag with it;
+        on_lag(ms) gets each measurement, e.g. Telemetry.lag."""
+        while True:
+            t = time.ticks_add(time.ticks_ms(), probe_ms)
+            await asyncio.sleep_ms(probe_ms)
+            lag = max(0, time.ticks_diff(time.ticks_ms(), t))
+            if on_lag:
+                on_lag(lag)
+            self.feed(lag)
+
+    def metrics(self):
+        return {"feeds": self.feeds, "slow": self.slow, "failed": self.failed}
@@ -0,0 +1,173 @@
+# wifi.py
+# Wi-Fi station connect that skips the slow parts when it can.
+# - After a full connect (scan, association, DHCP) the BSSID and channel of
+#   the AP joined, as the driver reports them, are cached in flash per SSID,
+#   with the DHCP lease (ifconfig) and when it was taken
+# - The next connect to that SSID goes straight to that AP: no choosing an
+#   AP and, with static=True, no DHCP either. If the link isn't up within
+#   direct_ms, the entry is dropped and a full connect follows
+# - static is opt-in: a lease is reused only for lease_s after it was taken,
+#   and only if the DHCP server keeps the address reserved for the board. A
+#   clock not yet set since power-up counts as expired
+# - reconnect() is for a periodic job, down_ms() for a watchdog check: the
+#   board resets only after the link has stayed down for a while
+# - Each stage is timed and logged; metrics() has the last connect's times
+
+import json
+import os
+import time
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+CACHE_FILE = "wifi_cache.json"
+
+
+class WifiConnect:
+    def __init__(self, wlan, path=CACHE_FILE, direct_ms=3000, timeout_ms=15000, static=False, lease_s=3600):
+        self.wlan = wlan
+        self.path = path
+        self.direct_ms = direct_ms
+        self.timeout_ms = timeout_ms
+        self.static = static
+        self.lease_s = lease_s
+        self.connecting = False
+        self._down = None  # ticks_ms when the link was first seen down
+
+        # Metrics
+        self.direct = 0  # connects from the cache
+        self.full = 0
+        self.failed = 0
+        self.lost = 0  # times the link went down
+        self.stage_ms = {}  # of the last connect
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _store(self, cache):
+        try:
+            with open(self.path, "w") as f:
+                json.dump(cache, f)
+        except OSError:
+            pass
+
+    def forget(self, ssid):
+        cache = self._load()
+        if cache.pop(ssid, None):
+            self._store(cache)
+
+    def _stage(self, name, t0, ok):
+        ms = time.ticks_diff(time.ticks_ms(), t0)
+        self.stage_ms[name] = ms
+        print("Wi-Fi: %s %s, %d ms" % (name, "ok" if ok else "failed", ms))
+
+    async def _wait(self, ms):
+        t0 = time.ticks_ms()
+        while time.ticks_diff(time.ticks_ms(), t0) < ms:
+            if self.wlan.isconnected():
+                return True
+            if self.wlan.status() < 0:  # rp2040: wrong password, no AP
+                return False
+            await asyncio.sleep_ms(50)
+        return self.wlan.isconnected()
+
+    def _remember(self, ssid):
+        # The AP just joined, not a scan's strongest, which may be another
+        try:
+            bssid = self.wlan.config("bssid")
+        except (ValueError, TypeError, OSError):
+            bssid = None  # not on every port; then connect by SSID only
+        try:
+            channel = self.wlan.config("channel")
+        except (ValueError, TypeError, OSError):
+            channel = None
+        cache = self._load()
+        cache[ssid] = {
+            "bssid": list(bssid) if bssid else None,
+            "channel": channel,
+            "ifconfig": list(self.wlan.ifconfig()),
+            "t": time.time(),
+        }
+        self._store(cache)
+
+    async def connect(self, ssid, pwd):
+        """Connect to ssid, straight from the cache if it can. Returns whether connected."""
+        self.connecting = True
+        try:
+            return await self._connect(ssid, pwd)
+        finally:
+            self.connecting = False
+
+    async def _connect(self, ssid, pwd):
+        w = self.wlan
+        w.active(True)
+        self.stage_ms = {}
+        e = self._load().get(ssid)
+        if e:
+            t0 = time.ticks_ms()
+            if e["channel"]:
+                try:
+                    w.config(channel=e["channel"])
+                except (ValueError, TypeError, OSError):
+                    pass  # not every port takes a channel for a station
+            static = self.static and 0 <= time.time() - e.get("t", 0) < self.lease_s
+            if static:
+                w.ifconfig(tuple(e["ifconfig"]))
+            if e["bssid"]:
+                w.connect(ssid, pwd, bssid=bytes(e["bssid"]))
+            else:
+                w.connect(ssid, pwd)
+            ok = await self._wait(self.direct_ms)
+            self._stage("direct", t0, ok)
+            if ok:
+                self.direct += 1
+                return True
+            self.forget(ssid)  # AP gone, moved channel or lease lost
+            w.disconnect()
+            if static:
+                w.ifconfig("dhcp")
+
+        t0 = time.ticks_ms()
+        w.connect(ssid, pwd)
+        ok = await self._wait(self.timeout_ms)
+        self._stage("connect", t0, ok)
+        if not ok:
+            self.failed += 1
+            return False
+        self.full += 1
+        self._remember(ssid)
+        return True
+
+    def down_ms(self):
+        """How long the link has been down, 0 while it is up."""
+        if self.wlan.isconnected():
+            self._down = None
+            return 0
+        if self._down is None:
+            self._down = time.ticks_ms()
+            self.lost += 1
+        return time.ticks_diff(time.ticks_ms(), self._down)
+
+    async def reconnect(self, ssids):
+        """Connect to the first of ssids, (ssid, pwd) pairs, that takes, if the
+        link is down and no connect is under way. Returns whether connected."""
+        self.down_ms()
+        if self.wlan.isconnected() or self.connecting:
+            return self.wlan.isconnected()
+        for ssid, pwd in ssids:
+            if await self.connect(ssid, pwd):
+                break
+        self.down_ms()  # restarts the count once back up
+        return self.wlan.isconnected()
+
+    def metrics(self):
+        m = {"direct": self.direct, "full": self.full, "failed": self.failed, "lost": self.lost}
+        for k, v in self.stage_ms.items():
+            m[k + "_ms"] = v
+        return m
@@ -3,5 +3,18 @@ config = {
     "wlan_pwd": "**SSID PASSWORD**",
     "wlan_ssid_fallback": "**SSID FALLBACK**",
     "wlan_pwd_fallback": "**SSID PASSWORD**",
-    "time_server": "au.pool.ntp.org",
+    "wifi_lost_s": 300,  # reconnects failing this long reset the board
+    "time_servers": ["0.au.pool.ntp.org", "1.au.pool.ntp.org", "2.au.pool.ntp.org"],
+    "utc_offset_hrs": 11,
+    "board_id": 1,
+    "board_groups": [1],
+    "udp_port": 5005,
+    "udp_group": "239.255.50.50",
+    "udp_key": "**UDP KEY**",
+    "mqtt_host": "",  # "" leaves MQTT off
+    "mqtt_clientid": "**CLIENT_ID**",
+    "mqtt_username": "**USER**",
+    "mqtt_password": "**PASSWORD**",
+    "mqtt_publish_rate": 5,
+    "mqtt_protocol": 4,
 }
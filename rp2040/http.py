@@ -119,6 +119,7 @@ class WebApp(object):
     def __init__(self):
         self.url_map = []
         self.templates_dir = "/templates"
+        self.templates = {}  # name -> compiled render()
         self.static_dir = "/static"
         self.url_map.append((re.compile("^/(static/.+)"), self.handle_static))
         self.headers_mode = "parse"
@@ -233,6 +234,35 @@ class WebApp(object):
             else:
                 raise
 
+    def _load_template(self, tmpl_name):
+        tmpl = self.templates.get(tmpl_name)
+        if tmpl is None:
+            import template
+
+            tmpl = self.templates[tmpl_name] = template.load(self.templates_dir, tmpl_name)
+        return tmpl
+
+    def render_template(self, writer, tmpl_name, args=(), chunk=256):
+        # Written as it renders, gathered into writes of up to chunk bytes
+        tmpl = self._load_template(tmpl_name)
+        buf = bytearray(chunk)
+        n = 0
+        for s in tmpl(*args):
+            if not isinstance(s, bytes):
+                s = s.encode()
+            k = len(s)
+            if n + k > chunk:
+                if n:
+                    yield from writer.awrite(buf, 0, n)
+                    n = 0
+                if k > chunk:
+                    yield from writer.awrite(s)
+                    continue
+            buf[n : n + k] = s
+            n += k
+        if n:
+            yield from writer.awrite(buf, 0, n)
+
     def handle_static(self, req, resp):
         fpath = req.url_match.group(1)
         if ".." in fpath:
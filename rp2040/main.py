@@ -1,14 +1,21 @@
 import rp2
+import machine
 from machine import Pin
-from time import sleep
+from time import gmtime, sleep, ticks_ms
 import network
-import socket
-import struct
-import select
 import gc
-from time import gmtime
 from config import *
-from http import WebApp, jsonify
+from commands import CommandQueue
+from http import WebApp, jsonify, start_response
+from mqtt import AsyncMQTTClient, PublishQueue
+from ntp import NTPClient
+from profiler import Profiler
+from resolver import Resolver
+from statejson import StateJSON
+from telemetry import Telemetry
+from udpctl import UdpControl
+from watchdog import Watchdog
+from wifi import WifiConnect
 
 # Make sure watchdog disabled as first priority
 wdePin = Pin(14, Pin.OUT)
@@ -16,11 +23,6 @@ wdePin.high()
 
 led = machine.Pin("LED", machine.Pin.OUT)
 
-try:
-    import usocket as socket
-except:
-    import socket
-
 try:
     import uasyncio as asyncio
 except ImportError:
@@ -30,18 +32,32 @@ webapp = WebApp()
 
 outputs = 0x00000000
 
-gc.collect()
+# Set when outputs change outside the 1 s refresh, so update_outputs() writes them straight away
+outputs_flag = asyncio.ThreadSafeFlag()
+
+# Debounced input word, latest change sequence number and recent edges
+inputs = 0x00000000
+input_seq = 0
+input_events = []  # (seq, ticks_ms, rising mask, falling mask), oldest first
+INPUT_EVENTS_MAX = 32
+
+# Called with (inputs, rising, falling) on every input change
+input_listeners = []
 
-# The NTP host can be configured at runtime by doing: ntptime.host = 'myhost.org'
-ntp_host = config["time_server"]
+gc.collect()
 
-# (date(2000, 1, 1) - date(1900, 1, 1)).days * 24*60*60
-# (date(1970, 1, 1) - date(1900, 1, 1)).days * 24*60*60
-NTP_DELTA = 3155673600 if gmtime(0)[0] == 2000 else 2208988800
+# "time_servers" wins; a single "time_server" from an older config.py is still accepted
+ntp_servers = config.get("time_servers") or [config["time_server"]]
 
 # Get real time clock
 rtc = machine.RTC()
 
+# Cached DNS, server address is set once WLAN is connected
+resolver = Resolver()
+
+# RTC holds local time, resynced periodically by ntp.run()
+ntp = NTPClient(ntp_servers, rtc, utc_offset_hrs=config.get("utc_offset_hrs", 0), resolver=resolver)
+
 # WLAN connected status flag
 is_wlan_connected = False
 wlan_ip = "not set"
@@ -49,6 +65,24 @@ wlan_ip = "not set"
 wlan = network.WLAN(network.STA_IF)
 wlan.active(True)
 
+# Reconnects go straight to the last AP with the last address, see wifi.py
+wifi = WifiConnect(wlan, timeout_ms=30000)
+
+# Heap, loop lag, RSSI, uptime, reset cause and error counters for /health
+health = Telemetry(wlan)
+health.add("ntp", ntp.metrics, ("failures", "offset_ms"))
+health.add("wifi", wifi.metrics, ("direct", "full", "lost", "direct_ms", "connect_ms"))
+
+# Per-task timing for /profile when "profile" is set in config.py
+prof = Profiler(enabled=config.get("profile", False))
+
+# The hardware watchdog is fed from its own 1 s timer while the loop keeps
+# time and WLAN isn't down for longer than wlan_keep() gets to bring it back
+# (wifi_lost_s); the RP2040's allows at most ~8.3 s
+wdt = Watchdog(config.get("wdt_timeout_ms", 8000))
+wdt.check("wifi lost", lambda: wifi.down_ms() < config.get("wifi_lost_s", 300) * 1000)
+health.add("watchdog", wdt.metrics)
+
 outputEnablePin = Pin(13, Pin.OUT, Pin.PULL_UP)
 outputEnablePin.high()
 
@@ -77,6 +111,146 @@ sm0.put(outputs)
 outputEnablePin.low()
 
 
+# The data pin is QH of the 74HC165 chain, load is side set bit 0 (default high, active low), clock is side set bit 1 (default low)
+# Each pass loads and shifts in all 32 inputs (~330 cycles). A new word is only pushed once DEBOUNCE samples in a row
+# agree: y holds the candidate, and the OSR's shift counter counts the samples, 32 / 4 = 8 after the first. The OSR
+# is empty once a word has been pushed, so an unchanged sample then costs nothing.
+@rp2.asm_pio(sideset_init=(rp2.PIO.OUT_HIGH, rp2.PIO.OUT_LOW), in_shiftdir=rp2.PIO.SHIFT_LEFT)
+def pio_in_prog():
+    wrap_target()
+    set(x, 31).side(0x00)[1]  # load low, latch parallel inputs
+    label("bitloop")
+    in_(pins, 1).side(0x01)  # load high, sample QH
+    jmp(x_dec, "bitloop").side(0x03)  # set clock, shift next bit to QH
+    mov(x, isr).side(0x01)  # x = this sample
+    jmp(x_not_y, "differs").side(0x01)
+    jmp(not_osre, "confirm").side(0x01)  # counting a candidate
+    jmp("sleep").side(0x01)  # stable and already pushed
+    label("differs")
+    mov(y, x).side(0x01)  # new candidate
+    mov(osr, null).side(0x01)  # restart the count
+    jmp("sleep").side(0x01)
+    label("confirm")
+    out(null, 4).side(0x01)
+    jmp(not_osre, "sleep").side(0x01)
+    push(block).side(0x01)  # isr still holds the sample
+    irq(rel(0)).side(0x01)  # wake read_inputs()
+    label("sleep")
+    mov(isr, null).side(0x01)
+    set(x, 31).side(0x01)
+    label("delay")
+    jmp(x_dec, "delay").side(0x01)[7]  # 256 cycles between samples
+    wrap()
+
+
+DEBOUNCE = 9  # samples, ~3 ms; out(null, 4) above sets it
+
+inputs_flag = asyncio.ThreadSafeFlag()
+
+# Pin(6) is the data pin, Pin(7) is the load pin and Pin(8) is the clock pin
+# PIO1 is left to the Pico W's cyw43 Wi-Fi driver, so this is state machine 1 on PIO0, next to sm0: the two
+# programs take 26 of its 32 instructions. At 1 MHz inputs are sampled every ~0.33 ms
+sm1 = rp2.StateMachine(1, pio_in_prog, freq=1000000, in_base=Pin(6), sideset_base=Pin(7))
+sm1.irq(lambda sm: inputs_flag.set())
+sm1.active(1)
+
+
+def apply_outputs(set_mask, clear_mask):
+    global outputs
+
+    outputs = (outputs & ~clear_mask & 0xFFFFFFFF) | set_mask
+    outputs_flag.set()
+    return outputs
+
+
+# Seconds from 1970 to the port's epoch, which is 2000 on some ports
+EPOCH_1970_S = 946684800 if gmtime(0)[0] == 2000 else 0
+
+
+def utc_seconds():
+    # None until NTP has set the clock, the timestamp check is skipped until then
+    if not ntp.syncs:
+        return None
+    return (ntp.now_ms() - ntp.tz_ms) // 1000 + EPOCH_1970_S
+
+
+# Authenticated UDP output updates, only when a key is configured
+udpctl = None
+if config.get("udp_key"):
+    udpctl = UdpControl(
+        config["udp_key"],
+        config.get("board_id", 1),
+        apply_outputs,
+        groups=config.get("board_groups", ()),
+        port=config.get("udp_port", 5005),
+        group_addr=config.get("udp_group"),
+        clock=utc_seconds,
+    )
+    health.add("udp", udpctl.metrics, ("rejected", "replays"))
+
+
+def apply_commands(mask, values):
+    # Every command queued since the last call, as one write
+    apply_outputs(values & mask, ~values & mask & 0xFFFFFFFF)
+
+
+# MQTT alongside the HTTP server, only when a broker is configured.
+# <id>/outputs/set takes {"op1": true, "op2": false} or whole masks,
+# {"set": 5, "clear": 2}; <id>/outputs and <id>/inputs are retained and
+# published on change
+mqtt_client = None
+if config.get("mqtt_host"):
+    mqtt_clientid = config["mqtt_clientid"]
+    TOPIC_OUTPUTS_SET = (mqtt_clientid + "/outputs/set").encode()
+    TOPIC_OUTPUTS = (mqtt_clientid + "/outputs").encode()
+    TOPIC_INPUTS = (mqtt_clientid + "/inputs").encode()
+    # One buffer per topic, see statejson.py
+    OUTPUTS_JSON = StateJSON(("outputs",))
+    INPUTS_JSON = StateJSON(("inputs", "seq"))
+    mqtt_outputs = {"outputs": None}  # as last published
+    mqtt_inputs = {"inputs": 0, "seq": 0}
+    mqtt_client = AsyncMQTTClient(
+        client_id=mqtt_clientid,
+        server=config["mqtt_host"],
+        port=config.get("mqtt_port", 0),
+        user=config.get("mqtt_username") or None,
+        password=config.get("mqtt_password") or None,
+        keepalive=60,
+        protocol=config.get("mqtt_protocol", 4),
+    )
+    outbox = PublishQueue(mqtt_client, rate=config.get("mqtt_publish_rate", 5))
+    commands = CommandQueue(tuple("op%d" % (i + 1) for i in range(32)), apply_commands, masks=True)
+    health.add("mqtt", mqtt_client.metrics, ("reconnects", "dead_links", "refused", "retransmits", "srtt_ms", "last_error"))
+    health.add("outbox", outbox.metrics, ("failed", "dropped"))
+    health.add("commands", commands.metrics, ("received", "invalid", "folded"))
+
+
+def mqtt_on_msg(topic, msg):
+    # msg points into the client's receive buffer, only good until this
+    # returns; checked and queued here, applied by commands.run()
+    if not commands.push(msg):
+        print("Invalid command:", bytes(msg))
+
+
+def mqtt_publish_outputs():
+    mqtt_outputs["outputs"] = outputs
+    outbox.put(TOPIC_OUTPUTS, OUTPUTS_JSON.dumps(mqtt_outputs), True)
+
+
+def mqtt_publish_inputs(word, rising, falling):
+    mqtt_inputs["inputs"] = word
+    mqtt_inputs["seq"] = input_seq
+    outbox.put(TOPIC_INPUTS, INPUTS_JSON.dumps(mqtt_inputs), True)
+
+
+async def mqtt_service():
+    await mqtt_client.subscribe(TOPIC_OUTPUTS_SET, handler=mqtt_on_msg)  # sent on connect
+    mqtt_publish_outputs()
+    mqtt_publish_inputs(inputs, 0, 0)
+    input_listeners.append(mqtt_publish_inputs)
+    await mqtt_client.keep_connected(resolver.lookup)  # never returns
+
+
 def get_output(name):
     global outputs
 
@@ -203,6 +377,59 @@ def index(request, response):
     yield from jsonify(response, obj)
 
 
+@webapp.route("/inputs", method="GET")
+def get_inputs(request, response):
+    # Optional ?since=<seq> returns only newer edge events
+    request.parse_qs()
+    try:
+        since = int(request.form.get("since", 0))
+    except ValueError:
+        yield from webapp.abort(response, "400")
+        return
+    obj = {}
+    obj["inputs"] = inputs
+    obj["seq"] = input_seq
+    obj["events"] = [{"seq": e[0], "ms": e[1], "rising": e[2], "falling": e[3]} for e in input_events if e[0] > since]
+    gc.collect()
+    yield from jsonify(response, obj)
+
+
+@webapp.route("/time", method="GET")
+def time_status(request, response):
+    obj = ntp.metrics()
+    obj["date_time"] = rtc.datetime()
+    gc.collect()
+    yield from jsonify(response, obj)
+
+
+@webapp.route("/health", method="GET")
+def health_status(request, response):
+    obj = health.snapshot()
+    gc.collect()
+    yield from jsonify(response, obj)
+
+
+@webapp.route("/profile", method="GET")
+def profile_status(request, response):
+    obj = prof.stats() if prof.enabled else {"enabled": False}
+    gc.collect()
+    yield from jsonify(response, obj)
+
+
+@webapp.route("/status", method="GET")
+def status_page(request, response):
+    # templates/status.html, sent as it renders rather than built in RAM
+    yield from start_response(response)
+    yield from webapp.render_template(response, "status.html", (outputs, inputs, input_seq))
+
+
+@webapp.route("/udp", method="GET")
+def udp_status(request, response):
+    obj = udpctl.metrics() if udpctl else {"enabled": False}
+    gc.collect()
+    yield from jsonify(response, obj)
+
+
 @webapp.route("/outputs/1", method="GET")
 def index(request, response):
     global outputs
@@ -493,15 +720,9 @@ def set_outputs(request, response):
 
 def wlan_connect(ssid, pwd):
     wlan.disconnect()
-    wlan.connect(ssid, pwd)
 
-    # Wait for connect or fail
-    wait = 30
-    while wait > 0:
-        if wlan.status() < 0 or wlan.status() >= 3:
-            break
-        wait -= 1
-        sleep(1)
+    # Connect or fail, each stage's time is logged
+    asyncio.run(wifi.connect(ssid, pwd))
 
 
 def wlan_connected():
@@ -530,58 +751,64 @@ def wlan_init():
         is_wlan_connected = False
     else:
         wlan_ip = wlan.ifconfig()[0]
+        resolver.dns_server = wlan.ifconfig()[3]
         is_wlan_connected = True
 
 
-def ts_time(hrs_offset=0):  # Local time offset in hrs relative to UTC
-    NTP_QUERY = bytearray(48)
-    NTP_QUERY[0] = 0x1B
-    try:
-        addr = socket.getaddrinfo(ntp_host, 123)[0][-1]
-    except OSError:
-        return 0
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    poller = select.poll()
-    poller.register(s, select.POLLIN)
-    try:
-        s.sendto(NTP_QUERY, addr)
-        if poller.poll(1000):  # time in milliseconds
-            msg = s.recv(48)
-            val = struct.unpack("!I", msg[40:44])[0]  # Can return 0
-            return max(val - NTP_DELTA + hrs_offset * 3600, 0)
-    except OSError:
-        pass  # LAN error
-    finally:
-        s.close()
-    return 0  # Timeout or LAN error occurred
+async def wlan_keep():
+    global wlan_ip
+
+    # Reconnect when the link drops, to the fallback SSID if the main one fails
+    ssids = ((config["wlan_ssid"], config["wlan_pwd"]), (config["wlan_ssid_fallback"], config["wlan_pwd_fallback"]))
+    while True:
+        await asyncio.sleep_ms(2000)
+        if not wlan_connected() and await wifi.reconnect(ssids):
+            wlan_ip = wlan.ifconfig()[0]
+            resolver.dns_server = wlan.ifconfig()[3]
 
 
 def refresh_date_time():
     if not is_wlan_connected:
         return  # Can't refresh date / time if WLAN not connected
 
-    # gmtime returns time.struct_time
-    # 0 tm_year (for example, 1993)
-    # 1 tm_mon  range [1, 12]
-    # 2 tm_mday range [1, 31]
-    # 3 tm_hour range [0, 23]
-    # 4 tm_min  range [0, 59]
-    # 5 tm_sec  range [0, 61]
-    # 6 tm_wday range [0, 6], Monday is 0
-    # 7 tm_yday range [1, 366]
-    # 8 tm_isdst    0, 1 or -1
+    asyncio.run(ntp.sync())
 
-    dt = gmtime(ts_time(11))
 
-    # rtc.datetime takes tuple (year, month, day, weekday, hours, minutes, seconds, subseconds)
-    rtc.datetime((dt[0], dt[1], dt[2], dt[7], dt[3], dt[4], dt[5], dt[6]))
+async def read_inputs():
+    global inputs
+    global input_seq
+
+    while True:
+        await inputs_flag.wait()
+        while sm1.rx_fifo():
+            word = sm1.get()
+            changed = word ^ inputs
+            if not changed:
+                continue
+            rising = changed & word
+            falling = changed & inputs
+            inputs = word
+            input_seq += 1
+            input_events.append((input_seq, ticks_ms(), rising, falling))
+            if len(input_events) > INPUT_EVENTS_MAX:
+                input_events.pop(0)
+            for f in input_listeners:
+                f(inputs, rising, falling)
 
 
 async def update_outputs():
     while True:
-        await asyncio.sleep(1)
+        try:
+            await asyncio.wait_for_ms(outputs_flag.wait(), 1000)
+        except asyncio.TimeoutError:
+            gc.collect()
+        # A put blocks while the TX FIFO is full, so wait for a frame to go out first
+        while sm0.tx_fifo() >= 4:
+            await asyncio.sleep_ms(10)
         sm0.put(outputs)
-        gc.collect()
+        # Changes by HTTP and UDP too, within the 1 s refresh
+        if mqtt_client and outputs != mqtt_outputs["outputs"]:
+            mqtt_publish_outputs()
 
 
 print("Connecting to WLAN")
@@ -608,8 +835,18 @@ while True:
         continue
 
     loop = asyncio.get_event_loop()
-    loop.create_task(update_outputs())
-    loop.create_task(asyncio.start_server(webapp.handle, "0.0.0.0", 80))
+    loop.create_task(prof.wrap(update_outputs(), "outputs"))
+    loop.create_task(prof.wrap(read_inputs(), "inputs"))
+    loop.create_task(prof.wrap(ntp.run(), "ntp"))
+    loop.create_task(prof.wrap(wdt.run(on_lag=health.lag), "watchdog"))
+    loop.create_task(prof.wrap(wlan_keep(), "wifi"))
+    if udpctl:
+        loop.create_task(prof.wrap(udpctl.run(wlan_ip), "udp"))
+    if mqtt_client:
+        loop.create_task(prof.wrap(mqtt_service(), "mqtt"))
+        loop.create_task(prof.wrap(outbox.run(), "outbox"))
+        loop.create_task(prof.wrap(commands.run(), "commands"))
+    loop.create_task(asyncio.start_server(lambda r, w: prof.wrap(webapp.handle(r, w), "http"), "0.0.0.0", 80))
     gc.collect()
     loop.run_forever()
     sm0.put(outputs)
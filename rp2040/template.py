@@ -0,0 +1,113 @@
+# template.py
+# Templates compiled to generator functions, for WebApp.render_template().
+# - translate() turns a template into the source of a module with one
+#   function, render(), that yields the page a piece at a time: the text
+#   between tags as bytes constants, each {{ expr }} as str(expr)
+# - load() compiles templates_dir/name.html to templates_dir/name_html.py
+#   once, again only when the template is newer, and imports it. A .mpy of
+#   it from mpy-cross is imported the same way, the template can then go
+# - Tags: {% args a, b=1 %} (the parameters of render(), first), {{ expr }},
+#   {% if %} {% elif %} {% else %} {% endif %}, {% for %} {% endfor %},
+#   {% while %} {% endwhile %} and {# comments #}. A newline right after a
+#   {% %} tag is dropped. Nothing is escaped
+#
+# Rendering allocates only the str() of each value, so a page is never in
+# RAM whole, however long it is.
+
+import os
+import sys
+
+_CLOSE = {"{": "}}", "%": "%}", "#": "#}"}
+_BLOCKS = ("if", "for", "while")
+
+
+def translate(text):
+    """Python source of a module whose render() yields text rendered."""
+    args = ""
+    code = []
+    stack = []
+    yields = 0
+    n = len(text)
+    i = 0
+    while i < n:
+        # The next tag, or the end
+        j = text.find("{", i)
+        while j != -1 and text[j + 1 : j + 2] not in _CLOSE:
+            j = text.find("{", j + 1)
+        if j == -1:
+            j = n
+        ind = "    " * (len(stack) + 1)
+        if j > i:
+            code.append("%syield %r" % (ind, text[i:j].encode()))
+            yields += 1
+        if j == n:
+            break
+        kind = text[j + 1]
+        k = text.find(_CLOSE[kind], j + 2)
+        if k == -1:
+            raise ValueError("template: unclosed %s" % text[j : j + 20])
+        body = text[j + 2 : k].strip()
+        i = k + 2
+        if kind == "{":
+            code.append("%syield str(%s)" % (ind, body))
+            yields += 1
+            continue
+        if kind == "#":
+            continue
+        if text[i : i + 2] == "\r\n":
+            i += 2
+        elif text[i : i + 1] == "\n":
+            i += 1
+        word = body.split(None, 1)[0] if body else ""
+        if word == "args":
+            if code or stack:
+                raise ValueError("template: args must come first")
+            args = body[4:].strip()
+        elif word in _BLOCKS:
+            code.append("%s%s:" % (ind, body))
+            code.append("%s    pass" % ind)  # the block may be empty
+            stack.append(word)
+        elif word in ("elif", "else"):
+            if not stack or stack[-1] != "if":
+                raise ValueError("template: %s outside if" % word)
+            code.append("%s%s:" % (ind[4:], body))
+            code.append("%spass" % ind)
+        elif word[:3] == "end" and word[3:] in _BLOCKS:
+            if not stack or stack.pop() != word[3:]:
+                raise ValueError("template: unexpected %s" % word)
+        else:
+            raise ValueError("template: unknown tag {%% %s %%}" % body)
+    if stack:
+        raise ValueError("template: no end%s" % stack[-1])
+    if not yields:
+        code.append("    yield b''")  # still a generator
+    return "def render(%s):\n%s\n" % (args, "\n".join(code))
+
+
+def _mtime(path):
+    try:
+        return os.stat(path)[8]
+    except OSError:
+        return None
+
+
+def load(templates_dir, name):
+    """render() of templates_dir/name, compiled and imported."""
+    mod = name.replace(".", "_")
+    src = templates_dir + "/" + name
+    out = templates_dir + "/" + mod + ".py"
+    t = _mtime(src)
+    if t is not None:  # else shipped compiled only
+        c = _mtime(out)
+        if c is None or c < t:
+            with open(src) as f:
+                code = translate(f.read())
+            with open(out, "w") as f:
+                f.write("# Compiled from %s by template.py, redone when it changes\n" % name)
+                f.write(code)
+            sys.modules.pop(mod, None)
+    sys.path.insert(0, templates_dir)
+    try:
+        return __import__(mod).render
+    finally:
+        sys.path.remove(templates_dir)
@@ -0,0 +1,214 @@
+# udpctl.py
+# Compact UDP control of the outputs, for updating many boards at once.
+# - One 40 byte datagram sets and clears output bits on a board, a group of boards or all of them
+# - Sent unicast, or to a multicast group so a single packet reaches the whole fleet
+# - Authenticated with a truncated HMAC-SHA256 over a shared key
+# - Replays are rejected: sequence numbers must increase per sender and the
+#   timestamp must be within WINDOW_S of the board's clock and after it
+#   booted. The sequence numbers are only kept in RAM, so the boot time is
+#   what stops datagrams captured before a reboot. Until the clock is known
+#   (clock() returns None) only the sequence numbers are checked
+# - An ack with the resulting outputs is sent back when the sender asks for one
+#
+# Datagram (big endian):
+#   0  2  magic b"UC"
+#   2  1  version (1)
+#   3  1  flags: FLAG_ACK ack wanted, FLAG_GROUP target is a group id, FLAG_REPLY this is an ack
+#   4  1  sender id, each controller uses its own
+#   5  1  reserved (0)
+#   6  2  target board id, or group id with FLAG_GROUP, ALL for every board
+#   8  4  sequence number
+#  12  4  UTC seconds since 1970
+#  16  4  bits to set
+#  20  4  bits to clear
+#  24 16  HMAC-SHA256(key, bytes 0-23), first 16 bytes
+
+import struct
+import time
+
+try:
+    import uhashlib as hashlib
+except ImportError:
+    import hashlib
+
+try:
+    import usocket as socket
+except ImportError:
+    import socket
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+MAGIC = b"UC"
+VERSION = 1
+FLAG_ACK = 0x01
+FLAG_GROUP = 0x02
+FLAG_REPLY = 0x80
+ALL = 0xFFFF
+HEADER = "!2sBBBBHIIII"
+HEADER_LEN = 24
+MAC_LEN = 16
+PACKET_LEN = HEADER_LEN + MAC_LEN
+WINDOW_S = 30
+
+
+def _hmac(key, msg):
+    # No hmac module on MicroPython, RFC 2104 by hand
+    if len(key) > 64:
+        key = hashlib.sha256(key).digest()
+    key = key + bytes(64 - len(key))
+    inner = hashlib.sha256(bytes(b ^ 0x36 for b in key))
+    inner.update(msg)
+    outer = hashlib.sha256(bytes(b ^ 0x5C for b in key))
+    outer.update(inner.digest())
+    return outer.digest()
+
+
+def _same(a, b):
+    # Compare without bailing out at the first difference
+    if len(a) != len(b):
+        return False
+    r = 0
+    for i in range(len(a)):
+        r |= a[i] ^ b[i]
+    return r == 0
+
+
+def _ip(addr):
+    return bytes(int(p) for p in addr.split("."))
+
+
+def pack(key, sender, target, seq, t, set_mask, clear_mask, flags=0):
+    """Build a signed datagram. Also used by controllers running CPython."""
+    if isinstance(key, str):
+        key = key.encode()
+    msg = struct.pack(HEADER, MAGIC, VERSION, flags, sender, 0, target, seq, t, set_mask, clear_mask)
+    return msg + _hmac(key, msg)[:MAC_LEN]
+
+
+def unpack(key, pkt):
+    """Returns (flags, sender, target, seq, t, set_mask, clear_mask), or None if the packet is not valid."""
+    if isinstance(key, str):
+        key = key.encode()
+    if len(pkt) != PACKET_LEN:
+        return None
+    magic, ver, flags, sender, _, target, seq, t, set_mask, clear_mask = struct.unpack_from(HEADER, pkt, 0)
+    if magic != MAGIC or ver != VERSION:
+        return None
+    if not _same(_hmac(key, pkt[:HEADER_LEN])[:MAC_LEN], pkt[HEADER_LEN:]):
+        return None
+    return flags, sender, target, seq, t, set_mask, clear_mask
+
+
+def _wait_readable(s):
+    # uasyncio streams have no recvfrom, so park on the poller until a datagram arrives
+    yield asyncio.core._io_queue.queue_read(s)
+
+
+class UdpControl:
+    def __init__(self, key, board_id, apply, groups=(), port=5005, group_addr=None, clock=None):
+        """apply(set_mask, clear_mask) updates the outputs and returns the new output word.
+        clock() returns UTC seconds since 1970, or None while the time is not known."""
+        self.key = key.encode() if isinstance(key, str) else key
+        self.board_id = board_id
+        self.groups = groups
+        self.apply = apply
+        self.port = port
+        self.group_addr = group_addr
+        self.clock = clock
+        self._seqs = {}  # sender id -> last accepted sequence number, at most 256 entries
+        self._boot_s = None  # UTC seconds at boot, once the clock is known
+
+        # Metrics
+        self.received = 0
+        self.applied = 0
+        self.ignored = 0
+        self.rejected = 0
+        self.replays = 0
+        self.acks = 0
+
+    def _for_us(self, flags, target):
+        if target == ALL:
+            return True
+        if flags & FLAG_GROUP:
+            return target in self.groups
+        return target == self.board_id
+
+    def handle(self, pkt):
+        """Check and apply one datagram. Returns the ack to send back, or None."""
+        self.received += 1
+        r = unpack(self.key, pkt)
+        if r is None:
+            self.rejected += 1
+            return None
+        flags, sender, target, seq, t, set_mask, clear_mask = r
+        if flags & FLAG_REPLY or not self._for_us(flags, target):
+            self.ignored += 1
+            return None
+
+        # Serial number arithmetic, so the sequence may wrap
+        last = self._seqs.get(sender)
+        now = self.clock() if self.clock else None
+        if last is not None and not 0 < (seq - last) & 0xFFFFFFFF < 0x80000000:
+            self.replays += 1
+            return None
+        if now is not None:
+            if self._boot_s is None:
+                self._boot_s = now - time.ticks_ms() // 1000
+            if abs(t - now) > WINDOW_S or t < self._boot_s:
+                self.replays += 1
+                return None
+        self._seqs[sender] = seq
+
+        outputs = self.apply(set_mask, clear_mask)
+        self.applied += 1
+        if not flags & FLAG_ACK:
+            return None
+        self.acks += 1
+        return pack(self.key, sender, self.board_id, seq, now or t, outputs, 0, FLAG_REPLY)
+
+    def _open(self, local_ip=None):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind(socket.getaddrinfo("0.0.0.0", self.port)[0][-1])
+        if self.group_addr:
+            try:
+                mreq = _ip(self.group_addr) + _ip(local_ip or "0.0.0.0")
+                s.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+            except (AttributeError, OSError, ValueError, TypeError) as e:  # no multicast, or a bad group_addr
+                print("UDP control: multicast join failed:", e)
+        s.setblocking(False)
+        return s
+
+    async def run(self, local_ip=None):
+        """Receive and apply datagrams forever."""
+        s = self._open(local_ip)
+        try:
+            while True:
+                await _wait_readable(s)
+                try:
+                    # One spare byte, so oversized packets fail the length check
+                    pkt, addr = s.recvfrom(PACKET_LEN + 1)
+                except OSError:
+                    continue
+                ack = self.handle(pkt)
+                if ack:
+                    try:
+                        s.sendto(ack, addr)
+                    except OSError:
+                        pass
+        finally:
+            s.close()
+
+    def metrics(self):
+        return {
+            "received": self.received,
+            "applied": self.applied,
+            "ignored": self.ignored,
+            "rejected": self.rejected,
+            "replays": self.replays,
+            "acks": self.acks,
+            "senders": len(self._seqs),
+        }